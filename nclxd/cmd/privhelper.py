@@ -0,0 +1,264 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Privileged helper for the LXD compute driver.
+
+The driver starts this once through the root helper and keeps it running.
+Requests and replies are single JSON documents, one per line, on stdin
+and stdout. Only the operations in OPS are accepted, and file operations
+are limited to the LXD containers and snapshots directories, except for
+new files created in a directory of the calling user. Files can only be
+given to the user that started the helper through sudo.
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import stat
+import subprocess
+import sys
+import tarfile
+
+from nclxd.nova.virt.lxd import constants
+
+
+class CommandError(Exception):
+
+    def __init__(self, cmd, exit_code, stdout, stderr):
+        super(CommandError, self).__init__(
+            '%s exited with %s' % (' '.join(cmd), exit_code))
+        self.cmd = cmd
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class PrivHelper(object):
+
+    def __init__(self, root_dir, uid, gid):
+        self.uid = uid
+        self.gid = gid
+        self.containers_dir = os.path.join(os.path.realpath(root_dir),
+                                           'containers')
+        self.snapshots_dir = os.path.join(os.path.realpath(root_dir),
+                                          'snapshots')
+
+    def _check_path(self, path, allowed_dir=None):
+        allowed_dir = allowed_dir or self.containers_dir
+        real_path = os.path.realpath(path)
+        if not real_path.startswith(allowed_dir + os.sep):
+            raise ValueError('%s is outside of %s' % (path, allowed_dir))
+        return real_path
+
+    def _check_args(self, args):
+        # json always decodes strings to unicode.
+        if not all(isinstance(arg, type(u'')) for arg in args):
+            raise ValueError('Arguments must be strings')
+
+    def _run(self, cmd, process_input=None):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate(
+            process_input.encode() if process_input is not None else None)
+        stdout = stdout.decode('utf-8', 'replace')
+        stderr = stderr.decode('utf-8', 'replace')
+        if proc.returncode != 0:
+            raise CommandError(cmd, proc.returncode, stdout, stderr)
+        return stdout
+
+    def chown(self, path, uid, gid):
+        if (int(uid), int(gid)) != (self.uid, self.gid):
+            raise ValueError('Files can only be given to %s:%s' %
+                             (self.uid, self.gid))
+        os.chown(self._check_path(path), self.uid, self.gid)
+
+    def chmod(self, path, mode):
+        real_path = self._check_path(path)
+        if int(mode) != 0o755 or not os.path.isdir(real_path):
+            raise ValueError('Only directories can be made 0755')
+        os.chmod(real_path, 0o755)
+
+    def read_console(self, path, max_bytes, offset=None):
+        """Read a console log, base64 encoded.
+
+        Returns what was written after offset, or the last max_bytes if
+        offset is not given or no longer within the last max_bytes,
+        along with the file's size and inode.
+        """
+        with open(self._check_path(path), 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            start = max(0, stat.st_size - int(max_bytes))
+            if offset is not None and start < int(offset) <= stat.st_size:
+                start = int(offset)
+            fp.seek(start)
+            data = fp.read(stat.st_size - start)
+        return {'data': base64.b64encode(data).decode('ascii'),
+                'offset': start,
+                'size': stat.st_size,
+                'inode': stat.st_ino}
+
+    def ip_batch(self, commands):
+        self._check_args(commands)
+        for command in commands:
+            if '\n' in command or not command.startswith('link '):
+                raise ValueError('Only link commands are allowed')
+        return self._run(['ip', '-batch', '-'],
+                         '\n'.join(commands) + '\n')
+
+    def ovs_vsctl(self, args):
+        self._check_args(args)
+        return self._run(['ovs-vsctl'] + list(args))
+
+    def _create_target(self, target):
+        """Create a new file for the calling user in one of its dirs."""
+        target_dir = os.path.realpath(os.path.dirname(target))
+        if os.stat(target_dir).st_uid != self.uid:
+            raise ValueError('%s does not belong to %s' %
+                             (target_dir, self.uid))
+        # Never follow or reuse what the caller may have put there.
+        fd = os.open(os.path.join(target_dir, os.path.basename(target)),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                     0o644)
+        os.fchown(fd, self.uid, self.gid)
+        return os.fdopen(fd, 'wb')
+
+    def _changed(self, old, new, old_path, new_path):
+        if old is None:
+            return True
+        if (stat.S_IFMT(old.st_mode) != stat.S_IFMT(new.st_mode) or
+                (old.st_mode, old.st_uid, old.st_gid) !=
+                (new.st_mode, new.st_uid, new.st_gid)):
+            return True
+        if stat.S_ISDIR(new.st_mode):
+            return False
+        if stat.S_ISLNK(new.st_mode):
+            return os.readlink(old_path) != os.readlink(new_path)
+        return (old.st_size != new.st_size or
+                int(old.st_mtime) != int(new.st_mtime))
+
+    def rootfs_delta(self, base, new, target):
+        """Write the changes between two snapshot rootfs to a tarball.
+
+        Entries of new whose type, mode, owner, size, mtime or link
+        target differ from base are added under rootfs/, unshifted to the
+        container's own ids like in an image export. Paths removed since
+        base are listed in the WHITEOUTS member, which comes first. The
+        tarball is created as a new file of the calling user, in a
+        directory of that user.
+        """
+        # Walk with native strings so that names of any encoding survive.
+        base = str(self._check_path(base, self.snapshots_dir))
+        new = str(self._check_path(new, self.snapshots_dir))
+        root = os.lstat(new)
+
+        removed = []
+        for dirpath, dirnames, filenames in os.walk(base):
+            rel_dir = os.path.relpath(dirpath, base)
+            for name in list(dirnames) + filenames:
+                rel = os.path.normpath(os.path.join(rel_dir, name))
+                if not os.path.lexists(os.path.join(new, rel)):
+                    removed.append(rel)
+                    if name in dirnames:
+                        dirnames.remove(name)
+
+        def unshift(tar_info):
+            if tar_info.uid >= root.st_uid:
+                tar_info.uid -= root.st_uid
+            if tar_info.gid >= root.st_gid:
+                tar_info.gid -= root.st_gid
+            tar_info.uname = tar_info.gname = ''
+            return tar_info
+
+        changed = 0
+        with self._create_target(target) as fp:
+            with tarfile.open(fileobj=fp, mode='w:gz') as tar:
+                whiteouts = ''.join(rel + '\0' for rel in removed)
+                if not isinstance(whiteouts, bytes):
+                    whiteouts = os.fsencode(whiteouts)
+                tar_info = tarfile.TarInfo(constants.WHITEOUTS)
+                tar_info.size = len(whiteouts)
+                tar.addfile(tar_info, io.BytesIO(whiteouts))
+
+                for dirpath, dirnames, filenames in os.walk(new):
+                    rel_dir = os.path.relpath(dirpath, new)
+                    for name in dirnames + filenames:
+                        rel = os.path.normpath(os.path.join(rel_dir, name))
+                        new_path = os.path.join(new, rel)
+                        old_path = os.path.join(base, rel)
+                        new_stat = os.lstat(new_path)
+                        try:
+                            old_stat = os.lstat(old_path)
+                        except OSError:
+                            old_stat = None
+                        if self._changed(old_stat, new_stat, old_path,
+                                         new_path):
+                            tar.add(new_path, arcname='rootfs/' + rel,
+                                    recursive=False, filter=unshift)
+                            changed += 1
+            size = fp.tell()
+        return {'changed': changed, 'removed': len(removed), 'size': size}
+
+    OPS = ('chown', 'chmod', 'read_console', 'ip_batch', 'ovs_vsctl',
+           'rootfs_delta')
+
+    def handle(self, request):
+        if not isinstance(request, dict):
+            return {'error': 'Invalid request'}
+        op = request.get('op')
+        if op not in self.OPS:
+            return {'error': 'Unknown operation %s' % op}
+        try:
+            return {'result': getattr(self, op)(*request.get('args', []))}
+        except CommandError as ex:
+            return {'error': str(ex), 'cmd': ex.cmd,
+                    'exit_code': ex.exit_code,
+                    'stdout': ex.stdout, 'stderr': ex.stderr}
+        except Exception as ex:
+            return {'error': '%s: %s' % (type(ex).__name__, ex)}
+
+
+def _caller():
+    """Return the uid and gid of the user that ran sudo."""
+    try:
+        return int(os.environ['SUDO_UID']), int(os.environ['SUDO_GID'])
+    except (KeyError, ValueError):
+        return os.getuid(), os.getgid()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--root-dir', default='/var/lib/lxd',
+                        help='LXD directory')
+    args = parser.parse_args()
+
+    uid, gid = _caller()
+    helper = PrivHelper(args.root_dir, uid, gid)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        try:
+            reply = helper.handle(json.loads(line))
+        except ValueError as ex:
+            reply = {'error': 'Invalid request: %s' % ex}
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,15 +14,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import select
+import socket
+import threading
+import time
+
+import eventlet
 from nova.compute import power_state
 from nova import exception
 from nova import i18n
 from oslo_config import cfg
 from oslo_log import log as logging
+from six.moves import http_client
 
 from pylxd import api
 from pylxd import exceptions as lxd_exceptions
 
+from nclxd.nova.virt.lxd import container_events
+from nclxd.nova.virt.lxd import container_transfer
 from nclxd.nova.virt.lxd import container_utils
 
 _ = i18n._
@@ -44,23 +55,242 @@ LXD_POWER_STATES = {
     'UNKNOWN': power_state.NOSTATE
 }
 
-class LXDContainerClient(object):
+
+class LXDKeepAlive(object):
+    """Persistent HTTP connection for a pooled pylxd client.
+
+    pylxd asks its connection object for a new HTTP connection on every
+    request, so every request would pay for a new unix or TLS socket.
+    This replaces the get_connection of a pooled client and hands out
+    the same keep-alive connection every time instead. A connection the
+    daemon has closed, or that still has a response pending, is closed
+    and reopens on the next request.
+
+    :param connect: opens a new HTTP connection; streams that outlive a
+                    request, such as image exports, use it to get a
+                    connection of their own
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self._conn = None
+
+    def _is_reusable(self, conn):
+        # http_client refuses a new request while a response is unread.
+        if getattr(conn, '_HTTPConnection__state',
+                   http_client._CS_IDLE) != http_client._CS_IDLE:
+            return False
+        if conn.sock is None:
+            return True
+        try:
+            # An idle socket only becomes readable when the peer closed it.
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def __call__(self):
+        if self._conn is None:
+            self._conn = self.connect()
+        elif not self._is_reusable(self._conn):
+            self._conn.close()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class LXDConnectionPool(object):
+    """Pool of LXD API connections keyed by host.
+
+    The local unix socket is kept under the ``None`` key and every remote
+    host gets its own entry. Each pooled client keeps its socket open
+    between requests, see LXDKeepAlive. Connections are handed out most
+    recently used first and closed once they exceed the idle timeout.
+    """
 
     def __init__(self):
-        self.container_dir = container_utils.LXDContainerDirectories()
+        self._idle = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
 
-    def client(self, func, *args, **kwargs):
-        if kwargs['host'] is None:
-            lxd_client = api.API()
+    def _connect(self, host):
+        try:
+            lxd_client = api.API() if host is None else api.API(host=host)
+        except lxd_exceptions.APIError as ex:
+            msg = ('Unable to connect to %s %s') % (host, ex)
+            raise exception.NovaException(msg)
+        lxd_client.connection.get_connection = LXDKeepAlive(
+            lxd_client.connection.get_connection)
+        return lxd_client
+
+    def _close(self, lxd_client):
+        lxd_client.connection.get_connection.close()
+
+    def _evict(self, now):
+        for host in list(self._idle):
+            idle = self._idle[host]
+            while idle and now - idle[0][1] > CONF.lxd.pool_idle_timeout:
+                self._close(idle.popleft()[0])
+            if not idle:
+                del self._idle[host]
+
+    def get(self, host=None):
+        with self._lock:
+            self._evict(time.time())
+            if self._idle.get(host):
+                return self._idle[host].pop()[0]
+        return self._connect(host)
+
+    def put(self, host, lxd_client):
+        with self._lock:
+            idle = self._idle[host]
+            if len(idle) < CONF.lxd.pool_size:
+                idle.append((lxd_client, time.time()))
+                return
+        self._close(lxd_client)
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for lxd_client, last_used in idle:
+                    self._close(lxd_client)
+            self._idle.clear()
+
+    @contextlib.contextmanager
+    def connection(self, host=None):
+        """Borrow a connection and return it to the pool afterwards.
+
+        Connections are only returned when the call succeeded or failed
+        with an API level error; anything else, including a greenthread
+        killed mid-request, may have left the underlying socket in an
+        unknown state.
+        """
+        lxd_client = self.get(host)
+        try:
+            yield lxd_client
+        except exception.NovaException:
+            self.put(host, lxd_client)
+            raise
+        except BaseException:
+            self._close(lxd_client)
+            raise
         else:
+            self.put(host, lxd_client)
+
+
+POOL = LXDConnectionPool()
+
+
+class LXDContainerStateCache(object):
+    """Power state of every container on a host, fetched in one request.
+
+    The snapshot is kept for ``state_cache_ttl`` seconds and dropped as
+    soon as an operation on the host completes, so periodic tasks asking
+    for the state of every instance only cost one round-trip.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._generation = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def invalidate(self, host=None, metadata=None):
+        self._generation[host] += 1
+        self._states.pop(host, None)
+
+    def _fetch(self, host):
+        with POOL.connection(host) as lxd_client:
             try:
-                lxd_client = api.API(host=kwargs['host'])
+                (state, data) = lxd_client.connection.get_object(
+                    'GET', '/1.0/containers?recursion=1')
             except lxd_exceptions.APIError as ex:
-                msg = ('Unable to connect to %s %s') % (kwargs['host'],
-                                                        ex)
+                msg = _('Unable to list instances: %s') % ex
                 raise exception.NovaException(msg)
+
+        states = {}
+        for container in data['metadata']:
+            status = container.get('status')
+            if isinstance(status, dict):
+                status = status.get('status')
+            states[container['name']] = LXD_POWER_STATES.get(
+                status, LXD_POWER_STATES.get(str(status).upper(),
+                                             power_state.NOSTATE))
+        return states
+
+    def get(self, host=None):
+        """Return a mapping of container name to power state."""
+        # Serialise refreshes so that concurrent callers share one fetch.
+        with self._lock:
+            entry = self._states.get(host)
+            if (entry is not None and
+                    time.time() - entry[1] < CONF.lxd.state_cache_ttl):
+                return entry[0]
+
+            generation = self._generation[host]
+            states = self._fetch(host)
+            if generation == self._generation[host]:
+                self._states[host] = (states, time.time())
+            return states
+
+
+STATES = LXDContainerStateCache()
+
+
+class LXDContainerClient(object):
+
+    # Calls that change the state of a container.
+    MUTATING = ('start', 'stop', 'pause', 'unpause', 'destroy', 'init',
+                'reboot', 'wait')
+
+    def __init__(self):
+        self.container_dir = container_utils.LXDContainerDirectories()
+
+    def client(self, func, *args, **kwargs):
+        host = kwargs['host']
+        mutating = func in self.MUTATING
+        if mutating:
+            STATES.invalidate(host)
         func = getattr(self, "container_%s" % func)
-        return func(lxd_client, *args, **kwargs)
+        # Subscribe to the host's events early so that operations started
+        # by this call can be waited on through the stream.
+        listener = container_events.get_listener(host)
+        if listener is not None:
+            listener.add_callback(STATES.invalidate)
+        try:
+            with POOL.connection(host) as lxd_client:
+                return func(lxd_client, *args, **kwargs)
+        finally:
+            # A fetch made while the call ran may have cached the state
+            # from before it.
+            if mutating:
+                STATES.invalidate(host)
+
+    def client_async(self, func, *args, **kwargs):
+        """Start an operation in its own greenthread.
+
+        :returns: the greenthread; wait() on it returns the result of the
+                  operation or raises its error
+        """
+        return eventlet.spawn(self.client, func, *args, **kwargs)
+
+    def client_many(self, func, instances, host=None, concurrency=None,
+                    **kwargs):
+        """Run the same operation against many containers concurrently.
+
+        Each call borrows its own connection from the pool, so up to
+        ``concurrency`` (``bulk_concurrency`` by default) requests are in
+        flight against the daemon at once.
+
+        :returns: dict of container name to (result, exception)
+        """
+        def call(instance):
+            return self.client(func, instance=instance, host=host, **kwargs)
+
+        results = container_utils.run_many(
+            call, instances, concurrency or CONF.lxd.bulk_concurrency)
+        return dict((instance, (result, error))
+                    for instance, result, error in results)
 
     def container_list(self, lxd, *args, **kwargs):
         try:
@@ -133,6 +363,18 @@ class LXDContainerClient(object):
                 msg = _('Failed to destroy container: %s') % ex
                 raise exception.NovaException(msg)
 
+    def container_snapshot_delete(self, lxd, *args, **kwargs):
+        LOG.debug('Container snapshot delete')
+        try:
+            return lxd.container_snapshot_delete(kwargs['instance'],
+                                                 kwargs['snapshot'])
+        except lxd_exceptions.APIError as ex:
+            if ex.status_code == 404:
+                return
+            else:
+                msg = _('Failed to delete container snapshot: %s') % ex
+                raise exception.NovaException(msg)
+
     def container_state(self, lxd, *args, **kwargs):
         LOG.debug('container state')
         try:
@@ -202,14 +444,54 @@ class LXDContainerClient(object):
             msg = _('Failed to migrate container: %s') % ex
             raise exception.NovaException(msg)
 
+    def container_cancel(self, lxd, *args, **kwargs):
+        try:
+            return lxd.operation_delete(kwargs['oid'])
+        except lxd_exceptions.APIError as ex:
+            if ex.status_code == 404:
+                return
+            else:
+                msg = _('Failed to cancel operation: %s') % ex
+                raise exception.NovaException(msg)
+
+    def _check_operation(self, metadata):
+        if metadata.get('status_code') != 200:
+            msg = (_('Container operation failed: %s') %
+                   metadata.get('err'))
+            raise exception.NovaException(msg)
+
     def container_wait(self, lxd, *args, **kwargs):
-        if not kwargs['oid']:
+        oid = kwargs['oid']
+        if not oid:
             msg = _('Unable to determine container operation')
             raise exception.NovaException(msg)
+        timeout = kwargs.get('timeout') or CONF.lxd.operation_timeout
+
+        listener = container_events.get_listener(kwargs['host'])
+        if listener is not None and listener.connected:
+            try:
+                metadata = listener.wait(oid, timeout)
+            except container_events.LXDEventStreamLost:
+                LOG.debug('Events stream lost, polling operation %s', oid)
+            else:
+                if metadata is None:
+                    raise container_utils.LXDOperationTimeout(item=oid)
+                return self._check_operation(metadata)
 
-        if not lxd.wait_container_operation(kwargs['oid'], 200, -1):
-            msg = _('Container creation timed out')
+        # There is no events stream, or it was lost while waiting; ask
+        # the daemon directly. LXD answers when the operation is done or
+        # the timeout expired, whichever comes first.
+        try:
+            (state, data) = lxd.connection.get_object(
+                'GET', '/1.0/operations/%s/wait?timeout=%s' % (oid, timeout))
+        except lxd_exceptions.APIError as ex:
+            msg = _('Failed to wait for operation %(oid)s: %(ex)s') % {
+                'oid': oid, 'ex': ex}
             raise exception.NovaException(msg)
+        metadata = data['metadata']
+        if metadata.get('status_code', 0) < 200:
+            raise container_utils.LXDOperationTimeout(item=oid)
+        self._check_operation(metadata)
 
     # container images
     def container_image_defined(self, lxd, *args, **kwargs):
@@ -221,3 +503,42 @@ class LXDContainerClient(object):
             else:
                 msg = _('Failed to determine image: %s') % ex
                 raise exception.NovaException(msg)
+
+    def container_alias_defined(self, lxd, *args, **kwargs):
+        try:
+            return lxd.alias_defined(kwargs['instance'])
+        except lxd_exceptions.APIError as ex:
+            if ex.status_code == 404:
+                return False
+            else:
+                msg = _('Failed to determine image alias: %s') % ex
+                raise exception.NovaException(msg)
+
+    def container_publish(self, lxd, *args, **kwargs):
+        try:
+            return lxd.container_publish(kwargs['container_image'])
+        except lxd_exceptions.APIError as ex:
+            msg = _('Failed to publish container: %s') % ex
+            raise exception.NovaException(msg)
+
+    def container_image_export(self, lxd, *args, **kwargs):
+        return container_transfer.ImageExportReader(lxd.connection,
+                                                    kwargs['fingerprint'])
+
+    def container_image_upload(self, lxd, *args, **kwargs):
+        try:
+            return lxd.image_upload(data=kwargs['data'],
+                                    headers=kwargs['headers'])
+        except lxd_exceptions.APIError as ex:
+            msg = _('Failed to upload image: %s') % ex
+            raise exception.NovaException(msg)
+
+    def container_image_delete(self, lxd, *args, **kwargs):
+        try:
+            return lxd.image_delete(kwargs['fingerprint'])
+        except lxd_exceptions.APIError as ex:
+            if ex.status_code == 404:
+                return
+            else:
+                msg = _('Failed to delete image: %s') % ex
+                raise exception.NovaException(msg)
@@ -17,6 +17,7 @@
 import collections
 import pprint
 
+import eventlet
 from nova.api.metadata import base as instance_metadata
 from nova import exception
 from nova import i18n
@@ -32,6 +33,7 @@ import six
 
 from nclxd.nova.virt.lxd import container_client
 from nclxd.nova.virt.lxd import container_image
+from nclxd.nova.virt.lxd import container_usage
 from nclxd.nova.virt.lxd import container_utils
 
 _ = i18n._
@@ -57,10 +59,13 @@ class LXDContainerConfig(object):
         return config
 
     def create_container(self, context, instance, image_meta, injected_files,
-                        admin_password, network_info, block_device_info,
-                        name_label=None, rescue=False, host=None):
+                         admin_password, network_info, block_device_info,
+                         name_label=None, rescue=False, host=None,
+                         timings=None):
 
         LOG.debug('Creating instance')
+        if timings is None:
+            timings = {}
 
         name = instance.uuid
         if rescue:
@@ -90,52 +95,45 @@ class LXDContainerConfig(object):
         container_config = self.configure_container_config(name,
             container_config, instance)
 
-        ''' Create an LXD image '''
-        self.img_driver.setup_image(context, instance, image_meta, host=host)
+        ''' Create an LXD image and the config drive side by side '''
+        stages = [eventlet.spawn(container_utils.timed_call, timings,
+                                 'image', self.img_driver.setup_image,
+                                 context, instance, image_meta, host=host)]
+        configdrive_required = configdrive.required_by(instance)
+        if configdrive_required:
+            stages.append(eventlet.spawn(container_utils.timed_call, timings,
+                                         'configdrive', self.make_configdrive,
+                                         instance, injected_files,
+                                         admin_password))
+        container_utils.wait_all(stages)
+
         container_config = (
             self.add_config(container_config, 'source',
                             self.configure_lxd_image(container_config,
                                                      instance, image_meta)))
 
+        # Add every device before the container is created so that it
+        # is set up with a single request rather than an init followed by
+        # one full config update per device type.
+        if configdrive_required:
+            container_config = self.configure_disk_path(container_config,
+                                                        'configdrive',
+                                                        instance)
+
+        if network_info:
+            container_config = self.configure_network_devices(
+                container_config, instance, network_info)
+
+        if rescue:
+            container_config = self.configure_container_rescuedisk(
+                container_config, instance)
+
         LOG.debug(pprint.pprint(container_config))
         (state, data) = self.container_client.client('init', container_config=container_config,
                                                      host=host)
         self.container_client.client('wait', oid=data.get('operation').split('/')[3],
                                      host=host)
 
-        if configdrive.required_by(instance):
-            container_configdrive = (
-                self.configure_container_configdrive(
-                    container_config,
-                    instance,
-                    injected_files,
-                    admin_password))
-            LOG.debug(pprint.pprint(container_configdrive))
-            self.container_client.client('update', instnace=name,
-                                         container_config=container_configdrive,
-                                         host=host)
-
-        if network_info:
-            container_network_devices = (
-                self.configure_network_devices(
-                    container_config,
-                    instance,
-                    network_info))
-            LOG.debug(pprint.pprint(container_network_devices))
-            self.container_client.client('update', instance=name,
-                                         container_config=container_network_devices,
-                                         host=host)
-
-        if rescue:
-            container_rescue_devices = (
-                self.configure_container_rescuedisk(
-                    container_config,
-                    instance))
-            LOG.debug(pprint.pprint(container_rescue_devices))
-            self.container_client.client('update', instnace=name,
-                                         container_config=container_rescue_devices,
-                                         host=host)
-
         return container_config
 
     def configure_container_migrate(self, instance, network_info, host=None):
@@ -157,32 +155,95 @@ class LXDContainerConfig(object):
 
         return container_config
 
+    def configure_container_live_migrate(self, instance, network_info,
+                                         host=None):
+        """Return the config that pulls a container into another host.
+
+        Unlike configure_container_migrate this leaves the source
+        container untouched, so it keeps running until the destination
+        has restored it.
+        """
+        LOG.debug('Creating LXD live migration config')
+
+        container_config = self._init_container_config()
+        container_config = self.configure_container_config(
+            instance.uuid, container_config, instance)
+        if network_info:
+            container_config = self.configure_network_devices(
+                container_config, instance, network_info)
+        return self.configure_lxd_ws(container_config, instance, host)
+
+    def configure_container_from_image(self, instance, network_info,
+                                       fingerprint):
+        """Return the config that recreates a container from an image."""
+        container_config = self._init_container_config()
+        container_config = self.configure_container_config(
+            instance.uuid, container_config, instance)
+        if network_info:
+            container_config = self.configure_network_devices(
+                container_config, instance, network_info)
+        return self.add_config(container_config, 'source',
+                               {'type': 'image',
+                                'fingerprint': fingerprint})
+
     def configure_container_config(self, name, container_config, instance):
         LOG.debug('Configure LXD container')
 
-        ''' Set the limits. '''
-        flavor = instance.flavor
-        mem = flavor.memory_mb * units.Mi
-        vcpus = flavor.vcpus
-
         container_config = self.add_config(container_config, 'name',
                                            name)
         container_config = self.add_config(container_config, 'profiles',
                                            [str(CONF.lxd.default_profile)])
 
+        ''' Set the limits. '''
+        container_config = self.configure_container_limits(container_config,
+                                                           instance)
+
+        ''' Basic container configuration. '''
+        self.add_config(container_config, 'config', 'raw.lxc',
+                        data='lxc.console.logfile=%s\n'
+                        % self.container_dir.get_console_path(instance.uuid))
+        return container_config
+
+    def configure_container_limits(self, container_config, instance):
+        flavor = instance.flavor
+        mem = flavor.memory_mb * units.Mi
+        vcpus = flavor.vcpus
+
         if mem >= 0:
             self.add_config(container_config, 'config', 'limits.memory',
                             data='%s' % mem)
         if vcpus >= 1:
             self.add_config(container_config, 'config', 'limits.cpus',
                             data='%s' % vcpus)
-
-        ''' Basic container configuration. '''
-        self.add_config(container_config, 'config', 'raw.lxc',
-                        data='lxc.console.logfile=%s\n'
-                        % self.container_dir.get_console_path(instance.uuid))
         return container_config
 
+    def update_container_limits(self, instance, host=None):
+        """Apply the limits of the instance's flavor to its container.
+
+        LXD applies limits to a running container straight away, so this
+        is a single config update without restarting the container.
+        """
+        LOG.debug('Updating container limits', instance=instance)
+        container_old = self.container_client.client(
+            'config', instance=instance.uuid, host=host)
+        container_config = self._init_container_config()
+        container_config['config'] = self._convert(container_old['config'])
+        container_config['devices'] = self._convert(
+            container_old['devices'])
+        # PUT replaces the whole container, keep its profiles.
+        container_config['profiles'] = self._convert(
+            container_old.get('profiles',
+                              [str(CONF.lxd.default_profile)]))
+        # add_config never overwrites a key, drop the old limits first.
+        for key in ('limits.memory', 'limits.cpus'):
+            container_config['config'].pop(key, None)
+        container_config = self.configure_container_limits(container_config,
+                                                           instance)
+        self.container_client.client('update', instance=instance.uuid,
+                                     container_config=container_config,
+                                     host=host)
+        container_usage.USAGE.invalidate()
+
     def configure_lxd_image(self, container_config, instance, image_meta):
         LOG.debug('Getting LXD image')
 
@@ -201,14 +262,17 @@ class LXDContainerConfig(object):
         container_url = "wss://%s:%s/1.0/operations/%s/websocket" % (CONF.my_ip,
                                                                     CONF.lxd.lxd_port,
                                                                     container_ws['operation'])
+        secrets = {"control": container_ws['control'],
+                   "fs": container_ws['fs']}
+        # LXD only hands out a criu secret for running containers; with
+        # it the destination restores the process state as well.
+        if container_ws.get('criu'):
+            secrets['criu'] = container_ws['criu']
         self.add_config(container_config, 'source',
                         {'base-image': '',
                          "mode": "pull",
                          "operation": container_url,
-                         "secrets": {
-                           "control": container_ws['control'],
-                           "fs": container_ws['fs']
-                         },
+                         "secrets": secrets,
                          "type": "migration"
                          })
         return container_config
@@ -254,6 +318,11 @@ class LXDContainerConfig(object):
 
     def configure_container_configdrive(self, container_config, instance,
                                         injected_files, admin_password):
+        self.make_configdrive(instance, injected_files, admin_password)
+        return self.configure_disk_path(container_config, 'configdrive',
+                                        instance)
+
+    def make_configdrive(self, instance, injected_files, admin_password):
         LOG.debug('Create config drive')
         if CONF.config_drive_format not in ('fs', None):
             msg = (_('Invalid config drive format: %s')
@@ -273,16 +342,11 @@ class LXDContainerConfig(object):
                     self.container_dir.get_container_configdrive(name)
                 )
                 cdb.make_drive(container_configdrive)
-                container_config = self.configure_disk_path(container_config,
-                                                            'configdrive',
-                                                            instance)
         except Exception as e:
             with excutils.save_and_reraise_exception():
                 LOG.error(_LE('Creating config drive failed with error: %s'),
                           e, instance=instance)
 
-        return container_config
-
     def configure_container_net_device(self, instance, vif):
         LOG.debug('Configure container device')
         container_config = self._get_container_config(instance, vif)
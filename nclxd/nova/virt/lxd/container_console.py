@@ -0,0 +1,137 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import threading
+
+from oslo_log import log as logging
+
+from nclxd.nova.virt.lxd import privhelper
+
+LOG = logging.getLogger(__name__)
+
+
+class LXDConsoleLog(object):
+    """In-memory tail of one container's console log.
+
+    The last ``max_bytes`` of the log are kept together with the file
+    offset and inode they were read from. Every poll only reads what was
+    appended since the previous one; a new inode or a shrinking file
+    means the log was rotated or truncated and the tail is read again.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.inode = None
+        self.start = 0
+        self.data = b''
+        self._lock = threading.Lock()
+
+    @property
+    def end(self):
+        """File offset just past the buffered data."""
+        return self.start + len(self.data)
+
+    def _make_readable(self):
+        privhelper.chown(self.path, os.getuid(), os.getgid())
+        privhelper.chmod(os.path.dirname(self.path), 0o755)
+
+    def _read_direct(self, offset):
+        try:
+            fp = open(self.path, 'rb')
+        except IOError as ex:
+            if ex.errno != errno.EACCES:
+                raise
+            self._make_readable()
+            fp = open(self.path, 'rb')
+
+        with fp:
+            stat = os.fstat(fp.fileno())
+            start = max(0, stat.st_size - self.max_bytes)
+            if offset is not None and start < offset <= stat.st_size:
+                start = offset
+            fp.seek(start)
+            data = fp.read(stat.st_size - start)
+        return {'data': data,
+                'offset': start,
+                'size': stat.st_size,
+                'inode': stat.st_ino}
+
+    def _read(self, offset):
+        try:
+            return privhelper.read_console(self.path, self.max_bytes,
+                                           offset)
+        except privhelper.LXDPrivHelperUnavailable:
+            return self._read_direct(offset)
+
+    def update(self):
+        """Pull whatever was appended to the log since the last update."""
+        with self._lock:
+            offset = self.end if self.inode is not None else None
+            reply = self._read(offset)
+            if offset is not None and (reply['inode'] != self.inode or
+                                       reply['size'] < offset):
+                LOG.debug('Console log %s was rotated', self.path)
+                reply = self._read(None)
+
+            if reply['inode'] == self.inode and reply['offset'] == self.end:
+                self.data += reply['data']
+            else:
+                self.data = reply['data']
+                self.start = reply['offset']
+            self.inode = reply['inode']
+
+            if len(self.data) > self.max_bytes:
+                trim = len(self.data) - self.max_bytes
+                self.data = self.data[trim:]
+                self.start += trim
+
+    def read(self, since=None):
+        """Return console data and the offset to continue from.
+
+        :param since: offset returned by a previous read; only data
+                      written after it is returned. If it is unknown or
+                      no longer buffered the whole tail is returned.
+        :returns: tuple of (data, offset)
+        """
+        self.update()
+        with self._lock:
+            if since is None or not self.start <= since <= self.end:
+                return self.data, self.end
+            return self.data[since - self.start:], self.end
+
+
+class LXDConsoleLogs(object):
+    """Console log tails of the containers on this host by name."""
+
+    def __init__(self):
+        self._logs = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, path, max_bytes):
+        with self._lock:
+            log = self._logs.get(name)
+            if log is None or log.path != path:
+                log = self._logs[name] = LXDConsoleLog(path, max_bytes)
+            return log
+
+    def forget(self, name):
+        with self._lock:
+            self._logs.pop(name, None)
+
+
+CONSOLES = LXDConsoleLogs()
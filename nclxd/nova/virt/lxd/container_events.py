@@ -0,0 +1,208 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import socket
+import threading
+import time
+
+import eventlet
+from eventlet import event
+from nova import i18n
+from nova import utils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+_ = i18n._
+_LE = i18n._LE
+_LW = i18n._LW
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+# How long a completed operation is remembered for waiters that register
+# after its completion event has already been received.
+FINISHED_TTL = 60
+
+
+class LXDEventStreamLost(Exception):
+    """The events stream went away while waiting for an operation."""
+
+
+class LXDEventListener(object):
+    """Subscriber for the operation events of a single LXD host.
+
+    A single greenthread keeps a websocket open on ``/1.0/events`` and
+    dispatches operation completion events to the greenthreads waiting on
+    them, so in-flight operations share one connection instead of each
+    holding a blocking wait request against the daemon.
+    """
+
+    def __init__(self, host=None):
+        self.host = host
+        self.connected = False
+        self._waiters = {}
+        self._finished = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._started = False
+
+    def add_callback(self, callback):
+        """Call ``callback(host, metadata)`` for every finished operation."""
+        with self._lock:
+            if callback not in self._callbacks:
+                self._callbacks.append(callback)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        utils.spawn_n(self._run)
+
+    def _connect(self):
+        if self.host is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(os.path.join(CONF.lxd.root_dir, 'unix.socket'))
+            return websocket.create_connection(
+                'ws://localhost/1.0/events?type=operation', socket=sock)
+
+        config_dir = os.path.join(os.path.expanduser('~'), '.config', 'lxc')
+        sslopt = {'certfile': os.path.join(config_dir, 'client.crt'),
+                  'keyfile': os.path.join(config_dir, 'client.key'),
+                  'cert_reqs': 0}
+        return websocket.create_connection(
+            'wss://%s:%s/1.0/events?type=operation' % (self.host,
+                                                       CONF.lxd.lxd_port),
+            sslopt=sslopt)
+
+    def _run(self):
+        while True:
+            try:
+                ws = self._connect()
+            except Exception as ex:
+                LOG.warning(_LW('Unable to subscribe to LXD events on '
+                                '%(host)s: %(ex)s'),
+                            {'host': self.host or 'local', 'ex': ex})
+                eventlet.sleep(CONF.lxd.events_retry_interval)
+                continue
+
+            LOG.debug('Subscribed to LXD events on %s', self.host or 'local')
+            self.connected = True
+            try:
+                while True:
+                    self._dispatch(jsonutils.loads(ws.recv()))
+            except Exception as ex:
+                LOG.warning(_LW('Lost LXD events stream on %(host)s: '
+                                '%(ex)s'),
+                            {'host': self.host or 'local', 'ex': ex})
+            finally:
+                self.connected = False
+                self._release_waiters()
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+
+    def _dispatch(self, data):
+        if data.get('type') != 'operation':
+            return
+        metadata = data.get('metadata') or {}
+        oid = metadata.get('id')
+        # 1xx status codes are pending or running operations.
+        if not oid or metadata.get('status_code', 0) < 200:
+            return
+
+        now = time.time()
+        with self._lock:
+            for finished_oid, (_unused, stamp) in list(
+                    self._finished.items()):
+                if now - stamp > FINISHED_TTL:
+                    del self._finished[finished_oid]
+            self._finished[oid] = (metadata, now)
+            waiter = self._waiters.pop(oid, None)
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            try:
+                callback(self.host, metadata)
+            except Exception:
+                LOG.exception(_LE('Failed to handle LXD event'))
+        if waiter is not None:
+            waiter.send(metadata)
+
+    def _release_waiters(self):
+        with self._lock:
+            waiters = list(self._waiters.values())
+            self._waiters.clear()
+        for waiter in waiters:
+            waiter.send(None)
+
+    def wait(self, oid, timeout):
+        """Wait for an operation to finish.
+
+        :param oid: operation id
+        :param timeout: seconds to wait for the completion event
+        :returns: the operation metadata or None if the timeout expired
+        :raises LXDEventStreamLost: if the stream disconnected while
+                                    waiting
+        """
+        with self._lock:
+            if oid in self._finished:
+                return self._finished.pop(oid)[0]
+            waiter = self._waiters.setdefault(oid, event.Event())
+
+        metadata = False
+        try:
+            with eventlet.Timeout(timeout, False):
+                metadata = waiter.wait()
+        finally:
+            with self._lock:
+                if self._waiters.get(oid) is waiter:
+                    del self._waiters[oid]
+                self._finished.pop(oid, None)
+
+        if metadata is False:
+            return None
+        if metadata is None:
+            raise LXDEventStreamLost()
+        return metadata
+
+
+_LISTENERS = {}
+_LISTENERS_LOCK = threading.Lock()
+
+
+def get_listener(host=None):
+    """Return the running events listener for a host.
+
+    Returns None when no websocket client library is available, in which
+    case callers have to poll the operation instead.
+    """
+    if websocket is None:
+        return None
+
+    with _LISTENERS_LOCK:
+        listener = _LISTENERS.get(host)
+        if listener is None:
+            listener = _LISTENERS[host] = LXDEventListener(host)
+    listener.start()
+    return listener
@@ -22,16 +22,21 @@ import uuid
 from nova import exception
 from nova import i18n
 from nova import image
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import fileutils
+from oslo_utils import units
 from pylxd import api
 from pylxd import exceptions as lxd_exceptions
 
+from nclxd.nova.virt.lxd import constants
 from nclxd.nova.virt.lxd import container_utils
 from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import imagecache
 
 _ = i18n._
+_LW = i18n._LW
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
@@ -47,9 +52,12 @@ def update_image(context, instance):
             'lxd_image_alias': instance.image_ref
         }
     }
+    # Keep the other properties, lxd_parent of incremental snapshots in
+    # particular.
     IMAGE_API.update(context,
                      instance.image_ref,
-                     image_meta)
+                     image_meta,
+                     purge_props=False)
 
 def setup_alias(instance, data):
     lxd = api.API()
@@ -66,6 +74,70 @@ def setup_alias(instance, data):
             image_id=instance.image_ref,
             reason=_('Image already exists: %s' % ex))
 
+
+class MultipartReader(object):
+    """multipart/form-data request body streamed from open files.
+
+    The body is produced on demand while the request is being sent, so
+    uploading an image only ever holds one chunk of it in memory.
+
+    :param boundary: multipart boundary
+    :param parts: list of (name, filename, fileobj, size) tuples
+    """
+
+    CHUNK_SIZE = 64 * units.Ki
+
+    def __init__(self, boundary, parts):
+        self._segments = []
+        for name, filename, fileobj, size in parts:
+            header = ('--%s\r\n'
+                      'Content-Disposition: form-data; '
+                      'name=%s; filename=%s\r\n'
+                      'Content-Type: application/octet-stream\r\n'
+                      '\r\n' % (boundary, name, filename))
+            self._segments.append(header.encode())
+            self._segments.append([fileobj, size])
+            self._segments.append(b'\r\n')
+        self._segments.append(('--%s--\r\n\r\n' % boundary).encode())
+        self._length = sum(len(segment) if isinstance(segment, bytes)
+                           else segment[1] for segment in self._segments)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while self._segments and size != 0:
+            segment = self._segments[0]
+            if isinstance(segment, bytes):
+                if size < 0 or len(segment) <= size:
+                    chunk = self._segments.pop(0)
+                else:
+                    chunk = segment[:size]
+                    self._segments[0] = segment[size:]
+            else:
+                fileobj, remaining = segment
+                wanted = remaining if size < 0 else min(size, remaining)
+                chunk = fileobj.read(wanted)
+                if not chunk:
+                    if remaining:
+                        raise IOError(_('Unexpected end of image data'))
+                    self._segments.pop(0)
+                    continue
+                segment[1] -= len(chunk)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
 def images_upload(path, filename):
     lxd = api.API()
     headers = {}
@@ -73,51 +145,101 @@ def images_upload(path, filename):
     if isinstance(path, str):
         headers['Content-Type'] = "application/octet-stream"
         try:
-            status, data = lxd.image_upload(data=open(path, 'rb'), 
+            status, data = lxd.image_upload(data=open(path, 'rb'),
                                             headers=headers)
-        except lxd_exceptions as ex:
+        except lxd_exceptions.APIError as ex:
             raise exception.ImageUnacceptable(
-                image_id=instance.image_ref,
+                image_id=filename,
                 reason=_('Failed to upload image: %s' % ex))
     else:
         meta_path, rootfs_path = path
-        boundary = str(uuid.uuid1())
-
-        form = []
-        for name, path in [("metadata", meta_path),
-                           ("rootfs", rootfs_path)]:
-            filename = os.path.basename(path)
-            form.append("--%s" % boundary)
-            form.append("Content-Disposition: form-data; "
-                        "name=%s; filename=%s" % (name, filename))
-            form.append("Content-Type: application/octet-stream")
-            form.append("")
-            with open(path, "rb") as fd:
-                form.append(fd.read())
-
-        form.append("--%s--" % boundary)
-        form.append("")
-
-        body = b""
-        for entry in form:
-            if isinstance(entry, bytes):
-                body += entry + b"\r\n"
-            else:
-                body += entry.encode() + b"\r\n"
-
-        headers['Content-Type'] = "multipart/form-data; boundary=%s" \
-                % boundary
 
+        files = []
         try:
-            status, data = lxd.image_upload(data=body,
-                                            headers=headers)
-        except lxd_exceptions as ex:
-            raise exception.ImageUnacceptable(
-                image_id=instance.image_ref,
-                reason=_('Failed to upload image: %s' % ex))
+            parts = []
+            for name, path in [("metadata", meta_path),
+                               ("rootfs", rootfs_path)]:
+                fd = open(path, "rb")
+                files.append(fd)
+                parts.append((name, os.path.basename(path), fd,
+                              os.path.getsize(path)))
+            data = images_upload_parts(parts, filename)
+        finally:
+            for fd in files:
+                fd.close()
 
     return data
 
+
+def images_upload_parts(parts, filename):
+    """Upload a split LXD image from already opened file objects.
+
+    :param parts: list of (name, filename, fileobj, size) tuples for the
+                  metadata and rootfs tarballs
+    """
+    lxd = api.API()
+    boundary = str(uuid.uuid1())
+    body = MultipartReader(boundary, parts)
+
+    headers = {}
+    headers['Content-Type'] = "multipart/form-data; boundary=%s" \
+        % boundary
+    headers['Content-Length'] = str(len(body))
+
+    try:
+        status, data = lxd.image_upload(data=body,
+                                        headers=headers)
+    except lxd_exceptions.APIError as ex:
+        raise exception.ImageUnacceptable(
+            image_id=filename,
+            reason=_('Failed to upload image: %s' % ex))
+    return data
+
+
+def merge_image_chain(layers, target):
+    """Merge a chain of incremental snapshots into one LXD image.
+
+    Layers are applied from the full image at the start of the chain to
+    the newest delta. They are read newest first so that every path is
+    only written once: paths already written by a newer layer or removed
+    by it, as listed in its whiteouts member, are skipped.
+
+    :param layers: paths of the images, full image first
+    :param target: path of the gzip compressed image to write
+    """
+    written = set()
+    removed = set()
+
+    def is_removed(name):
+        while name:
+            if name in removed:
+                return True
+            name = os.path.dirname(name)
+        return False
+
+    with tarfile.open(target, 'w:gz') as out:
+        for layer in reversed(layers):
+            whiteouts = []
+            with tarfile.open(layer, mode='r') as tar:
+                for tar_info in tar:
+                    name = os.path.normpath(tar_info.name).lstrip('/')
+                    if name == constants.WHITEOUTS:
+                        data = tar.extractfile(tar_info).read()
+                        if not isinstance(data, str):
+                            data = os.fsdecode(data)
+                        whiteouts = ['rootfs/' + path
+                                     for path in data.split('\0') if path]
+                        continue
+                    if name in written or is_removed(name):
+                        continue
+                    written.add(name)
+                    if tar_info.isreg():
+                        out.addfile(tar_info, tar.extractfile(tar_info))
+                    else:
+                        out.addfile(tar_info)
+            removed.update(whiteouts)
+
+
 class LXDBaseImage(object):
     def __init__(self):
         pass
@@ -137,26 +259,139 @@ class LXDContainerImage(LXDBaseImage):
         LOG.debug('Fetching image info from LXD')
 
         lxd_image = get_lxd_image(image_meta)
-        if lxd_image is not None:
-            return 
-
-        LOG.debug("Uploading file data %(image_ref)s to LXD",
-                  {'image_ref': instance.image_ref})
+        if lxd_image is not None and self.container_client.client(
+                'alias_defined', instance=lxd_image, host=host):
+            imagecache.INDEX.touch([instance.image_ref])
+            return
 
         base_dir = self.container_dir.get_base_dir()
         if not os.path.exists(base_dir):
             fileutils.ensure_tree(base_dir)
 
+        # Only one spawn per image downloads and uploads it, both within
+        # this process and across processes sharing the image cache. The
+        # others wait here and then find the alias already in place.
+        with lockutils.lock(instance.image_ref,
+                            lock_file_prefix='nclxd-image-',
+                            external=True, lock_path=base_dir):
+            if self.container_client.client('alias_defined',
+                                            instance=instance.image_ref,
+                                            host=host):
+                LOG.debug('Image %(image_ref)s was uploaded concurrently',
+                          {'image_ref': instance.image_ref})
+                imagecache.INDEX.touch([instance.image_ref])
+                return
+
+            self._fetch_image(context, instance, image_meta)
+
+    def _fetch_image(self, context, instance, image_meta):
+        LOG.debug("Uploading file data %(image_ref)s to LXD",
+                  {'image_ref': instance.image_ref})
+
+        if image_meta['properties'].get('lxd_parent'):
+            (data, files) = self._fetch_image_chain(context, instance,
+                                                    image_meta)
+            setup_alias(instance, data)
+            update_image(context, instance)
+            imagecache.INDEX.add(instance.image_ref,
+                                 data['metadata']['fingerprint'],
+                                 files)
+            return
+
         container_image = self.container_dir.get_container_image(image_meta)
         IMAGE_API.download(context, instance.image_ref, dest_path=container_image)
 
         ''' Upload LXD image(s) '''
-        (target_metadata, target_rootfs) = self._get_image_contents(container_image, 
-                                                                    image_meta)
-        data = images_upload((target_metadata, target_rootfs),
-                              target_metadata.split('/')[-1])
+        data = None
+        files = [container_image]
+        if CONF.lxd.stream_image_upload:
+            try:
+                data = self._stream_image_contents(container_image)
+            except (IOError, tarfile.TarError) as ex:
+                LOG.warning(_LW('Unable to stream image %(image)s, '
+                                'extracting it instead: %(ex)s'),
+                            {'image': instance.image_ref, 'ex': ex})
+
+        if data is None:
+            (target_metadata, target_rootfs) = self._get_image_contents(
+                container_image, image_meta)
+            data = images_upload((target_metadata, target_rootfs),
+                                 target_metadata.split('/')[-1])
+            files.extend([target_metadata, target_rootfs])
+
         setup_alias(instance, data)
         update_image(context, instance)
+        imagecache.INDEX.add(instance.image_ref,
+                             data['metadata']['fingerprint'],
+                             files)
+
+    def _fetch_image_chain(self, context, instance, image_meta):
+        """Download an incremental snapshot and the images it builds on.
+
+        :returns: the LXD upload response and the files kept in the
+                  image cache
+        """
+        chain = [image_meta]
+        while chain[-1]['properties'].get('lxd_parent'):
+            parent_id = chain[-1]['properties']['lxd_parent']
+            if parent_id in [meta['id'] for meta in chain]:
+                raise exception.ImageUnacceptable(
+                    image_id=instance.image_ref,
+                    reason=_('Image chain loops at %s') % parent_id)
+            chain.append(IMAGE_API.get(context, parent_id))
+        LOG.debug('Merging %(count)d images into %(image_ref)s',
+                  {'count': len(chain), 'image_ref': instance.image_ref})
+
+        layers = []
+        try:
+            for meta in reversed(chain):
+                layer = os.path.join(self.container_dir.get_base_dir(),
+                                     '%s-layer.tar' % meta['id'])
+                layers.append(layer)
+                IMAGE_API.download(context, meta['id'], dest_path=layer)
+            container_image = self.container_dir.get_container_image(
+                image_meta)
+            try:
+                merge_image_chain(layers, container_image)
+            except (IOError, tarfile.TarError) as ex:
+                raise exception.ImageUnacceptable(
+                    image_id=instance.image_ref,
+                    reason=_('Unable to merge image chain: %s') % ex)
+        finally:
+            for layer in layers:
+                fileutils.delete_if_exists(layer)
+
+        data = images_upload(container_image,
+                             os.path.basename(container_image))
+        return (data, [container_image])
+
+    def _stream_image_contents(self, container_image):
+        """Upload the LXD tarballs straight out of the Glance tarball.
+
+        This avoids writing the metadata and rootfs tarballs to disk only
+        to read them back for the upload.
+        """
+        LOG.debug('Streaming LXD files')
+
+        with tarfile.open(container_image, mode='r') as tar:
+            members = {}
+            # Stop at the second member instead of indexing the whole
+            # archive, which would decompress it one more time.
+            tar_info = tar.next()
+            while tar_info is not None and len(members) < 2:
+                if tar_info.name.endswith('-lxd.tar.xz'):
+                    members['metadata'] = tar_info
+                elif tar_info.name.endswith('-root.tar.xz'):
+                    members['rootfs'] = tar_info
+                tar_info = tar.next()
+
+            if len(members) < 2:
+                raise tarfile.TarError(_('Image is missing LXD tarballs'))
+
+            parts = [(name, os.path.basename(members[name].name),
+                      tar.extractfile(members[name]), members[name].size)
+                     for name in ('metadata', 'rootfs')]
+            return images_upload_parts(parts, parts[0][1])
 
     def _get_image_contents(self, container_image, image_meta):
         LOG.debug('Extracting LXD files')
@@ -14,20 +14,31 @@
 #    under the License.
 
 import pprint
+import time
 
+import eventlet
 from nova import exception
 from nova import i18n
 
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import excutils
+from oslo_utils import units
 
 from nclxd.nova.virt.lxd import container_client
 from nclxd.nova.virt.lxd import container_config
 from nclxd.nova.virt.lxd import container_ops
+from nclxd.nova.virt.lxd import container_transfer
 
 _ = i18n._
+_LE = i18n._LE
+_LI = i18n._LI
+_LW = i18n._LW
 
 CONF = cfg.CONF
+CONF.import_opt('host', 'nova.netconf')
+CONF.import_opt('my_ip', 'nova.netconf')
 LOG = logging.getLogger(__name__)
 
 class LXDContainerMigrate(object):
@@ -42,6 +53,14 @@ class LXDContainerMigrate(object):
                                    block_device_info=None, timeout=0,
                                    retry_interval=0, host=None):
         LOG.debug("!! migrate_disk_and_power_off called", instance=instance)
+        if self._is_same_host(dest):
+            # The new limits are applied to the running container in
+            # finish_migration, nothing has to be copied.
+            LOG.debug('Resizing on the same host, keeping the container '
+                      'running', instance=instance)
+            return ""
+        if CONF.lxd.migration_transfer == 'image':
+            return self._migrate_image(instance, dest, network_info, host)
 
         container_config = (
                             self.container_config.configure_container_migrate(
@@ -59,51 +78,241 @@ class LXDContainerMigrate(object):
         # disk_info is not used
         return ""
 
+    def _migrate_image(self, instance, dest, network_info, host=None):
+        """Copy a stopped container to another host as an image.
+
+        The container is published on this host and its export is
+        streamed into the image store of the destination, where the
+        container is created from it. On the way the image can be
+        recompressed and its bandwidth limited.
+
+        :returns: disk_info with the transfer statistics
+        """
+        # Fail before the container is stopped rather than after it has
+        # been published.
+        container_transfer.check_compression(
+            CONF.lxd.migration_compression,
+            CONF.lxd.migration_compression_level)
+        result = self.container_client.client('stop', instance=instance.uuid,
+                                              host=host)
+        if result is not None:
+            (state, data) = result
+            self.container_client.client(
+                'wait', oid=data.get('operation').split('/')[3], host=host)
+
+        container_image = {'source': {'name': instance.uuid,
+                                      'type': 'container'}}
+        (state, data) = self.container_client.client(
+            'publish', container_image=container_image, host=host)
+        fingerprint = str(data['metadata']['fingerprint'])
+
+        try:
+            export = self.container_client.client(
+                'image_export', fingerprint=fingerprint, host=host)
+            try:
+                stream = container_transfer.open_stream(
+                    export, CONF.lxd.migration_compression,
+                    CONF.lxd.migration_compression_level,
+                    CONF.lxd.migration_bandwidth_mb * units.Mi)
+                (state, data) = self.container_client.client(
+                    'image_upload',
+                    data=container_transfer.ChunkedEncoder(stream),
+                    headers={'Content-Type': 'application/octet-stream',
+                             'Transfer-Encoding': 'chunked'},
+                    host=dest)
+            finally:
+                export.close()
+        finally:
+            self.container_client.client('image_delete',
+                                         fingerprint=fingerprint, host=host)
+
+        stats = {'bytes_exported': export.bytes_read,
+                 'bytes_sent': stream.bytes_read,
+                 'seconds': stream.elapsed,
+                 'rate': stream.bytes_read / max(stream.elapsed, 0.001)}
+        LOG.info(_LI('Sent %(bytes_sent)d bytes of a %(bytes_exported)d '
+                     'byte image in %(seconds).1f seconds, '
+                     '%(rate).0f bytes/s'), stats, instance=instance)
+
+        dest_fingerprint = str(data['metadata']['fingerprint'])
+        try:
+            container_config = (
+                self.container_config.configure_container_from_image(
+                    instance, network_info, dest_fingerprint))
+            (state, data) = self.container_client.client(
+                'init', container_config=container_config, host=dest)
+            self.container_client.client(
+                'wait', oid=data.get('operation').split('/')[3], host=dest)
+        finally:
+            self.container_client.client('image_delete',
+                                         fingerprint=dest_fingerprint,
+                                         host=dest)
+        return jsonutils.dumps({'transfer': stats})
+
+    def _is_same_host(self, dest):
+        return dest in (CONF.host, CONF.my_ip)
+
     def confirm_migration(self, migration, instance, network_info):
         LOG.debug("!! confirm_migration called", instance=instance)
 
     def finish_revert_migration(self, context, instance, network_info,
                                 block_device_info=None, power_on=True):
         LOG.debug("finish_revert_migration called", instance=instance)
+        # The instance carries its old flavor again at this point.
+        self.container_config.update_container_limits(instance)
+        if power_on and not self.container_client.client(
+                'running', instance=instance.uuid, host=None):
+            self.container_ops.start_instance(None, instance, network_info)
 
     def finish_migration(self, context, migration, instance, disk_info,
                          network_info, image_meta, resize_instance=False,
                          block_device_info=None, power_on=True):
         LOG.debug("!! finish_migration called", instance=instance)
+        if migration.source_compute == migration.dest_compute:
+            if resize_instance:
+                self.container_config.update_container_limits(instance)
+            return
         if power_on:
-            self.container_ops.start_instance(instance, network_info)
+            self.container_ops.start_instance(None, instance, network_info)
 
     def live_migration(self, context, instance_ref, dest, post_method,
                        recover_method, block_migration=False,
                        migrate_data=None):
-        LOG.debug("!! live_migration called", instance=instance_ref)
-        post_method(context, instance_ref, dest, block_migration)
+        LOG.debug("live_migration called", instance=instance_ref)
+        try:
+            self._live_migrate(instance_ref, dest)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.exception(_LE('Live migration to %s failed'), dest,
+                              instance=instance_ref)
+                recover_method(context, instance_ref, dest, block_migration,
+                               migrate_data)
+        post_method(context, instance_ref, dest, block_migration,
+                    migrate_data)
+
+    def _live_migrate(self, instance, dest):
+        """Let the destination pull the container while it keeps running.
+
+        For a running container LXD checkpoints the processes with CRIU
+        once the filesystem has been copied and restores them on the
+        destination, so the container only stops for the final dump.
+        """
+        network_info = []
+        if instance.info_cache is not None:
+            network_info = instance.info_cache.network_info
+        container_config = (
+            self.container_config.configure_container_live_migrate(
+                instance, network_info))
+        source = container_config['source']
+        source_oid = source['operation'].split('/')[-2]
+        if 'criu' not in source['secrets']:
+            LOG.warning(_LW('Container is not running, only its filesystem '
+                            'is migrated'), instance=instance)
+
+        start = time.time()
+        (state, data) = self.container_client.client(
+            'init', container_config=container_config, host=dest)
+        waiter = self.container_client.client_async(
+            'wait', oid=data.get('operation').split('/')[3], host=dest,
+            timeout=CONF.lxd.live_migration_timeout)
+
+        try:
+            while True:
+                with eventlet.Timeout(
+                        CONF.lxd.live_migration_progress_interval, False):
+                    waiter.wait()
+                    break
+                elapsed = time.time() - start
+                if elapsed >= CONF.lxd.live_migration_timeout:
+                    msg = (_('Live migration to %(dest)s did not finish '
+                             'within %(timeout)d seconds') %
+                           {'dest': dest,
+                            'timeout': CONF.lxd.live_migration_timeout})
+                    raise exception.MigrationError(reason=msg)
+                LOG.info(_LI('Live migration to %(dest)s running for '
+                             '%(elapsed)d seconds'),
+                         {'dest': dest, 'elapsed': elapsed},
+                         instance=instance)
+        except Exception:
+            # However the wait failed, LXD would otherwise keep migrating
+            # a container that nova is about to recover.
+            with excutils.save_and_reraise_exception():
+                waiter.kill()
+                self._cancel_operation(source_oid, instance)
+
+        LOG.info(_LI('Live migration to %(dest)s finished in '
+                     '%(elapsed).1f seconds'),
+                 {'dest': dest, 'elapsed': time.time() - start},
+                 instance=instance)
+
+    def _cancel_operation(self, oid, instance):
+        try:
+            self.container_client.client('cancel', oid=oid, host=None)
+        except exception.NovaException as ex:
+            LOG.warning(_LW('Unable to cancel operation %(oid)s: %(ex)s'),
+                        {'oid': oid, 'ex': ex}, instance=instance)
 
     def pre_live_migration(self, context, instance, block_device_info,
                            network_info):
-        LOG.debug("!! pre_live_migration called", instance=instance)
+        LOG.debug("pre_live_migration called", instance=instance)
+        self.container_ops.plug_vifs(None, instance, network_info)
+        return {}
+
+    def rollback_live_migration_at_destination(self, context, instance,
+                                               network_info,
+                                               block_device_info,
+                                               destroy_disks=True,
+                                               migrate_data=None):
+        LOG.debug("rollback_live_migration_at_destination called",
+                  instance=instance)
+        self.container_client.client('stop', instance=instance.uuid,
+                                     host=None)
+        self.container_client.client('destroy', instance=instance.uuid,
+                                     host=None)
+        self._unplug_vifs(instance, network_info)
 
     def post_live_migration(self, context, instance, block_device_info):
-        LOG.debug("post_live_migration", instance=instance)
-        pass
+        LOG.debug("post_live_migration called", instance=instance)
+        # The destination restored its own copy; drop the checkpointed
+        # source container.
+        self.container_client.client('stop', instance=instance.uuid,
+                                     host=None)
+        self.container_client.client('destroy', instance=instance.uuid,
+                                     host=None)
+
+    def post_live_migration_at_source(self, context, instance, network_info):
+        LOG.debug("post_live_migration_at_source called", instance=instance)
+        self._unplug_vifs(instance, network_info)
 
     def post_live_migration_at_destination(self, ctxt, instance_ref,
                                            network_info, block_migration):
-        LOG.debug("!! post_live_migration_at_destination called",
+        LOG.debug("post_live_migration_at_destination called",
                   instance=instance_ref)
 
+    def _unplug_vifs(self, instance, network_info):
+        self.container_ops.firewall_driver.unfilter_instance(instance,
+                                                             network_info)
+        for vif in network_info or []:
+            self.container_ops.vif_driver.unplug(instance, vif)
+
     def check_can_live_migrate_destination(self, ctxt, instance_ref,
                                            src_compute_info, dst_compute_info,
                                            block_migration=False,
                                            disk_over_commit=False):
-        LOG.debug("!! check_can_live_migrate_destination called", instance_ref)
-        return {}
+        LOG.debug("check_can_live_migrate_destination called",
+                  instance=instance_ref)
+        return {'block_migration': block_migration}
 
     def check_can_live_migrate_destination_cleanup(self, ctxt,
                                                    dest_check_data):
-        LOG.debug("!! check_can_live_migrate_destination_cleanup called")
+        LOG.debug("check_can_live_migrate_destination_cleanup called")
 
     def check_can_live_migrate_source(self, ctxt, instance_ref,
                                       dest_check_data):
-        LOG.debug("!! check_can_live_migrate_source called", instance_ref)
+        LOG.debug("check_can_live_migrate_source called",
+                  instance=instance_ref)
+        if not self.container_client.client('defined',
+                                            instance=instance_ref.uuid,
+                                            host=None):
+            raise exception.InstanceNotFound(instance_id=instance_ref.uuid)
         return dest_check_data
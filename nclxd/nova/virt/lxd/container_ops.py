@@ -16,13 +16,18 @@
 
 import os
 import pprint
-import pwd
 import shutil
+import time
 
+import eventlet
+from nova.compute import power_state
+from nova.compute import task_states
 from nova import exception
 from nova import i18n
+from nova import objects
 from nova import utils
 from nova.virt import configdrive
+from nova.virt import diagnostics
 from nova.virt import driver
 from nova.virt import hardware
 from oslo_config import cfg
@@ -33,13 +38,16 @@ from oslo_utils import units
 
 from nclxd.nova.virt.lxd import container_config
 from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import container_console
 from nclxd.nova.virt.lxd import container_firewall
 from nclxd.nova.virt.lxd import container_image
+from nclxd.nova.virt.lxd import container_usage
 from nclxd.nova.virt.lxd import container_utils
 from nclxd.nova.virt.lxd import vif
 
 _ = i18n._
 _LE = i18n._LE
+_LI = i18n._LI
 _LW = i18n._LW
 
 CONF = cfg.CONF
@@ -61,9 +69,18 @@ class LXDContainerOperations(object):
         self.firewall_driver = container_firewall.LXDContainerFirewall()
 
         self.vif_driver = vif.LXDGenericDriver()
+        self.metrics = container_usage.LXDMetricsSampler()
+        self._maintenance_stopped = []
+
+    def init_host(self, host):
+        self.metrics.start()
 
     def list_instances(self, host=None):
-        return self.container_client.client('list', host=None)
+        return list(container_client.STATES.get(host))
+
+    def list_instance_uuids(self, host=None):
+        return [name for name in container_client.STATES.get(host)
+                if not name.endswith('-rescue')]
 
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None,
@@ -86,23 +103,56 @@ class LXDContainerOperations(object):
         if self.container_client.client('defined', instance=name, host=host):
             raise exception.InstanceExists(name=name)
 
-        container_config = self.container_config.create_container(context, instance, image_meta,
-                             injected_files, admin_password, network_info,
-                             block_device_info, name_label, rescue)
-
-        self.start_instance(container_config, instance, network_info, rescue)
-
-    def start_instance(self, container_config, instance, network_info, rescue=False, host=None):
+        # The VIFs only need to be in place by the time the container
+        # starts, so plug them while the image and config drive are set up.
+        timings = {}
+        start = time.time()
+        stages = [
+            eventlet.spawn(container_utils.timed_call, timings, 'create',
+                           self.container_config.create_container, context,
+                           instance, image_meta, injected_files,
+                           admin_password, network_info, block_device_info,
+                           name_label, rescue, host=host, timings=timings),
+            eventlet.spawn(container_utils.timed_call, timings, 'network',
+                           self.plug_instance_vifs, None, instance,
+                           network_info, running=False),
+        ]
+        container_config = container_utils.wait_all(stages)[0]
+
+        container_utils.timed_call(timings, 'start', self.start_instance,
+                                   container_config, instance, network_info,
+                                   rescue, host=host, vifs_plugged=True)
+        LOG.debug('Spawned container in %(total).2fs (%(stages)s)',
+                  {'total': time.time() - start,
+                   'stages': ', '.join('%s: %.2fs' % stage
+                                       for stage in sorted(timings.items()))},
+                  instance=instance)
+
+    def start_instance(self, container_config, instance, network_info,
+                       rescue=False, host=None, vifs_plugged=False):
         LOG.debug('Staring instance')
         name = instance.uuid
         if rescue:
             name = '%s-rescue' % instance.uuid
 
+        if not vifs_plugged:
+            running = self.container_client.client('running', instance=name,
+                                                   host=host)
+            self.plug_instance_vifs(container_config, instance, network_info,
+                                    running)
+
+        (state, data) = self.container_client.client('start', instance=name,
+                                                     host=host)
+        self.container_client.client('wait',
+                                     oid=data.get('operation').split('/')[3],
+                                     host=host)
+
+    def plug_instance_vifs(self, container_config, instance, network_info,
+                           running):
         timeout = CONF.vif_plugging_timeout
         # check to see if neutron is ready before
         # doing anything else
-        if (not self.container_client.client('running', instance=name,
-                                             host=host) and
+        if (not running and
                 utils.is_neutron() and timeout):
             events = self._get_neutron_events(network_info)
         else:
@@ -116,10 +166,97 @@ class LXDContainerOperations(object):
         except exception.VirtualInterfaceCreateException:
             LOG.info(_LW('Failed to connect networking to instance'))
 
-        (state, data) = self.container_client.client('start', instance=name,
-                                                     host=host)
-        self.container_client.client('wait', oid=data.get('operation').split('/')[3],
-                                     host=host)
+    def _power_container(self, action, name, host=None):
+        result = self.container_client.client(action, instance=name,
+                                              host=host)
+        if result is None:
+            # The container went away meanwhile.
+            return
+        (state, data) = result
+        self.container_client.client(
+            'wait', oid=data.get('operation').split('/')[3], host=host)
+
+    def power_containers(self, action, names=None, host=None):
+        """Start or stop many containers at once.
+
+        Up to bulk_concurrency containers are handled concurrently and
+        the whole operation is bounded by host_action_timeout.
+
+        :param action: 'start' or 'stop'
+        :param names: containers to act on; by default every container
+                      that is not already started or stopped
+        :returns: dict of container name to None or the error it hit
+        """
+        if names is None:
+            wanted = (power_state.RUNNING if action == 'stop'
+                      else power_state.SHUTDOWN)
+            names = [name for name, state in
+                     container_client.STATES.get(host).items()
+                     if state == wanted]
+
+        start = time.time()
+        results = container_utils.run_many(
+            lambda name: self._power_container(action, name, host),
+            names, CONF.lxd.bulk_concurrency,
+            CONF.lxd.host_action_timeout)
+
+        outcome = {}
+        for name, result, error in results:
+            outcome[name] = error
+            if error is not None:
+                LOG.error(_LE('Failed to %(action)s container %(name)s: '
+                              '%(error)s'),
+                          {'action': action, 'name': name, 'error': error})
+        LOG.info(_LI('%(action)s of %(count)d containers finished in '
+                     '%(elapsed).1fs with %(failed)d failures'),
+                 {'action': action, 'count': len(outcome),
+                  'elapsed': time.time() - start,
+                  'failed': len([error for error in outcome.values()
+                                 if error is not None])})
+        return outcome
+
+    def _check_power_outcome(self, action, outcome):
+        failed = sorted(name for name, error in outcome.items()
+                        if error is not None)
+        if failed:
+            msg = (_('Failed to %(action)s containers: %(names)s') %
+                   {'action': action, 'names': ', '.join(failed)})
+            raise exception.NovaException(msg)
+
+    def host_power_action(self, action, host=None):
+        if action == 'startup':
+            self._check_power_outcome(
+                'start', self.power_containers('start', host=host))
+        elif action == 'shutdown':
+            self._check_power_outcome(
+                'stop', self.power_containers('stop', host=host))
+        elif action == 'reboot':
+            outcome = self.power_containers('stop', host=host)
+            # Bring back what did stop before reporting what did not.
+            stopped = [name for name, error in outcome.items()
+                       if error is None]
+            started = self.power_containers('start', stopped, host=host)
+            self._check_power_outcome('stop', outcome)
+            self._check_power_outcome('start', started)
+        else:
+            msg = _('Unknown host power action: %s') % action
+            raise exception.NovaException(msg)
+        return action
+
+    def host_maintenance_mode(self, host, mode):
+        if mode:
+            outcome = self.power_containers('stop')
+            # Keep what an earlier call stopped, it is not running now.
+            self._maintenance_stopped.extend(
+                name for name, error in outcome.items()
+                if error is None and name not in self._maintenance_stopped)
+            self._check_power_outcome('stop', outcome)
+            return 'on_maintenance'
+
+        names, self._maintenance_stopped = self._maintenance_stopped, []
+        self._check_power_outcome('start',
+                                  self.power_containers('start', names))
+        return 'off_maintenance'
 
     def reboot(self, context, instance, network_info, reboot_type,
                block_device_info=None, bad_volumes_callback=None,
@@ -129,8 +266,7 @@ class LXDContainerOperations(object):
                                             host=host)
 
     def plug_vifs(self, container_config, instance, network_info):
-        for viface in network_info:
-            self.vif_driver.plug(instance, viface)
+        self.vif_driver.plug_vifs(instance, network_info)
         self._start_firewall(instance, network_info)
 
     def unplug_vifs(self, instance, network_info):
@@ -140,12 +276,28 @@ class LXDContainerOperations(object):
 
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, migrate_data=None, host=None):
+        if self._is_same_host_revert(context, instance):
+            # A same-host resize kept the container in place; it is the
+            # one finish_revert_migration goes back to.
+            LOG.debug('Reverting a resize on the same host, keeping the '
+                      'container', instance=instance)
+            return
         self.container_client.client('stop', instance=instance.uuid,
                                      host=host)
         self.container_client.client('destroy', instance=instance.uuid,
                                      host=host)
         self.cleanup(context, instance, network_info, block_device_info)
 
+    def _is_same_host_revert(self, context, instance):
+        if instance.task_state != task_states.RESIZE_REVERTING:
+            return False
+        try:
+            migration = objects.Migration.get_by_instance_and_status(
+                context.elevated(), instance.uuid, 'reverting')
+        except exception.MigrationNotFoundByStatus:
+            return False
+        return migration.source_compute == migration.dest_compute
+
     def power_off(self, instance, timeout=0, retry_interval=0, host=None):
         return self.container_client.client('stop', instance=instance.uuid,
                                             host=host)
@@ -190,33 +342,145 @@ class LXDContainerOperations(object):
     def cleanup(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, migrate_data=None, destroy_vifs=True):
         LOG.debug('container cleanup')
+        container_console.CONSOLES.forget(instance.uuid)
         container_dir = self.container_dir.get_instance_dir(instance.uuid)
         if os.path.exists(container_dir):
             shutil.rmtree(container_dir)
 
     def get_info(self, instance, host=None):
-        container_state = self.container_client.client('state', instance=instance.uuid,
-                                                       host=host)
-        return hardware.InstanceInfo(state=container_state,
-                                     max_mem_kb=0,
-                                     mem_kb=0,
-                                     num_cpu=2,
-                                     cpu_time_ns=0)
+        container_state = container_client.STATES.get(host).get(
+            instance.uuid, power_state.NOSTATE)
+        # cgroups can only be read for containers on this host.
+        usage = {}
+        if host is None:
+            usage = container_usage.USAGE.get().get(instance.uuid, {})
+        return hardware.InstanceInfo(
+            state=container_state,
+            max_mem_kb=(usage.get('max_mem_kb') or
+                        instance.flavor.memory_mb * units.Ki),
+            mem_kb=usage.get('mem_kb', 0),
+            num_cpu=usage.get('num_cpu') or instance.flavor.vcpus,
+            cpu_time_ns=usage.get('cpu_time_ns', 0))
+
+    def get_per_instance_usage(self):
+        return dict((name, {'uuid': name,
+                            'memory_mb': usage['mem_kb'] // units.Ki})
+                    for name, usage in container_usage.USAGE.get().items()
+                    if not name.endswith('-rescue'))
+
+    def get_all_bw_counters(self, instances):
+        """Return the traffic counters of every vif of the instances.
+
+        The host side veth of a vif (qvb) receives what is sent to the
+        instance and transmits what the instance sends.
+        """
+        ovs_driver = vif.LXDOpenVswitchDriver()
+        devices = []
+        for instance in instances:
+            info_cache = instance.info_cache
+            network_info = info_cache.network_info if info_cache else None
+            for instance_vif in network_info or []:
+                v1_name, v2_name = ovs_driver._get_veth_pair_names(
+                    instance_vif['id'])
+                devices.append((instance.uuid, instance_vif['address'],
+                                v1_name))
+
+        counters = container_usage.get_net_statistics(
+            device for uuid, address, device in devices)
+
+        bw_counters = []
+        for uuid, address, device in devices:
+            if device not in counters:
+                continue
+            rx_bytes, tx_bytes = counters[device]
+            bw_counters.append({'uuid': uuid,
+                                'mac_address': address,
+                                'bw_in': rx_bytes,
+                                'bw_out': tx_bytes})
+        return bw_counters
+
+    def _get_metrics(self, instance):
+        states = container_client.STATES.get()
+        if instance.uuid not in states:
+            raise exception.InstanceNotFound(instance_id=instance.uuid)
+        return states[instance.uuid], self.metrics.get(instance.uuid)
+
+    def get_diagnostics(self, instance):
+        container_state, sample = self._get_metrics(instance)
+        if sample is None:
+            return {}
+
+        diags = {'memory': sample.max_mem_kb or
+                 instance.flavor.memory_mb * units.Ki,
+                 'memory-actual': sample.mem_kb}
+        for cpu, cpu_time in enumerate(sample.cpu_times):
+            diags['cpu%d_time' % cpu] = cpu_time
+        for face, nic in sample.nics.items():
+            diags['%s_rx' % face] = nic.rx_bytes
+            diags['%s_rx_packets' % face] = nic.rx_packets
+            diags['%s_rx_errors' % face] = nic.rx_errors
+            diags['%s_rx_drop' % face] = nic.rx_drop
+            diags['%s_tx' % face] = nic.tx_bytes
+            diags['%s_tx_packets' % face] = nic.tx_packets
+            diags['%s_tx_errors' % face] = nic.tx_errors
+            diags['%s_tx_drop' % face] = nic.tx_drop
+        (diags['root_read'], diags['root_read_req'],
+         diags['root_write'], diags['root_write_req']) = sample.disk
+        return diags
+
+    def get_instance_diagnostics(self, instance):
+        container_state, sample = self._get_metrics(instance)
+        diags = diagnostics.Diagnostics(
+            state=power_state.STATE_MAP[container_state],
+            driver='lxd',
+            hypervisor_os='linux',
+            config_drive=configdrive.required_by(instance))
+        if sample is None:
+            return diags
+
+        if sample.started_at is not None:
+            diags.uptime = int(time.time() - sample.started_at)
+        diags.memory_details.maximum = (
+            (sample.max_mem_kb or instance.flavor.memory_mb * units.Ki) //
+            units.Ki)
+        diags.memory_details.used = sample.mem_kb // units.Ki
+        for cpu_time in sample.cpu_times:
+            diags.add_cpu(time=cpu_time)
+        for face in sorted(sample.nics):
+            nic = sample.nics[face]
+            diags.add_nic(rx_octets=nic.rx_bytes,
+                          rx_errors=nic.rx_errors,
+                          rx_drop=nic.rx_drop,
+                          rx_packets=nic.rx_packets,
+                          tx_octets=nic.tx_bytes,
+                          tx_errors=nic.tx_errors,
+                          tx_drop=nic.tx_drop,
+                          tx_packets=nic.tx_packets)
+        read_bytes, read_requests, write_bytes, write_requests = sample.disk
+        diags.add_disk(id='root',
+                       read_bytes=read_bytes,
+                       read_requests=read_requests,
+                       write_bytes=write_bytes,
+                       write_requests=write_requests)
+        return diags
+
+    def _get_console_log(self, instance):
+        return container_console.CONSOLES.get(
+            instance.uuid, self.container_dir.get_console_path(instance.uuid),
+            MAX_CONSOLE_BYTES)
 
     def get_console_output(self, context, instance):
         LOG.debug('in console output')
+        log_data, offset = self._get_console_log(instance).read()
+        return log_data
+
+    def get_console_output_since(self, context, instance, offset=None):
+        """Return the console output written after offset.
 
-        console_log = self.container_dir.get_console_path(instance.uuid)
-        uid = pwd.getpwuid(os.getuid()).pw_uid
-        utils.execute('chown', '%s:%s' % (uid, uid),
-                      console_log, run_as_root=True)
-        utils.execute('chmod', '755',
-                      self.container_dir.get_container_dir(instance.uuid),
-                      run_as_root=True)
-        with open(console_log, 'rb') as fp:
-            log_data, remaning = utils.last_bytes(fp,
-                                                  MAX_CONSOLE_BYTES)
-            return log_data
+        :returns: tuple of the new output and the offset to pass on the
+                  next call
+        """
+        return self._get_console_log(instance).read(since=offset)
 
     def container_attach_interface(self, instance, image_meta, vif, host=None):
         try:
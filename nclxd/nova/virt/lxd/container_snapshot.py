@@ -14,18 +14,27 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.from oslo_config import cfg
 
+import os
+
 from nova.compute import task_states
 from nova import exception
 from nova import i18n
 from nova import image
+from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import fileutils
 
 from pylxd import api
 
 from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import container_transfer
+from nclxd.nova.virt.lxd import container_utils
+from nclxd.nova.virt.lxd import privhelper
 
 _ = i18n._
+_LI = i18n._LI
+_LW = i18n._LW
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
@@ -37,6 +46,7 @@ class LXDSnapshot(object):
 
     def __init__(self):
         self.container_client = container_client.LXDContainerClient()
+        self.container_dir = container_utils.LXDContainerDirectories()
         self.lxd = api.API()
 
     def snapshot(self, context, instance, image_id, update_task_state, host=None):
@@ -46,7 +56,26 @@ class LXDSnapshot(object):
         snapshot = IMAGE_API.get(context, image_id)
 
         ''' Create a snapshot of the running contianer'''
-        self.create_container_snapshot(snapshot, instance.name)
+        if CONF.lxd.live_snapshots:
+            self.create_frozen_snapshot(snapshot, instance.name, host=host)
+        else:
+            self.create_container_snapshot(snapshot, instance.name)
+
+        if self.upload_delta(context, instance, image_id, snapshot,
+                             update_task_state):
+            return
+
+        if CONF.lxd.live_snapshots:
+            # The image is published from the snapshot, so the container
+            # keeps running while it is published and uploaded.
+            fingerprint = self.create_lxd_image(snapshot, instance.name)
+            update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                              expected_state=task_states.IMAGE_PENDING_UPLOAD)
+            self.create_glance_image(context, image_id, snapshot, fingerprint,
+                                     update_task_state)
+            if CONF.lxd.incremental_snapshots:
+                self.set_snapshot_base(instance, snapshot['name'], image_id, 0)
+            return
 
         ''' Publish the image to LXD '''
         (state, data) = self.container_client.client('stop', instance=instance.name,
@@ -55,15 +84,139 @@ class LXDSnapshot(object):
             oid=data.get('operation').split('/')[3],
             host=host)
         fingerprint = self.create_lxd_image(snapshot, instance.name)
-        self.create_glance_image(context, image_id, snapshot, fingerprint)
-
         update_task_state(task_state=task_states.IMAGE_UPLOADING,
                           expected_state=task_states.IMAGE_PENDING_UPLOAD)
-        (state, data) = self.container_client.client('start', instnace=instance.name,
-                                                     host=host)
+        self.create_glance_image(context, image_id, snapshot, fingerprint,
+                                 update_task_state)
+
+        (state, data) = self.container_client.client(
+            'start', instance=instance.name, host=host)
         self.container_client.client('wait',
                                      oid=data.get('operation').split('/')[3],
                                      host=host)
+        if CONF.lxd.incremental_snapshots:
+            self.set_snapshot_base(instance, snapshot['name'], image_id, 0)
+
+    def _snapshot_rootfs(self, instance_name, snapshot_name):
+        return os.path.join(CONF.lxd.root_dir, 'snapshots', instance_name,
+                            snapshot_name, 'rootfs')
+
+    def upload_delta(self, context, instance, image_id, snapshot,
+                     update_task_state):
+        """Upload only the changes since the instance's previous snapshot.
+
+        The image holds the rootfs entries that changed since the base
+        snapshot and a list of the removed ones, and names the base image
+        in its lxd_parent property. A full snapshot is taken instead when
+        there is no base yet, the chain has reached snapshot_full_every
+        images or the delta cannot be made.
+
+        :returns: True if the delta was uploaded
+        """
+        if not CONF.lxd.incremental_snapshots:
+            return False
+        sys_meta = instance.system_metadata
+        base = sys_meta.get('lxd_snapshot_base')
+        base_image = sys_meta.get('lxd_snapshot_image')
+        depth = int(sys_meta.get('lxd_snapshot_depth', 0)) + 1
+        if not base or not base_image or depth >= CONF.lxd.snapshot_full_every:
+            return False
+
+        # The helper writes the delta as a file of ours into the image
+        # cache, so it can be read and removed without root.
+        base_dir = self.container_dir.get_base_dir()
+        fileutils.ensure_tree(base_dir)
+        target = os.path.join(base_dir, 'snapshot-%s.tar.gz' % image_id)
+        try:
+            stats = privhelper.rootfs_delta(
+                self._snapshot_rootfs(instance.name, base),
+                self._snapshot_rootfs(instance.name, snapshot['name']),
+                target)
+            data = open(target, 'rb')
+        except (privhelper.LXDPrivHelperUnavailable,
+                processutils.ProcessExecutionError, IOError) as ex:
+            LOG.warning(_LW('Unable to make an incremental snapshot, '
+                            'taking a full one: %s'), ex, instance=instance)
+            return False
+        finally:
+            # The open file stays readable once its name is gone.
+            fileutils.delete_if_exists(target)
+
+        update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                          expected_state=task_states.IMAGE_PENDING_UPLOAD)
+        image_metadata = {'name': snapshot['name'],
+                          'disk_format': 'raw',
+                          'container_format': 'bare',
+                          'properties': {'lxd_parent': base_image,
+                                         'lxd_snapshot_depth': str(depth)}}
+        with data:
+            self.upload_image(context, image_id, image_metadata, data,
+                              update_task_state, stats['size'])
+
+        LOG.info(_LI('Uploaded incremental snapshot %(image)s of '
+                     '%(size)d bytes on top of %(base)s: %(changed)d paths '
+                     'changed, %(removed)d removed'),
+                 {'image': image_id, 'base': base_image,
+                  'size': stats['size'], 'changed': stats['changed'],
+                  'removed': stats['removed']}, instance=instance)
+        self.set_snapshot_base(instance, snapshot['name'], image_id, depth)
+        return True
+
+    def set_snapshot_base(self, instance, snapshot_name, image_id, depth):
+        """Make a snapshot the base of the instance's next delta.
+
+        The LXD snapshot of the previous base is no longer needed and is
+        deleted.
+        """
+        sys_meta = instance.system_metadata
+        old_base = sys_meta.get('lxd_snapshot_base')
+        if old_base and old_base != snapshot_name:
+            try:
+                self._wait_operation(
+                    self.container_client.client('snapshot_delete',
+                                                 instance=instance.name,
+                                                 snapshot=old_base,
+                                                 host=None))
+            except exception.NovaException as ex:
+                LOG.warning(_LW('Unable to delete snapshot %(snapshot)s: '
+                                '%(ex)s'),
+                            {'snapshot': old_base, 'ex': ex},
+                            instance=instance)
+        sys_meta['lxd_snapshot_base'] = snapshot_name
+        sys_meta['lxd_snapshot_image'] = image_id
+        sys_meta['lxd_snapshot_depth'] = str(depth)
+        instance.save()
+
+    def _wait_operation(self, response, host=None):
+        if response is not None:
+            (state, data) = response
+            self.container_client.client(
+                'wait', oid=data.get('operation').split('/')[3], host=host)
+
+    def create_frozen_snapshot(self, snapshot, instance_name, host=None):
+        """Snapshot a container with its processes frozen.
+
+        The container is only frozen while LXD takes the filesystem
+        snapshot, so that no write is caught half done. Containers that
+        are not running are snapshotted as they are.
+        """
+        if not self.container_client.client('running',
+                                            instance=instance_name,
+                                            host=host):
+            return self.create_container_snapshot(snapshot, instance_name,
+                                                  host=host)
+
+        self._wait_operation(
+            self.container_client.client('pause', instance=instance_name,
+                                         host=host), host)
+        try:
+            self.create_container_snapshot(snapshot, instance_name,
+                                           host=host)
+        finally:
+            self._wait_operation(
+                self.container_client.client('unpause',
+                                             instance=instance_name,
+                                             host=host), host)
 
     def create_container_snapshot(self, snapshot, instance_name, host=None):
         LOG.debug('Creating container snapshot')
@@ -95,15 +248,56 @@ class LXDSnapshot(object):
         self.lxd.alias_create(snapshot_alias)
         return fingerprint
 
-    def create_glance_image(self, context, image_id, snapshot, fingerprint):
+    def create_glance_image(self, context, image_id, snapshot, fingerprint,
+                            update_task_state):
         LOG.debug('Uploading image to glance')
         image_metadata = {'name': snapshot['name'],
                           "disk_format": "raw",
                           "container_format": "bare",
                           "properties": {}}
+        export = container_transfer.ImageExportReader(self.lxd.connection,
+                                                      fingerprint)
         try:
-            data = self.lxd.image_export(fingerprint)
-            IMAGE_API.update(context, image_id, image_metadata, data)
+            self.upload_image(context, image_id, image_metadata, export,
+                              update_task_state, export.size)
+        finally:
+            export.close()
+
+    def upload_image(self, context, image_id, image_metadata, data,
+                     update_task_state, size=None):
+        """Stream an image to Glance and check what Glance received.
+
+        The image is read in chunks as Glance consumes it, while its md5
+        is computed. Every few seconds the progress is logged and the
+        task state is saved again, which fails the upload early if the
+        instance has been deleted meanwhile.
+        """
+        def progress(bytes_read):
+            LOG.info(_LI('Uploaded %(bytes_read)d of %(size)s bytes of '
+                         'image %(image)s'),
+                     {'bytes_read': bytes_read, 'size': size or '?',
+                      'image': image_id})
+            update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                              expected_state=task_states.IMAGE_UPLOADING)
+
+        upload = container_transfer.ChecksumReader(data, progress)
+        try:
+            image_meta = IMAGE_API.update(context, image_id, image_metadata,
+                                          upload)
+        except exception.UnexpectedTaskStateError:
+            raise
         except Exception as ex:
             msg = _("Failed: %s") % ex
             raise exception.NovaException(msg)
+
+        checksum = image_meta.get('checksum')
+        if checksum is not None and checksum != upload.hexdigest():
+            msg = (_('Image %(image)s was corrupted during upload: '
+                     'checksum %(checksum)s, expected %(expected)s') %
+                   {'image': image_id, 'checksum': checksum,
+                    'expected': upload.hexdigest()})
+            raise exception.NovaException(msg)
+        LOG.debug('Uploaded %(bytes_read)d bytes of image %(image)s with '
+                  'checksum %(checksum)s',
+                  {'bytes_read': upload.bytes_read, 'image': image_id,
+                   'checksum': upload.hexdigest()})
@@ -0,0 +1,253 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bz2
+import hashlib
+import time
+import zlib
+
+import eventlet
+from nova import exception
+from nova import i18n
+from oslo_utils import units
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+_ = i18n._
+
+CHUNK_SIZE = 64 * units.Ki
+
+# Seconds between two progress reports of a ChecksumReader.
+PROGRESS_INTERVAL = 10
+
+# Compression formats LXD detects when an image is uploaded.
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'),
+                     (b'BZh', 'bzip2'),
+                     (b'\xfd7zXZ\x00', 'xz')]
+
+
+class LXDTransferError(exception.NovaException):
+    msg_fmt = _('Image transfer failed: %(reason)s')
+
+
+def _decompressor(algorithm):
+    if algorithm == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif algorithm == 'bzip2':
+        return bz2.BZ2Decompressor()
+    elif algorithm == 'xz' and lzma is not None:
+        return lzma.LZMADecompressor()
+    raise LXDTransferError(
+        reason=_('Unable to decompress %s images') % algorithm)
+
+
+def _compressor(algorithm, level):
+    if algorithm == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif algorithm == 'bzip2':
+        return bz2.BZ2Compressor(max(level, 1))
+    elif algorithm == 'xz' and lzma is not None:
+        return lzma.LZMACompressor(preset=level)
+    raise LXDTransferError(
+        reason=_('Unable to compress images with %s') % algorithm)
+
+
+class ImageExportReader(object):
+    """File-like reader of the export of an LXD image.
+
+    The export is read from its own HTTP connection as it is consumed,
+    so only one chunk of the image is held in memory at a time.
+
+    :param connection: pylxd connection of the host holding the image
+    :param fingerprint: fingerprint of the image
+    """
+
+    def __init__(self, connection, fingerprint):
+        self.bytes_read = 0
+        # Pooled clients share one keep-alive connection between their
+        # requests; the export is streamed on a connection of its own.
+        connect = getattr(connection.get_connection, 'connect',
+                          connection.get_connection)
+        self._conn = connect()
+        self._conn.request('GET', '/1.0/images/%s/export' % fingerprint)
+        self._response = self._conn.getresponse()
+        if self._response.status != 200:
+            reason = self._response.read()
+            self.close()
+            raise LXDTransferError(reason=reason)
+        length = self._response.getheader('Content-Length')
+        self.size = int(length) if length is not None else None
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self._response.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def close(self):
+        self._conn.close()
+
+
+class RecompressingReader(object):
+    """Re-encode a compressed stream on the fly.
+
+    The input format is detected from its first bytes; the output uses
+    the given algorithm and level.
+    """
+
+    def __init__(self, fileobj, algorithm, level):
+        self._fileobj = fileobj
+        self._decompressor = None
+        self._compressor = _compressor(algorithm, level)
+        self._buffer = b''
+        self._eof = False
+
+    def _detect(self, data):
+        for magic, algorithm in COMPRESSION_MAGIC:
+            if data.startswith(magic):
+                return _decompressor(algorithm)
+        raise LXDTransferError(reason=_('Unknown image compression'))
+
+    def read(self, size=CHUNK_SIZE):
+        while len(self._buffer) < size and not self._eof:
+            data = self._fileobj.read(CHUNK_SIZE)
+            if not data:
+                self._eof = True
+                self._buffer += self._compressor.flush()
+                break
+            if self._decompressor is None:
+                self._decompressor = self._detect(data)
+            self._buffer += self._compressor.compress(
+                self._decompressor.decompress(data))
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+class ThrottledReader(object):
+    """Limit how fast a stream is read with a token bucket.
+
+    :param rate: bytes per second, 0 for no limit
+    """
+
+    def __init__(self, fileobj, rate):
+        self._fileobj = fileobj
+        self._rate = rate
+        self._burst = max(rate, CHUNK_SIZE)
+        self._tokens = self._burst
+        self._stamp = time.time()
+        self.started = self._stamp
+        self.bytes_read = 0
+
+    def _consume(self, count):
+        if not self._rate:
+            return
+        now = time.time()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        self._tokens -= count
+        if self._tokens < 0:
+            eventlet.sleep(-self._tokens / float(self._rate))
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self._fileobj.read(size)
+        self.bytes_read += len(chunk)
+        self._consume(len(chunk))
+        return chunk
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+
+class ChecksumReader(object):
+    """Compute the md5 of a stream as it is read.
+
+    :param progress: called with the number of bytes read so far, at
+                     most once every PROGRESS_INTERVAL seconds
+    """
+
+    def __init__(self, fileobj, progress=None):
+        self._fileobj = fileobj
+        self._progress = progress
+        self._reported = time.time()
+        self._md5 = hashlib.md5()
+        self.bytes_read = 0
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self._fileobj.read(size)
+        self._md5.update(chunk)
+        self.bytes_read += len(chunk)
+        now = time.time()
+        if (self._progress is not None and
+                now - self._reported >= PROGRESS_INTERVAL):
+            self._reported = now
+            self._progress(self.bytes_read)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read()
+            if not chunk:
+                break
+            yield chunk
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+class ChunkedEncoder(object):
+    """Frame a stream of unknown length as an HTTP/1.1 chunked body."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._done = False
+
+    def read(self, size=CHUNK_SIZE):
+        if self._done:
+            return b''
+        chunk = self._fileobj.read(size)
+        if not chunk:
+            self._done = True
+            return b'0\r\n\r\n'
+        return ('%x\r\n' % len(chunk)).encode() + chunk + b'\r\n'
+
+
+def check_compression(compression, level):
+    """Make sure open_stream can recompress images this way.
+
+    Done before a transfer starts; xz is only there when the lzma
+    module is.
+
+    :raises LXDTransferError: if the compression is not available
+    """
+    if compression != 'none':
+        _compressor(compression, level)
+
+
+def open_stream(fileobj, compression, level, rate):
+    """Wrap an image export for transfer to another host.
+
+    :param compression: 'none' to send the image as LXD exported it, or
+                        'gzip', 'bzip2' or 'xz' to recompress it
+    :param level: compression level
+    :param rate: bandwidth limit in bytes per second, 0 for none
+    :returns: a ThrottledReader over the (recompressed) image
+    """
+    if compression != 'none':
+        fileobj = RecompressingReader(fileobj, compression, level)
+    return ThrottledReader(fileobj, rate)
@@ -0,0 +1,291 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import os
+import threading
+import time
+
+import eventlet
+from nova import i18n
+from nova import utils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import units
+
+from nclxd.nova.virt.lxd import container_utils
+
+_LE = i18n._LE
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+# The memory controller reports "no limit" as the largest page aligned
+# 64-bit value; anything at or above this is treated as unlimited.
+MEMORY_UNLIMITED = 2 ** 62
+
+SYSFS_NET = '/sys/class/net'
+
+# Counters of one network interface inside a container, in the order of
+# /proc/<pid>/net/dev.
+NicSample = collections.namedtuple(
+    'NicSample', ['rx_bytes', 'rx_packets', 'rx_errors', 'rx_drop',
+                  'tx_bytes', 'tx_packets', 'tx_errors', 'tx_drop'])
+
+# Everything the sampler records about one container.
+ContainerSample = collections.namedtuple(
+    'ContainerSample', ['mem_kb', 'max_mem_kb', 'cpu_times', 'nics',
+                        'disk', 'started_at'])
+
+
+class LXDContainerUsage(object):
+    """Resource usage of every running container on the local host.
+
+    LXD places each container in ``lxc/<name>`` below every cgroup
+    controller, so the usage of all containers is collected in a single
+    sweep over the cgroup filesystem instead of one API request per
+    container. The result is kept for ``usage_cache_ttl`` seconds.
+    """
+
+    def __init__(self):
+        self._usage = None
+        self._stamp = 0
+        self._lock = threading.Lock()
+
+    def _cgroup_dir(self, controller):
+        return os.path.join(CONF.lxd.cgroup_root, controller, 'lxc')
+
+    def _read(self, controller, name, key):
+        path = os.path.join(self._cgroup_dir(controller), name, key)
+        try:
+            with open(path) as fp:
+                return fp.read().strip()
+        except IOError:
+            return None
+
+    def _read_int(self, controller, name, key):
+        value = self._read(controller, name, key)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _list_containers(self):
+        cgroup_dir = self._cgroup_dir('memory')
+        try:
+            names = os.listdir(cgroup_dir)
+        except OSError:
+            LOG.debug('No container cgroups found in %s', cgroup_dir)
+            return []
+        return [name for name in names
+                if os.path.isdir(os.path.join(cgroup_dir, name))]
+
+    def _sweep(self):
+        usage = {}
+        for name in self._list_containers():
+            mem_bytes = self._read_int('memory', name,
+                                       'memory.usage_in_bytes') or 0
+            limit_bytes = self._read_int('memory', name,
+                                         'memory.limit_in_bytes')
+            if limit_bytes is not None and limit_bytes >= MEMORY_UNLIMITED:
+                limit_bytes = None
+            cpus = self._read('cpuset', name, 'cpuset.cpus')
+            usage[name] = {
+                'mem_kb': mem_bytes // units.Ki,
+                'max_mem_kb': (limit_bytes // units.Ki
+                               if limit_bytes is not None else None),
+                'num_cpu': (len(container_utils.parse_cpu_list(cpus))
+                            if cpus else None),
+                'cpu_time_ns': self._read_int('cpuacct', name,
+                                              'cpuacct.usage') or 0,
+            }
+        return usage
+
+    def invalidate(self):
+        self._usage = None
+
+    def get(self):
+        """Return a mapping of container name to its usage.
+
+        Each entry has ``mem_kb``, ``max_mem_kb``, ``num_cpu`` and
+        ``cpu_time_ns``; the limits are None when the container is not
+        restricted by its cgroup.
+        """
+        with self._lock:
+            if (self._usage is None or
+                    time.time() - self._stamp >= CONF.lxd.usage_cache_ttl):
+                self._usage = self._sweep()
+                self._stamp = time.time()
+            return self._usage
+
+
+USAGE = LXDContainerUsage()
+
+
+class LXDMetricsSampler(object):
+    """Periodic CPU, memory, NIC and disk samples of every container.
+
+    A single greenthread sweeps the cgroups of all containers every
+    ``metrics_interval`` seconds and appends the result to a ring buffer
+    holding the last ``metrics_history`` sweeps. Diagnostics are answered
+    from the newest sweep, so asking for them never touches the
+    containers themselves.
+    """
+
+    def __init__(self):
+        self._samples = collections.deque(maxlen=CONF.lxd.metrics_history)
+        self._started = False
+        self._btime = None
+
+    def start(self):
+        if self._started or CONF.lxd.metrics_interval <= 0:
+            return
+        self._started = True
+        utils.spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception:
+                LOG.exception(_LE('Failed to sample container metrics'))
+            eventlet.sleep(CONF.lxd.metrics_interval)
+
+    def _cpu_times(self, name, usage):
+        percpu = USAGE._read('cpuacct', name, 'cpuacct.usage_percpu')
+        if not percpu:
+            return (usage['cpu_time_ns'],)
+        times = [int(value) for value in percpu.split()]
+        cpus = USAGE._read('cpuset', name, 'cpuset.cpus')
+        if cpus:
+            times = [times[cpu]
+                     for cpu in container_utils.parse_cpu_list(cpus)
+                     if cpu < len(times)]
+        return tuple(times)
+
+    def _disk(self, name):
+        """Return (read_bytes, read_requests, write_bytes, write_requests)."""
+        totals = {}
+        for key in ('blkio.throttle.io_service_bytes',
+                    'blkio.throttle.io_serviced'):
+            data = USAGE._read('blkio', name, key) or ''
+            for line in data.splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                    stat = (key, fields[1])
+                    totals[stat] = totals.get(stat, 0) + int(fields[2])
+        return tuple(totals.get((key, op), 0)
+                     for op in ('Read', 'Write')
+                     for key in ('blkio.throttle.io_service_bytes',
+                                 'blkio.throttle.io_serviced'))
+
+    def _init_pid(self, name):
+        tasks = USAGE._read('memory', name, 'tasks')
+        if not tasks:
+            return None
+        return tasks.split()[0]
+
+    def _nics(self, pid):
+        nics = {}
+        try:
+            with open('/proc/%s/net/dev' % pid) as fp:
+                lines = fp.readlines()[2:]
+        except IOError:
+            return nics
+        for line in lines:
+            if ':' not in line:
+                continue
+            face, data = line.split(':', 1)
+            face = face.strip()
+            if face == 'lo':
+                continue
+            fields = [int(field) for field in data.split()]
+            nics[face] = NicSample(*(fields[0:4] + fields[8:12]))
+        return nics
+
+    def _boot_time(self):
+        if self._btime is None:
+            with open('/proc/stat') as fp:
+                for line in fp:
+                    if line.startswith('btime '):
+                        self._btime = int(line.split()[1])
+                        break
+        return self._btime
+
+    def _started_at(self, pid):
+        try:
+            with open('/proc/%s/stat' % pid) as fp:
+                stat = fp.read()
+            boot_time = self._boot_time()
+        except (IOError, OSError):
+            return None
+        # The command name in field 2 may hold spaces and parentheses;
+        # the fields after it start at the last ')'. Field 22, starttime,
+        # is in clock ticks since boot.
+        fields = stat.rsplit(')', 1)[1].split()
+        return boot_time + int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+
+    def sample(self):
+        """Take one sample of every container and store it."""
+        USAGE.invalidate()
+        samples = {}
+        for name, usage in USAGE.get().items():
+            pid = self._init_pid(name)
+            samples[name] = ContainerSample(
+                mem_kb=usage['mem_kb'],
+                max_mem_kb=usage['max_mem_kb'],
+                cpu_times=self._cpu_times(name, usage),
+                nics=self._nics(pid) if pid else {},
+                disk=self._disk(name),
+                started_at=self._started_at(pid) if pid else None)
+        self._samples.append((time.time(), samples))
+        return samples
+
+    def get(self, name):
+        """Return the newest sample of a container or None.
+
+        A sweep is taken on demand only when the sampler has not run yet.
+        """
+        if not self._samples:
+            self.sample()
+        return self._samples[-1][1].get(name)
+
+
+def get_net_statistics(devices):
+    """Read the rx/tx byte counters of host network devices.
+
+    All requested devices are read in a single pass over
+    /sys/class/net; devices that do not exist are left out.
+
+    :param devices: iterable of device names
+    :returns: mapping of device name to (rx_bytes, tx_bytes)
+    """
+    try:
+        present = set(os.listdir(SYSFS_NET))
+    except OSError:
+        return {}
+
+    counters = {}
+    for device in present.intersection(devices):
+        statistics = os.path.join(SYSFS_NET, device, 'statistics')
+        try:
+            with open(os.path.join(statistics, 'rx_bytes')) as fp:
+                rx_bytes = int(fp.read())
+            with open(os.path.join(statistics, 'tx_bytes')) as fp:
+                tx_bytes = int(fp.read())
+        except (IOError, ValueError):
+            continue
+        counters[device] = (rx_bytes, tx_bytes)
+    return counters
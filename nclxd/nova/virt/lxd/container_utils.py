@@ -15,11 +15,106 @@
 #    under the License.
 
 import os
+import sys
+import time
 
+import eventlet
+from eventlet import queue
+from nova import exception
+from nova import i18n
 from oslo_config import cfg
+import six
+
+_ = i18n._
 
 CONF = cfg.CONF
 
+
+class LXDOperationTimeout(exception.NovaException):
+    msg_fmt = _('Operation on %(item)s did not finish before the deadline')
+
+
+def parse_cpu_list(cpu_list):
+    """Expand a kernel CPU list such as '0-3,8' into CPU numbers."""
+    cpus = []
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def timed_call(timings, stage, func, *args, **kwargs):
+    """Call func and record how long it took under timings[stage]."""
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[stage] = time.time() - start
+
+
+def wait_all(threads):
+    """Wait for every greenthread and return their results.
+
+    As soon as one of them fails the others are killed, so that the
+    failure is not held back by slower work that is now pointless, and
+    it is re-raised.
+    """
+    finished = queue.LightQueue()
+    for index, thread in enumerate(threads):
+        thread.link(lambda thread, index=index: finished.put(index))
+
+    results = [None] * len(threads)
+    for _ in threads:
+        index = finished.get()
+        try:
+            results[index] = threads[index].wait()
+        except Exception:
+            error = sys.exc_info()
+            for thread in threads:
+                thread.kill()
+            six.reraise(*error)
+    return results
+
+
+def run_many(func, items, concurrency, timeout=None):
+    """Call func on every item from a pool of greenthreads.
+
+    At most concurrency calls run at the same time. A failing call does
+    not stop the others. Calls still running or not yet started when
+    timeout seconds have passed are cancelled and reported as
+    LXDOperationTimeout.
+
+    :returns: list of (item, result, exception) tuples in item order
+    """
+    items = list(items)
+    results = {}
+
+    def call(index, item):
+        try:
+            results[index] = (item, func(item), None)
+        except Exception as ex:
+            results[index] = (item, None, ex)
+
+    pool = eventlet.GreenPool(max(1, concurrency))
+    threads = []
+    with eventlet.Timeout(timeout, False):
+        for index, item in enumerate(items):
+            threads.append(pool.spawn(call, index, item))
+        pool.waitall()
+    for thread in threads:
+        thread.kill()
+
+    return [results.get(index) or
+            (item, None, LXDOperationTimeout(item=item))
+            for index, item in enumerate(items)]
+
+
 class LXDContainerDirectories(object):
 
     def __init__(self):
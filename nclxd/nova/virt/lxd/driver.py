@@ -29,6 +29,7 @@ from nclxd.nova.virt.lxd import container_ops
 from nclxd.nova.virt.lxd import container_snapshot
 from nclxd.nova.virt.lxd import container_migrate
 from nclxd.nova.virt.lxd import host
+from nclxd.nova.virt.lxd import imagecache
 
 _ = i18n._
 
@@ -42,12 +43,116 @@ lxd_opts = [
     cfg.IntOpt('timeout',
                default=5,
                help='Default LXD timeout'),
+    cfg.IntOpt('operation_timeout',
+               default=600,
+               help='Seconds to wait for an LXD operation such as creating, '
+                    'starting or snapshotting a container to finish'),
     cfg.StrOpt('default_profile',
                default='nclxd-profile',
                help='Default LXD profile'),
     cfg.StrOpt('lxd_port',
                default=8443,
-               help='Default LXD Port')
+               help='Default LXD Port'),
+    cfg.IntOpt('pool_size',
+               default=8,
+               help='Maximum number of idle LXD connections kept per host'),
+    cfg.IntOpt('pool_idle_timeout',
+               default=60,
+               help='Seconds an idle LXD connection is kept before it is '
+                    'closed'),
+    cfg.IntOpt('events_retry_interval',
+               default=5,
+               help='Seconds to wait before resubscribing to the LXD events '
+                    'stream after it was lost'),
+    cfg.IntOpt('state_cache_ttl',
+               default=5,
+               help='Seconds the power state of all containers is cached '
+                    'for when it is not invalidated by LXD events'),
+    cfg.IntOpt('image_cache_max_size_mb',
+               default=0,
+               help='Size of the local image cache above which the least '
+                    'recently used unused images are removed. 0 disables '
+                    'the size limit'),
+    cfg.BoolOpt('stream_image_upload',
+                default=True,
+                help='Upload images to LXD straight out of the downloaded '
+                     'Glance tarball instead of extracting it first'),
+    cfg.StrOpt('cgroup_root',
+               default='/sys/fs/cgroup',
+               help='Mount point of the cgroup controllers that container '
+                    'usage is read from'),
+    cfg.IntOpt('usage_cache_ttl',
+               default=5,
+               help='Seconds the resource usage of all containers is cached '
+                    'for'),
+    cfg.IntOpt('metrics_interval',
+               default=60,
+               help='Seconds between samples of the CPU, memory, network '
+                    'and disk statistics of all containers. 0 disables '
+                    'background sampling'),
+    cfg.IntOpt('metrics_history',
+               default=10,
+               help='Number of container statistics samples kept in memory'),
+    cfg.IntOpt('bulk_concurrency',
+               default=32,
+               help='Maximum number of concurrent LXD requests made by '
+                    'operations on many containers at once'),
+    cfg.IntOpt('host_action_timeout',
+               default=600,
+               help='Seconds a host power action or maintenance mode '
+                    'change may take to stop or start all containers'),
+    cfg.IntOpt('live_migration_timeout',
+               default=1800,
+               help='Seconds a live migration may take before it is '
+                    'cancelled and the instance is left on the source'),
+    cfg.IntOpt('live_migration_progress_interval',
+               default=10,
+               help='Seconds between progress reports of a running live '
+                    'migration'),
+    cfg.StrOpt('migration_transfer',
+               default='websocket',
+               choices=['websocket', 'image'],
+               help='How cold migrations copy a container: let the '
+                    'destination pull it over the LXD migration websocket, '
+                    'or stream it as an image that can be recompressed and '
+                    'rate limited'),
+    cfg.StrOpt('migration_compression',
+               default='none',
+               choices=['none', 'gzip', 'bzip2', 'xz'],
+               help='Compression of images streamed by image migrations; '
+                    'none sends them as compressed by LXD'),
+    cfg.IntOpt('migration_compression_level',
+               default=6,
+               help='Compression level of images streamed by image '
+                    'migrations'),
+    cfg.IntOpt('migration_bandwidth_mb',
+               default=0,
+               help='Maximum MB per second used by an image migration, '
+                    '0 for no limit'),
+    cfg.BoolOpt('live_snapshots',
+                default=False,
+                help='Keep instances running while they are snapshotted, '
+                     'only freezing them while the filesystem snapshot '
+                     'is taken. That is instant on btrfs, zfs and lvm but '
+                     'a copy of the rootfs on the dir backend'),
+    cfg.BoolOpt('incremental_snapshots',
+                default=False,
+                help='Upload only the changes since the previous snapshot '
+                     'of an instance, as an image linked to the previous '
+                     'one through its lxd_parent property. Needs the '
+                     'privileged helper and a storage backend that keeps '
+                     'snapshots as directories'),
+    cfg.IntOpt('snapshot_full_every',
+               default=7,
+               help='Number of images in a chain of incremental snapshots, '
+                    'including the full one it starts with'),
+    cfg.BoolOpt('use_privhelper',
+                default=True,
+                help='Run privileged operations through a long running '
+                     'nclxd-privhelper process started with the root '
+                     'helper instead of one root helper call each. The '
+                     'nclxd-privhelper rootwrap filter has to name the '
+                     'same directory as root_dir')
 ]
 
 CONF = cfg.CONF
@@ -59,7 +164,7 @@ class LXDDriver(driver.ComputeDriver):
     """LXD Lightervisor."""
 
     capabilities = {
-        "has_imagecache": False,
+        "has_imagecache": True,
         "supports_recreate": False,
         "supports_migrate_to_same_host": True,
     }
@@ -72,9 +177,12 @@ class LXDDriver(driver.ComputeDriver):
         self.container_firewall = container_firewall.LXDContainerFirewall()
         self.container_migrate = container_migrate.LXDContainerMigrate(virtapi)
         self.host = host.LXDHost()
+        self.image_cache_manager = imagecache.LXDImageCacheManager()
 
     def init_host(self, host):
-        return self.host.init_host(host)
+        result = self.host.init_host(host)
+        self.container_ops.init_host(host)
+        return result
 
     def get_info(self, instance):
         return self.container_ops.get_info(instance)
@@ -92,7 +200,7 @@ class LXDDriver(driver.ComputeDriver):
         return self.container_ops.list_instances()
 
     def list_instance_uuids(self):
-        raise NotImplementedError()
+        return self.container_ops.list_instance_uuids()
 
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None):
@@ -122,13 +230,13 @@ class LXDDriver(driver.ComputeDriver):
         return self.container_ops.get_console_output(context, instance)
 
     def get_diagnostics(self, instance):
-        raise NotImplementedError()
+        return self.container_ops.get_diagnostics(instance)
 
     def get_instance_diagnostics(self, instance):
-        raise NotImplementedError()
+        return self.container_ops.get_instance_diagnostics(instance)
 
     def get_all_bw_counters(self, instances):
-        raise NotImplementedError()
+        return self.container_ops.get_all_bw_counters(instances)
 
     def get_all_volume_usage(self, context, compute_host_bdms):
         raise NotImplementedError()
@@ -174,6 +282,11 @@ class LXDDriver(driver.ComputeDriver):
                                                        network_info, image_meta, resize_instance,
                                                        block_device_info, power_on)
 
+    def finish_revert_migration(self, context, instance, network_info,
+                                block_device_info=None, power_on=True):
+        return self.container_migrate.finish_revert_migration(
+            context, instance, network_info, block_device_info, power_on)
+
     def confirm_migration(self, migration, instance, network_info):
         return self.container_migrate.confirm_migration(migration, instance, network_info)
 
@@ -228,6 +341,20 @@ class LXDDriver(driver.ComputeDriver):
                             migrate_data=None):
         return self.container_migrate.post_live_migration(context, instance, block_device_info)
 
+    def rollback_live_migration_at_destination(self, context, instance,
+                                               network_info,
+                                               block_device_info,
+                                               destroy_disks=True,
+                                               migrate_data=None):
+        return (self.container_migrate
+                .rollback_live_migration_at_destination(
+                    context, instance, network_info, block_device_info,
+                    destroy_disks, migrate_data))
+
+    def post_live_migration_at_source(self, context, instance, network_info):
+        return self.container_migrate.post_live_migration_at_source(
+            context, instance, network_info)
+
 
     def post_live_migration_at_destination(self, context, instance,
                                            network_info,
@@ -249,15 +376,20 @@ class LXDDriver(driver.ComputeDriver):
                                            src_compute_info, dst_compute_info,
                                            block_migration=False,
                                            disk_over_commit=False):
-        raise NotImplementedError()
+        return self.container_migrate.check_can_live_migrate_destination(
+            context, instance, src_compute_info, dst_compute_info,
+            block_migration, disk_over_commit)
 
     def check_can_live_migrate_destination_cleanup(self, context,
                                                    dest_check_data):
-        raise NotImplementedError()
+        return (self.container_migrate
+                .check_can_live_migrate_destination_cleanup(
+                    context, dest_check_data))
 
     def check_can_live_migrate_source(self, context, instance,
                                       dest_check_data, block_device_info=None):
-        raise NotImplementedError()
+        return self.container_migrate.check_can_live_migrate_source(
+            context, instance, dest_check_data)
 
     def get_instance_disk_info(self, instance,
                                block_device_info=None):
@@ -296,13 +428,13 @@ class LXDDriver(driver.ComputeDriver):
         raise NotImplementedError()
 
     def host_power_action(self, action):
-        raise NotImplementedError()
+        return self.container_ops.host_power_action(action)
 
     def host_maintenance_mode(self, host, mode):
-        raise NotImplementedError()
+        return self.container_ops.host_maintenance_mode(host, mode)
 
     def set_host_enabled(self, enabled):
-        raise NotImplementedError()
+        return 'enabled' if enabled else 'disabled'
 
     def get_host_uptime(self):
         return self.host.get_host_uptime()
@@ -321,7 +453,7 @@ class LXDDriver(driver.ComputeDriver):
         return None
 
     def manage_image_cache(self, context, all_instances):
-        pass
+        return self.image_cache_manager.update(context, all_instances)
 
     def add_to_aggregate(self, context, aggregate, host, **kwargs):
         raise NotImplementedError()
@@ -349,7 +481,7 @@ class LXDDriver(driver.ComputeDriver):
         return nodename in self.get_available_nodes(refresh=True)
 
     def get_per_instance_usage(self):
-        return {}
+        return self.container_ops.get_per_instance_usage()
 
     def instance_on_disk(self, instance):
         return False
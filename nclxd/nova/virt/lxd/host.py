@@ -18,6 +18,7 @@
 #    under the License.
 
 
+import collections
 import os
 import platform
 
@@ -36,16 +37,24 @@ import psutil
 from pylxd import api
 from pylxd import exceptions as lxd_exceptions
 
+from nclxd.nova.virt.lxd import container_usage
+from nclxd.nova.virt.lxd import container_utils
+
 _ = i18n._
 _LW = i18n._LW
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
 
+SYSFS_CPU = '/sys/devices/system/cpu'
+
+
 class LXDHost(object):
 
     def __init__(self):
         self.lxd = api.API()
+        self._cpu_info = None
+        self._cpu_online = None
 
     def get_available_resource(self, nodename):
         LOG.debug('In get_available_resource')
@@ -65,7 +74,7 @@ class LXDHost(object):
             'memory_mb_used': local_memory_info['used'] / units.Mi,
             'local_gb': local_disk_info['total'] / units.Gi,
             'local_gb_used': local_disk_info['used'] / units.Gi,
-            'vcpus_used': 0,
+            'vcpus_used': self._get_vcpus_used(),
             'hypervisor_type': 'lxd',
             'hypervisor_version': '011',
             'cpu_info': jsonutils.dumps(local_cpu_info),
@@ -78,6 +87,10 @@ class LXDHost(object):
 
         return data
 
+    def _get_vcpus_used(self):
+        return sum(usage['num_cpu'] or 0
+                   for usage in container_usage.USAGE.get().values())
+
     def get_host_ip_addr(self):
         ips = compute_utils.get_machine_ips()
         if CONF.my_ip not in ips:
@@ -129,46 +142,97 @@ class LXDHost(object):
         }
 
     def _get_cpuinfo(self):
+        """Return the host CPU description.
+
+        The topology and flags are computed once and only refreshed when
+        the set of online CPUs changes or invalidate_cpuinfo is called.
+        """
+        try:
+            cpu_online = self._read_sysfs(os.path.join(SYSFS_CPU, 'online'))
+        except IOError:
+            # Restricted or containerised hosts may not expose sysfs;
+            # /proc/cpuinfo has to do.
+            cpu_online = None
+        if self._cpu_info is None or cpu_online != self._cpu_online:
+            LOG.debug('Refreshing host CPU info, online CPUs: %s',
+                      cpu_online)
+            self._cpu_info = self._build_cpuinfo(cpu_online)
+            self._cpu_online = cpu_online
+        return self._cpu_info
+
+    def invalidate_cpuinfo(self):
+        self._cpu_info = None
+
+    def _build_cpuinfo(self, cpu_online):
         cpuinfo = self._get_cpu_info()
 
         cpu_info = dict()
 
         cpu_info['arch'] = platform.uname()[5]
         cpu_info['model'] = cpuinfo.get('model name', 'unknown')
-        cpu_info['vendor'] = cpuinfo.get('vendor id', 'unknown')
-
-        topology = dict()
-        topology['sockets'] = cpuinfo.get('socket(s)', 1)
-        topology['cores'] = cpuinfo.get('core(s) per socket', 1)
-        topology['threads'] = cpuinfo.get('thread(s) per core', 1)
-        cpu_info['topology'] = topology
+        cpu_info['vendor'] = cpuinfo.get('vendor_id', 'unknown')
+        if cpu_online is None:
+            cpu_info['topology'] = self._get_cpuinfo_topology(cpuinfo)
+        else:
+            cpu_info['topology'] = self._get_cpu_topology(cpu_online)
         cpu_info['features'] = cpuinfo.get('flags', 'unknown')
 
         return cpu_info
 
+    def _get_cpu_topology(self, cpu_online):
+        """Work out sockets, cores and threads from sysfs."""
+        cpus = container_utils.parse_cpu_list(cpu_online)
+        cores = collections.defaultdict(set)
+        for cpu in cpus:
+            topology = os.path.join(SYSFS_CPU, 'cpu%d' % cpu, 'topology')
+            try:
+                socket = self._read_sysfs(
+                    os.path.join(topology, 'physical_package_id'))
+                core = self._read_sysfs(os.path.join(topology, 'core_id'))
+            except IOError:
+                continue
+            cores[socket].add(core)
+
+        if not cpus or not cores:
+            return {'sockets': 1, 'cores': max(len(cpus), 1), 'threads': 1}
+
+        sockets = len(cores)
+        cores_per_socket = max(len(socket_cores)
+                               for socket_cores in cores.values())
+        threads = max(len(cpus) // (sockets * cores_per_socket), 1)
+        return {'sockets': sockets,
+                'cores': cores_per_socket,
+                'threads': threads}
+
+    def _get_cpuinfo_topology(self, cpuinfo):
+        """Work out sockets, cores and threads from /proc/cpuinfo."""
+        cpus = psutil.cpu_count()
+        try:
+            cores = int(cpuinfo['cpu cores'])
+            siblings = int(cpuinfo['siblings'])
+        except (KeyError, ValueError):
+            return {'sockets': 1, 'cores': cpus, 'threads': 1}
+        return {'sockets': max(cpus // siblings, 1),
+                'cores': cores,
+                'threads': max(siblings // cores, 1)}
+
+    def _read_sysfs(self, path):
+        with open(path) as fp:
+            return fp.read().strip()
+
     def _get_cpu_info(self):
-        '''Parse the output of lscpu.'''
+        '''Parse the first processor entry of /proc/cpuinfo.'''
         cpuinfo = {}
-        out, err = utils.execute('lscpu')
-        if err:
-            msg = _('Unable to parse lscpu output.')
-            raise exception.NovaException(msg)
-
-        cpu = [line.strip('\n') for line in out.splitlines()]
-        for line in cpu:
-            if line.strip():
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if not line.strip():
+                    if cpuinfo:
+                        break
+                    continue
+                if ':' not in line:
+                    continue
                 name, value = line.split(':', 1)
-                name = name.strip().lower()
-                cpuinfo[name] = value.strip()
-
-        f = open('/proc/cpuinfo', 'r')
-        features = [line.strip('\n') for line in f.readlines()]
-        for line in features:
-            if line.strip():
-                if line.startswith('flags'):
-                    name, value = line.split(':', 1)
-                    name = name.strip().lower()
-                    cpuinfo[name] = value.strip()
+                cpuinfo[name.strip().lower()] = value.strip()
 
         return cpuinfo
 
@@ -187,6 +251,7 @@ class LXDHost(object):
 
     def init_host(self, host):
         LOG.debug('Host check')
+        self._get_cpuinfo()
         try:
             if not self.lxd.host_ping():
                 msg = _('Unable to connect to LXD daemon')
@@ -0,0 +1,174 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+
+from nova import i18n
+from nova.virt import imagecache
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import fileutils
+from oslo_utils import units
+from pylxd import exceptions as lxd_exceptions
+
+from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import container_utils
+
+_ = i18n._
+_LE = i18n._LE
+_LI = i18n._LI
+
+CONF = cfg.CONF
+CONF.import_opt('remove_unused_base_images', 'nova.virt.imagecache')
+CONF.import_opt('remove_unused_original_minimum_age_seconds',
+                'nova.virt.imagecache')
+LOG = logging.getLogger(__name__)
+
+INDEX_NAME = 'nclxd-image-cache.json'
+
+
+class LXDImageCacheIndex(object):
+    """On-disk index of the Glance images cached on this host.
+
+    Every entry records the LXD fingerprint of the uploaded image, the
+    local files that were downloaded for it, their size and when the
+    image was last used to spawn or back an instance.
+    """
+
+    def __init__(self):
+        self.container_dir = container_utils.LXDContainerDirectories()
+
+    def _path(self):
+        return os.path.join(self.container_dir.get_base_dir(), INDEX_NAME)
+
+    def _load(self):
+        try:
+            with open(self._path()) as fp:
+                return jsonutils.loads(fp.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, index):
+        path = self._path()
+        fileutils.ensure_tree(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as fp:
+            fp.write(jsonutils.dumps(index))
+        os.rename(path + '.tmp', path)
+
+    @lockutils.synchronized('nclxd-image-cache-index')
+    def entries(self):
+        return self._load()
+
+    @lockutils.synchronized('nclxd-image-cache-index')
+    def add(self, image_id, fingerprint, files):
+        index = self._load()
+        index[image_id] = {
+            'fingerprint': fingerprint,
+            'files': files,
+            'size': sum(os.path.getsize(path) for path in files
+                        if os.path.exists(path)),
+            'last_used': time.time(),
+        }
+        self._save(index)
+
+    @lockutils.synchronized('nclxd-image-cache-index')
+    def touch(self, image_ids):
+        index = self._load()
+        now = time.time()
+        for image_id in image_ids:
+            if image_id in index:
+                index[image_id]['last_used'] = now
+        self._save(index)
+
+    @lockutils.synchronized('nclxd-image-cache-index')
+    def remove(self, image_id):
+        index = self._load()
+        index.pop(image_id, None)
+        self._save(index)
+
+
+INDEX = LXDImageCacheIndex()
+
+
+class LXDImageCacheManager(imagecache.ImageCacheManager):
+    """Evict cached images that are no longer used by any instance.
+
+    Images still backing an instance on this host are never removed.
+    Unused images are removed once they are older than
+    remove_unused_original_minimum_age_seconds, and the least recently
+    used ones are removed early when the cache exceeds
+    image_cache_max_size_mb.
+    """
+
+    def _remove_image(self, image_id, entry):
+        # Hold the image's download lock so that a spawn that is setting
+        # up this image is never left without it.
+        with lockutils.lock(image_id, lock_file_prefix='nclxd-image-',
+                            external=True,
+                            lock_path=INDEX.container_dir.get_base_dir()):
+            current = INDEX.entries().get(image_id)
+            if (current is None or
+                    current['last_used'] != entry['last_used']):
+                return False
+            return self._delete_image(image_id, entry)
+
+    def _delete_image(self, image_id, entry):
+        LOG.info(_LI('Removing cached image %s'), image_id)
+        with container_client.POOL.connection() as lxd:
+            for func, arg in ((lxd.alias_delete, image_id),
+                              (lxd.image_delete, entry['fingerprint'])):
+                try:
+                    func(arg)
+                except lxd_exceptions.APIError as ex:
+                    if ex.status_code != 404:
+                        LOG.error(_LE('Failed to remove LXD image '
+                                      '%(image)s: %(ex)s'),
+                                  {'image': image_id, 'ex': ex})
+                        return False
+
+        for path in entry.get('files', []):
+            fileutils.delete_if_exists(path)
+        INDEX.remove(image_id)
+        return True
+
+    def update(self, context, all_instances):
+        running = self._list_running_instances(context, all_instances)
+        used_images = set(running['used_images'])
+
+        entries = INDEX.entries()
+        INDEX.touch(used_images & set(entries))
+        entries = INDEX.entries()
+        if not CONF.remove_unused_base_images:
+            return
+
+        now = time.time()
+        total = sum(entry['size'] for entry in entries.values())
+        unused = sorted(((image_id, entry)
+                         for image_id, entry in entries.items()
+                         if image_id not in used_images),
+                        key=lambda item: item[1]['last_used'])
+
+        max_size = CONF.lxd.image_cache_max_size_mb * units.Mi
+        for image_id, entry in unused:
+            too_old = (now - entry['last_used'] >
+                       CONF.remove_unused_original_minimum_age_seconds)
+            too_big = max_size and total > max_size
+            if not (too_old or too_big):
+                continue
+            if self._remove_image(image_id, entry):
+                total -= entry['size']
@@ -0,0 +1,183 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import base64
+import shlex
+import threading
+import time
+
+from eventlet.green import subprocess
+from nova import i18n
+from nova import utils
+from oslo_concurrency import processutils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+_ = i18n._
+_LW = i18n._LW
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+# Seconds to use the root helper for before trying to start the helper
+# again once it failed.
+RETRY_INTERVAL = 300
+
+
+class LXDPrivHelperUnavailable(Exception):
+    """The privileged helper could not be started or went away."""
+
+
+class LXDPrivHelper(object):
+    """Client for the long running nclxd-privhelper process.
+
+    The helper is started through the root helper on first use and then
+    serves every privileged request over its stdin and stdout, so a
+    request costs a pipe round-trip instead of a sudo and rootwrap
+    interpreter start. Requests are sent one at a time.
+
+    If the helper cannot be started, for example because the rootwrap
+    filter names another root_dir, it is not tried again for
+    RETRY_INTERVAL seconds, so that calls go straight to the fallback.
+    """
+
+    def __init__(self):
+        self._proc = None
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    def _give_up(self, reason):
+        self._proc = None
+        self._retry_at = time.time() + RETRY_INTERVAL
+        LOG.warning(_LW('Privileged helper unavailable, using the root '
+                        'helper for %(interval)d seconds: %(reason)s'),
+                    {'interval': RETRY_INTERVAL, 'reason': reason})
+        raise LXDPrivHelperUnavailable(reason)
+
+    def _start(self):
+        cmd = (shlex.split(utils.get_root_helper()) +
+               ['nclxd-privhelper', '--root-dir', CONF.lxd.root_dir])
+        LOG.debug('Starting privileged helper: %s', ' '.join(cmd))
+        try:
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True)
+        except OSError as ex:
+            self._give_up(ex)
+
+    def _request(self, request):
+        if self._proc is None or self._proc.poll() is not None:
+            if time.time() < self._retry_at:
+                raise LXDPrivHelperUnavailable()
+            self._start()
+        try:
+            self._proc.stdin.write(request)
+            self._proc.stdin.flush()
+            reply = self._proc.stdout.readline()
+        except (IOError, OSError) as ex:
+            self._give_up(ex)
+        if not reply:
+            self._give_up(_('helper exited'))
+        return jsonutils.loads(reply)
+
+    def call(self, op, *args):
+        request = (jsonutils.dumps({'op': op, 'args': args}) +
+                   '\n').encode()
+        with self._lock:
+            reply = self._request(request)
+
+        if 'error' in reply:
+            raise processutils.ProcessExecutionError(
+                stdout=reply.get('stdout'),
+                stderr=reply.get('stderr'),
+                exit_code=reply.get('exit_code'),
+                cmd=' '.join(reply.get('cmd') or [op]),
+                description=reply['error'])
+        return reply['result']
+
+
+HELPER = LXDPrivHelper()
+
+
+def _call(op, *args):
+    """Run op through the helper.
+
+    :raises LXDPrivHelperUnavailable: if the helper is disabled or could
+                                      not be reached, in which case the
+                                      caller falls back to the root helper
+    """
+    if not CONF.lxd.use_privhelper:
+        raise LXDPrivHelperUnavailable()
+    return HELPER.call(op, *args)
+
+
+def chown(path, uid, gid):
+    try:
+        _call('chown', path, uid, gid)
+    except LXDPrivHelperUnavailable:
+        utils.execute('chown', '%s:%s' % (uid, gid), path,
+                      run_as_root=True)
+
+
+def chmod(path, mode):
+    try:
+        _call('chmod', path, mode)
+    except LXDPrivHelperUnavailable:
+        utils.execute('chmod', '%o' % mode, path, run_as_root=True)
+
+
+def read_console(path, max_bytes, offset=None):
+    """Read a console log as root.
+
+    :returns: dict with the data read, the file offset it starts at and
+              the size and inode of the file
+    :raises LXDPrivHelperUnavailable: if the helper is not in use; the
+                                      caller then has to make the log
+                                      readable and read it itself
+    """
+    reply = _call('read_console', path, max_bytes, offset)
+    reply['data'] = base64.b64decode(reply['data'])
+    return reply
+
+
+def ip_batch(commands):
+    try:
+        _call('ip_batch', commands)
+    except LXDPrivHelperUnavailable:
+        utils.execute('ip', '-batch', '-',
+                      process_input='\n'.join(commands) + '\n',
+                      run_as_root=True)
+
+
+def ovs_vsctl(args):
+    try:
+        _call('ovs_vsctl', args)
+    except LXDPrivHelperUnavailable:
+        utils.execute('ovs-vsctl', *args, run_as_root=True)
+
+
+def rootfs_delta(base, new, target):
+    """Write the changes from one snapshot rootfs to the next to target.
+
+    target must not exist yet and its directory must belong to us; the
+    tarball is created as our file.
+
+    :returns: dict with the number of changed and removed paths and the
+              size of the tarball
+    :raises LXDPrivHelperUnavailable: if the helper is not in use; there
+                                      is no root helper equivalent
+    """
+    return _call('rootfs_delta', base, new, target)
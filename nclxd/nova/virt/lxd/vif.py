@@ -12,6 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+
+from eventlet import event
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -22,14 +25,100 @@ from nova.network import linux_net
 from nova.network import model as network_model
 from nova import utils
 
+from nclxd.nova.virt.lxd import privhelper
+
 _ = i18n._
 _LE = i18n._LE
+_LW = i18n._LW
 
 CONF = cfg.CONF
+CONF.import_opt('network_device_mtu', 'nova.network.linux_net')
+CONF.import_opt('ovs_vsctl_timeout', 'nova.network.linux_net')
 
 LOG = logging.getLogger(__name__)
 
 
+class LXDOvsPortTransaction(object):
+    """Group commit of OVS port creation.
+
+    Callers hand over all the ports of an instance at once. The first
+    caller commits every pending port in one ovs-vsctl transaction;
+    ports submitted by concurrent spawns while that transaction runs are
+    committed together in the next one. If a combined transaction fails,
+    each caller's ports are retried on their own so that one bad port
+    only fails its own instance.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._committing = False
+        self._lock = threading.Lock()
+
+    def _port_args(self, bridge, dev, iface_id, mac, instance_id):
+        return ['--', '--if-exists', 'del-port', dev,
+                '--', 'add-port', bridge, dev,
+                '--', 'set', 'Interface', dev,
+                'external-ids:iface-id=%s' % iface_id,
+                'external-ids:iface-status=active',
+                'external-ids:attached-mac=%s' % mac,
+                'external-ids:vm-uuid=%s' % instance_id]
+
+    def _ovs_vsctl(self, ports):
+        args = ['--timeout=%s' % CONF.ovs_vsctl_timeout]
+        for port in ports:
+            args.extend(self._port_args(*port))
+        try:
+            privhelper.ovs_vsctl(args)
+        except Exception as ex:
+            LOG.error(_LE('Unable to execute %(cmd)s. Exception: '
+                          '%(exception)s'),
+                      {'cmd': ['ovs-vsctl'] + args, 'exception': ex})
+            raise exception.OvsConfigurationFailure(inner_exception=ex)
+
+    def _commit(self, batch):
+        try:
+            self._ovs_vsctl([port for ports, done in batch
+                             for port in ports])
+        except exception.OvsConfigurationFailure as ex:
+            if len(batch) == 1:
+                batch[0][1].send_exception(ex)
+                return
+            for ports, done in batch:
+                try:
+                    self._ovs_vsctl(ports)
+                except exception.OvsConfigurationFailure as ex:
+                    done.send_exception(ex)
+                else:
+                    done.send(None)
+        else:
+            for ports, done in batch:
+                done.send(None)
+
+    def add_ports(self, ports):
+        """Create OVS ports and wait until they are committed.
+
+        :param ports: list of (bridge, dev, iface_id, mac, instance_id)
+        """
+        done = event.Event()
+        with self._lock:
+            self._pending.append((ports, done))
+            leader = not self._committing
+            self._committing = True
+
+        while leader:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._committing = False
+                    break
+            self._commit(batch)
+
+        return done.wait()
+
+
+OVS_PORTS = LXDOvsPortTransaction()
+
+
 class LXDGenericDriver(object):
 
     def _get_vif_driver(self, vif):
@@ -51,11 +140,26 @@ class LXDGenericDriver(object):
         vif_driver = self._get_vif_driver(vif)
         vif_driver.unplug(instance, vif)
 
+    def plug_vifs(self, instance, network_info):
+        """Plug every vif of an instance.
+
+        The host devices of all OVS vifs are set up together so that an
+        instance costs one privileged call however many vifs it has.
+        """
+        ovs_vifs = []
+        for vif in network_info:
+            vif_driver = self._get_vif_driver(vif)
+            if isinstance(vif_driver, LXDOpenVswitchDriver):
+                ovs_vifs.append(vif)
+            else:
+                vif_driver.plug(instance, vif)
+        if ovs_vifs:
+            LXDOpenVswitchDriver().plug_vifs(instance, ovs_vifs)
+
 
 class LXDOpenVswitchDriver(object):
 
     def plug(self, instance, vif, port='ovs'):
-        iface_id = self._get_ovs_interfaceid(vif)
         br_name = self._get_br_name(vif['id'])
         v1_name, v2_name = self._get_veth_pair_names(vif['id'])
 
@@ -74,13 +178,94 @@ class LXDOpenVswitchDriver(object):
             linux_net._create_veth_pair(v1_name, v2_name)
             utils.execute('ip', 'link', 'set', br_name, 'up', run_as_root=True)
             utils.execute('brctl', 'addif', br_name, v1_name, run_as_root=True)
-            if port == 'ovs':
-                linux_net.create_ovs_vif_port(self._get_bridge_name(vif),
-                                              v2_name, iface_id,
-                                              vif['address'], instance.uuid)
-            elif port == 'ivs':
-                linux_net.create_ivs_vif_port(v2_name, iface_id,
-                                              vif['address'], instance.uuid)
+            self._create_port(instance, vif, port)
+
+    def _get_plug_commands(self, vif):
+        """Return the ip(8) batch commands that set up a vif's devices."""
+        br_name = self._get_br_name(vif['id'])
+        v1_name, v2_name = self._get_veth_pair_names(vif['id'])
+
+        commands = []
+        if not linux_net.device_exists(br_name):
+            commands.append('link add name %s type bridge forward_delay 0 '
+                            'stp_state 0 mcast_snooping 0' % br_name)
+        if not linux_net.device_exists(v2_name):
+            commands.append('link add %s type veth peer name %s'
+                            % (v1_name, v2_name))
+            for dev in (v1_name, v2_name):
+                commands.append('link set %s up promisc on' % dev)
+                if CONF.network_device_mtu:
+                    commands.append('link set %s mtu %s'
+                                    % (dev, CONF.network_device_mtu))
+            commands.append('link set %s up' % br_name)
+            commands.append('link set %s master %s' % (v1_name, br_name))
+        return commands
+
+    def _get_added_devices(self, commands):
+        """Return the devices that ip(8) batch commands add."""
+        devices = []
+        for command in commands:
+            words = command.split()
+            if words[:3] == ['link', 'add', 'name']:
+                devices.append(words[3])
+            elif words[:2] == ['link', 'add']:
+                devices.append(words[2])
+        return devices
+
+    def plug_vifs(self, instance, vifs, port='ovs'):
+        """Plug several vifs with a single ip(8) batch.
+
+        Falls back to plugging them one at a time with the individual
+        commands if the batch fails, for example with an iproute2 that
+        does not know the bridge options.
+        """
+        commands = []
+        new_ports = []
+        for vif in vifs:
+            vif_commands = self._get_plug_commands(vif)
+            commands.extend(vif_commands)
+            v1_name, v2_name = self._get_veth_pair_names(vif['id'])
+            if any(command.startswith('link add %s ' % v1_name)
+                   for command in vif_commands):
+                new_ports.append(vif)
+
+        if commands:
+            try:
+                privhelper.ip_batch(commands)
+            except processutils.ProcessExecutionError as ex:
+                LOG.warning(_LW('Batched vif plugging failed, plugging '
+                                'vifs one by one: %s'), ex,
+                            instance=instance)
+                # ip -batch stops at the first failing command; plug()
+                # skips existing devices, so remove what got created.
+                for dev in reversed(self._get_added_devices(commands)):
+                    linux_net.delete_net_dev(dev)
+                for vif in vifs:
+                    self.plug(instance, vif, port)
+                return
+
+        if port == 'ovs':
+            if new_ports:
+                OVS_PORTS.add_ports(
+                    [(self._get_bridge_name(vif),
+                      self._get_veth_pair_names(vif['id'])[1],
+                      self._get_ovs_interfaceid(vif),
+                      vif['address'], instance.uuid) for vif in new_ports])
+            return
+
+        for vif in new_ports:
+            self._create_port(instance, vif, port)
+
+    def _create_port(self, instance, vif, port):
+        iface_id = self._get_ovs_interfaceid(vif)
+        v1_name, v2_name = self._get_veth_pair_names(vif['id'])
+        if port == 'ovs':
+            linux_net.create_ovs_vif_port(self._get_bridge_name(vif),
+                                          v2_name, iface_id,
+                                          vif['address'], instance.uuid)
+        elif port == 'ivs':
+            linux_net.create_ivs_vif_port(v2_name, iface_id,
+                                          vif['address'], instance.uuid)
 
     def unplug(self, instance, vif):
         try:
@@ -35,6 +35,26 @@ class MockConf(mock.Mock):
             'default_profile': 'fake_profile',
             'root_dir': '/fake/lxd/root',
             'timeout': 20,
+            'operation_timeout': 600,
+            'pool_size': 8,
+            'pool_idle_timeout': 60,
+            'state_cache_ttl': 5,
+            'cgroup_root': '/fake/cgroup',
+            'usage_cache_ttl': 5,
+            'metrics_interval': 0,
+            'metrics_history': 10,
+            'use_privhelper': False,
+            'bulk_concurrency': 4,
+            'host_action_timeout': 600,
+            'live_migration_timeout': 1800,
+            'live_migration_progress_interval': 10,
+            'migration_transfer': 'websocket',
+            'migration_compression': 'none',
+            'migration_compression_level': 6,
+            'migration_bandwidth_mb': 0,
+            'live_snapshots': False,
+            'incremental_snapshots': False,
+            'snapshot_full_every': 7,
         }
         lxd_default.update(lxd_kwargs)
         self.lxd = mock.Mock(lxd_args, **lxd_default)
@@ -54,11 +74,26 @@ class MockInstance(mock.Mock):
         self.flavor = mock.Mock(memory_mb=memory_mb, vcpus=vcpus)
 
 
+def _get_object(method, path, *args, **kwargs):
+    # Operations waited on succeed; everything else gets the return value.
+    if path.startswith('/1.0/operations/'):
+        return (200, {'metadata': {'status_code': 200}})
+    return mock.DEFAULT
+
+
 def lxd_mock(*args, **kwargs):
     default = {
         'profile_list.return_value': ['fake_profile'],
         'container_list.return_value': ['mock-instance-1', 'mock-instance-2'],
+        'connection.get_object.return_value': (
+            200, {'metadata': [{'name': 'mock-instance-1',
+                                'status': {'status': 'RUNNING'}},
+                               {'name': 'mock-instance-2',
+                                'status': {'status': 'STOPPED'}},
+                               {'name': 'mock-instance-2-rescue',
+                                'status': {'status': 'RUNNING'}}]}),
         'host_ping.return_value': True,
+        'connection.get_object.side_effect': _get_object,
     }
     default.update(kwargs)
     return mock.Mock(*args, **default)
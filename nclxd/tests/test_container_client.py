@@ -0,0 +1,266 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+
+import eventlet
+import mock
+from six.moves import http_client
+
+from nova import exception
+from nova import test
+from pylxd import exceptions as lxd_exceptions
+
+from nclxd.nova.virt.lxd import container_client
+from nclxd import tests
+
+
+@mock.patch.object(container_client, 'CONF', tests.MockConf())
+class LXDTestConnectionPool(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestConnectionPool, self).setUp()
+        self.ma = mock.Mock(side_effect=lambda *args, **kwargs:
+                            tests.lxd_mock())
+        lxd_patcher = mock.patch('pylxd.api.API', self.ma)
+        lxd_patcher.start()
+        self.addCleanup(lxd_patcher.stop)
+
+        self.pool = container_client.LXDConnectionPool()
+
+    def test_reuse(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.ma.assert_called_once_with()
+
+    def test_keyed_by_host(self):
+        with self.pool.connection() as local:
+            pass
+        with self.pool.connection('fake-host') as remote:
+            pass
+        self.assertIsNot(local, remote)
+        self.assertEqual([mock.call(), mock.call(host='fake-host')],
+                         self.ma.call_args_list)
+
+    def test_connect_fail(self):
+        self.ma.side_effect = lxd_exceptions.APIError('Fake', 500)
+        self.assertRaises(exception.NovaException,
+                          self.pool.get, 'fake-host')
+
+    @mock.patch('time.time')
+    def test_idle_eviction(self, mt):
+        mt.return_value = 0
+        with self.pool.connection() as first:
+            first.connection.get_connection()
+        mt.return_value = 61
+        with self.pool.connection() as second:
+            pass
+        self.assertIsNot(first, second)
+        first.connection.get_connection.connect.return_value.close.\
+            assert_called_once_with()
+
+    def test_max_size(self):
+        connections = [self.pool.get() for i in range(10)]
+        for lxd_client in connections:
+            self.pool.put(None, lxd_client)
+        self.assertEqual(8, len(self.pool._idle[None]))
+
+    def test_discard_on_error(self):
+        clients = []
+
+        def fail():
+            with self.pool.connection() as lxd_client:
+                clients.append(lxd_client)
+                lxd_client.connection.get_connection()
+                raise IOError()
+
+        self.assertRaises(IOError, fail)
+        self.assertEqual({}, dict(self.pool._idle))
+        clients[0].connection.get_connection.connect.return_value.close.\
+            assert_called_once_with()
+
+    def test_discard_on_kill(self):
+        clients = []
+
+        def borrow():
+            with self.pool.connection() as lxd_client:
+                clients.append(lxd_client)
+                lxd_client.connection.get_connection()
+                eventlet.sleep(10)
+
+        thread = eventlet.spawn(borrow)
+        eventlet.sleep(0)
+        thread.kill()
+        self.assertEqual({}, dict(self.pool._idle))
+        clients[0].connection.get_connection.connect.return_value.close.\
+            assert_called_once_with()
+
+    def test_keep_on_api_error(self):
+        def fail():
+            with self.pool.connection():
+                raise exception.NovaException()
+
+        self.assertRaises(exception.NovaException, fail)
+        self.assertEqual(1, len(self.pool._idle[None]))
+
+
+class LXDTestKeepAlive(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestKeepAlive, self).setUp()
+        self.server, client = socket.socketpair()
+        self.addCleanup(self.server.close)
+        self.conn = http_client.HTTPConnection('localhost')
+        self.conn.sock = client
+        self.addCleanup(self.conn.close)
+        self.connect = mock.Mock(return_value=self.conn)
+        self.keep_alive = container_client.LXDKeepAlive(self.connect)
+
+    def test_reuse(self):
+        self.assertIs(self.conn, self.keep_alive())
+        self.assertIs(self.conn, self.keep_alive())
+        self.connect.assert_called_once_with()
+        self.assertIsNotNone(self.conn.sock)
+
+    def test_closed_by_peer(self):
+        self.keep_alive()
+        self.server.close()
+        self.assertIs(self.conn, self.keep_alive())
+        self.assertIsNone(self.conn.sock)
+        self.connect.assert_called_once_with()
+
+    def test_response_pending(self):
+        self.keep_alive()
+        self.conn.putrequest('GET', '/1.0')
+        self.assertIs(self.conn, self.keep_alive())
+        self.assertIsNone(self.conn.sock)
+
+    def test_close(self):
+        self.keep_alive()
+        self.keep_alive.close()
+        self.assertIsNone(self.conn.sock)
+        self.keep_alive()
+        self.assertEqual(2, self.connect.call_count)
+
+
+@mock.patch.object(container_client, 'CONF', tests.MockConf())
+class LXDTestContainerClientBulk(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestContainerClientBulk, self).setUp()
+        self.ml = tests.lxd_mock()
+        lxd_patcher = mock.patch('pylxd.api.API',
+                                 mock.Mock(return_value=self.ml))
+        lxd_patcher.start()
+        self.addCleanup(lxd_patcher.stop)
+        events_patcher = mock.patch.object(
+            container_client.container_events, 'get_listener',
+            mock.Mock(return_value=None))
+        events_patcher.start()
+        self.addCleanup(events_patcher.stop)
+        container_client.POOL.clear()
+        self.addCleanup(container_client.POOL.clear)
+
+        self.client = container_client.LXDContainerClient()
+
+    def test_client_many(self):
+        error = lxd_exceptions.APIError('Fake', 500)
+        self.ml.container_stop.side_effect = [(200, {}), error, (200, {})]
+        results = self.client.client_many('stop', ['one', 'bad', 'two'])
+        self.assertEqual(['bad', 'one', 'two'], sorted(results))
+        self.assertEqual(((200, {}), None), results['one'])
+        self.assertEqual(((200, {}), None), results['two'])
+        self.assertIsNone(results['bad'][0])
+        self.assertIsInstance(results['bad'][1], exception.NovaException)
+
+    @mock.patch.object(container_client, 'STATES',
+                       container_client.LXDContainerStateCache())
+    def test_client_invalidates_after_call(self):
+        def stop(*args):
+            # A periodic task refreshing the states during the stop.
+            container_client.STATES.get()
+            return (200, {})
+
+        self.ml.container_stop.side_effect = stop
+        self.client.client('stop', instance='mock-instance-1', host=None)
+        self.assertEqual({}, container_client.STATES._states)
+
+    def test_client_async(self):
+        self.ml.container_defined.return_value = True
+        thread = self.client.client_async('defined', instance='fake',
+                                          host=None)
+        self.assertTrue(thread.wait())
+        self.ml.container_defined.assert_called_once_with('fake')
+
+
+@mock.patch.object(container_client, 'CONF', tests.MockConf())
+class LXDTestContainerWait(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestContainerWait, self).setUp()
+        self.ml = tests.lxd_mock()
+        self.listener = mock.Mock(connected=True)
+        events_patcher = mock.patch.object(
+            container_client.container_events, 'get_listener',
+            mock.Mock(return_value=self.listener))
+        events_patcher.start()
+        self.addCleanup(events_patcher.stop)
+        self.client = container_client.LXDContainerClient()
+
+    def _wait(self):
+        return self.client.container_wait(self.ml, oid='fake-op', host=None)
+
+    def test_wait_event(self):
+        self.listener.wait.return_value = {'status_code': 200}
+        self._wait()
+        self.listener.wait.assert_called_once_with('fake-op', 600)
+        self.assertFalse(self.ml.connection.get_object.called)
+
+    def test_wait_event_failed(self):
+        self.listener.wait.return_value = {'status_code': 400,
+                                           'err': 'fake'}
+        self.assertRaises(exception.NovaException, self._wait)
+
+    def test_wait_event_timeout(self):
+        self.listener.wait.return_value = None
+        self.assertRaises(container_client.container_utils.
+                          LXDOperationTimeout, self._wait)
+        self.assertFalse(self.ml.connection.get_object.called)
+
+    def test_wait_stream_lost(self):
+        self.listener.wait.side_effect = (
+            container_client.container_events.LXDEventStreamLost())
+        self._wait()
+        self.ml.connection.get_object.assert_called_once_with(
+            'GET', '/1.0/operations/fake-op/wait?timeout=600')
+
+    def test_poll_still_running(self):
+        self.listener.connected = False
+        self.ml.connection.get_object.side_effect = None
+        self.ml.connection.get_object.return_value = (
+            200, {'metadata': {'status_code': 103}})
+        self.assertRaises(container_client.container_utils.
+                          LXDOperationTimeout, self._wait)
+        self.assertFalse(self.listener.wait.called)
+
+    def test_poll_failed(self):
+        self.listener.connected = False
+        self.ml.connection.get_object.side_effect = None
+        self.ml.connection.get_object.return_value = (
+            200, {'metadata': {'status_code': 400, 'err': 'fake'}})
+        self.assertRaises(exception.NovaException, self._wait)
@@ -82,6 +82,32 @@ class LXDTestContainerConfig(test.NoDBTestCase):
             self.container_config.configure_container_config({},
                                                              instance))
 
+    @mock.patch.object(container_config.container_usage.USAGE,
+                       'invalidate')
+    def test_update_container_limits(self, mi):
+        instance = tests.MockInstance(memory_mb=1024, vcpus=2)
+        mc = mock.Mock()
+        mc.client.side_effect = [
+            {'config': {'limits.memory': '536870912',
+                        'limits.cpus': '1',
+                        'raw.lxc': 'fake'},
+             'devices': {'eth0': {'type': 'nic'}},
+             'profiles': ['fake_profile', 'extra']},
+            None]
+        self.container_config.container_client = mc
+        self.container_config.update_container_limits(instance)
+        mc.client.assert_called_with(
+            'update', instance='fake-uuid',
+            container_config={
+                'config': {'limits.memory': '1073741824',
+                           'limits.cpus': '2',
+                           'raw.lxc': 'fake'},
+                'devices': {'eth0': {'type': 'nic'}},
+                'profiles': ['fake_profile', 'extra']},
+            host=None)
+        self.assertEqual(2, mc.client.call_count)
+        mi.assert_called_once_with()
+
     def test_configure_network_devices(self):
         instance = tests.MockInstance()
         network_info = (
@@ -177,3 +203,31 @@ class LXDTestContainerConfig(test.NoDBTestCase):
              '/fake/instances/path/fake-uuid/config-drive'))
         mi.assert_called_once_with(
             instance, content=injected_files, extra_md={})
+
+    @mock.patch('oslo_utils.fileutils.ensure_tree', mock.Mock())
+    @mock.patch.object(container_config, 'configdrive')
+    @mock.patch.object(
+        container_config, 'driver',
+        mock.Mock(swap_is_usable=mock.Mock(return_value=False)))
+    def test_create_container_single_request(self, mcd):
+        instance = tests.MockInstance()
+        network_info = [{'id': '0123456789abcdef',
+                         'address': '00:11:22:33:44:55'}]
+        mcd.required_by.return_value = True
+        with mock.patch.object(self.container_config,
+                               'container_client') as mc, (
+                mock.patch.object(self.container_config, 'img_driver')), (
+                mock.patch.object(self.container_config,
+                                  'make_configdrive')) as mm:
+            mc.client.return_value = (
+                200, {'operation': '/1.0/operations/0123456789'})
+            config = self.container_config.create_container(
+                {}, instance, {}, [], 'secret', network_info, None,
+                'fake-uuid-rescue', True)
+            mm.assert_called_once_with(instance, [], 'secret')
+            self.assertEqual(
+                [mock.call('init', container_config=config, host=None),
+                 mock.call('wait', oid='0123456789', host=None)],
+                mc.client.call_args_list)
+        self.assertEqual(['configdrive', 'qbr0123456789a', 'rescue'],
+                         sorted(config['devices']))
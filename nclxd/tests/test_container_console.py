@@ -0,0 +1,111 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+
+import fixtures
+import mock
+from nova import test
+
+from nclxd.nova.virt.lxd import container_console
+from nclxd.nova.virt.lxd import privhelper
+from nclxd import tests
+
+
+@mock.patch.object(privhelper, 'CONF', tests.MockConf())
+class LXDTestConsoleLog(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestConsoleLog, self).setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(self.tempdir, 'console.log')
+        self.log = container_console.LXDConsoleLog(self.path, 10)
+
+    def _write(self, data, mode='ab'):
+        with open(self.path, mode) as fp:
+            fp.write(data)
+
+    def test_read_tail(self):
+        self._write(b'0123456789abcdef')
+        self.assertEqual((b'6789abcdef', 16), self.log.read())
+
+    def test_read_since(self):
+        self._write(b'boot\n')
+        self.assertEqual((b'boot\n', 5), self.log.read())
+        self._write(b'login:')
+        self.assertEqual((b'login:', 11), self.log.read(since=5))
+        self.assertEqual((b'', 11), self.log.read(since=11))
+        self.assertEqual((b'ot\nlogin:', 11), self.log.read(since=2))
+        # Offsets that are no longer buffered return the whole tail.
+        self.assertEqual((b'oot\nlogin:', 11), self.log.read(since=0))
+
+    def test_read_incremental(self):
+        self._write(b'01234')
+        self.log.read()
+        with mock.patch.object(self.log, '_read_direct',
+                               wraps=self.log._read_direct) as mr:
+            self._write(b'56789abc')
+            self.assertEqual((b'3456789abc', 13), self.log.read())
+            mr.assert_called_once_with(5)
+        self.assertEqual(3, self.log.start)
+
+    def test_rotated(self):
+        self._write(b'old log data')
+        self.log.read()
+        os.rename(self.path, self.path + '.1')
+        self._write(b'new log data that is longer', 'wb')
+        self.assertEqual((b' is longer', 27), self.log.read())
+
+    def test_truncated(self):
+        self._write(b'0123456789')
+        self.log.read()
+        self._write(b'abc', 'wb')
+        self.assertEqual((b'abc', 3), self.log.read())
+
+    @mock.patch.object(privhelper, 'chmod')
+    @mock.patch.object(privhelper, 'chown')
+    def test_make_readable(self, mc, mm):
+        self._write(b'console')
+        real_open = open
+        with mock.patch('six.moves.builtins.open') as mo:
+            mo.side_effect = [IOError(errno.EACCES, 'denied'),
+                              real_open(self.path, 'rb')]
+            self.assertEqual((b'console', 7), self.log.read())
+        mc.assert_called_once_with(self.path, os.getuid(), os.getgid())
+        mm.assert_called_once_with(self.tempdir, 0o755)
+
+    def test_privhelper(self):
+        with mock.patch.object(privhelper, 'read_console') as mr:
+            mr.return_value = {'data': b'console', 'offset': 0,
+                               'size': 7, 'inode': 42}
+            self.assertEqual((b'console', 7), self.log.read())
+            mr.return_value = {'data': b'!', 'offset': 7,
+                               'size': 8, 'inode': 42}
+            self.assertEqual((b'!', 8), self.log.read(since=7))
+        self.assertEqual([mock.call(self.path, 10, None),
+                          mock.call(self.path, 10, 7)],
+                         mr.call_args_list)
+
+
+class LXDTestConsoleLogs(test.NoDBTestCase):
+
+    def test_get_forget(self):
+        logs = container_console.LXDConsoleLogs()
+        log = logs.get('fake-uuid', '/fake/console.log', 10)
+        self.assertIs(log, logs.get('fake-uuid', '/fake/console.log', 10))
+        logs.forget('fake-uuid')
+        self.assertIsNot(log, logs.get('fake-uuid', '/fake/console.log',
+                                       10))
@@ -0,0 +1,64 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+
+from nova import test
+
+from nclxd.nova.virt.lxd import container_events
+
+
+class LXDTestEventListener(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestEventListener, self).setUp()
+        self.listener = container_events.LXDEventListener()
+
+    def _event(self, oid, status_code=200):
+        return {'type': 'operation',
+                'metadata': {'id': oid, 'status_code': status_code}}
+
+    def test_wait_finished(self):
+        waiter = eventlet.spawn(self.listener.wait, 'fake-op', 10)
+        eventlet.sleep(0)
+        self.listener._dispatch(self._event('fake-op', 103))
+        self.listener._dispatch(self._event('fake-op'))
+        self.assertEqual({'id': 'fake-op', 'status_code': 200},
+                         waiter.wait())
+
+    def test_wait_already_finished(self):
+        self.listener._dispatch(self._event('fake-op', 400))
+        self.assertEqual({'id': 'fake-op', 'status_code': 400},
+                         self.listener.wait('fake-op', 10))
+        self.assertEqual({}, self.listener._finished)
+
+    def test_wait_timeout(self):
+        self.assertIsNone(self.listener.wait('fake-op', 0.01))
+        self.assertEqual({}, self.listener._waiters)
+
+    def test_wait_stream_lost(self):
+        waiter = eventlet.spawn(self.listener.wait, 'fake-op', 10)
+        eventlet.sleep(0)
+        self.listener._release_waiters()
+        self.assertRaises(container_events.LXDEventStreamLost, waiter.wait)
+
+    def test_ignore_other_events(self):
+        self.listener._dispatch({'type': 'logging', 'metadata': {}})
+        self.assertEqual({}, self.listener._finished)
+
+    @mock.patch.object(container_events, 'websocket', None)
+    def test_no_websocket(self):
+        self.assertIsNone(container_events.get_listener())
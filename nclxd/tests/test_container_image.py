@@ -13,13 +13,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import tarfile
+
 from nova import exception
 from nova import test
 from pylxd import exceptions as lxd_exceptions
 
 import ddt
+import fixtures
 import mock
+import six
 
+from nclxd.nova.virt.lxd import constants
 from nclxd.nova.virt.lxd import container_image
 from nclxd.nova.virt.lxd import container_utils
 from nclxd import tests
@@ -165,3 +171,146 @@ class LXDTestContainerImage(test.NoDBTestCase):
                 {'name': 'new_image',
                  'target': '6105d6cc76af400325e94d588ce511be'
                  '5bfdbb73b437dc51eca43917d7a43e3d'})
+
+
+class LXDTestMultipartReader(test.NoDBTestCase):
+
+    def _reader(self):
+        return container_image.MultipartReader(
+            'fake-boundary',
+            [('metadata', 'meta.tar.xz', six.BytesIO(b'meta'), 4),
+             ('rootfs', 'root.tar.xz', six.BytesIO(b'rootfs'), 6)])
+
+    expected = (b'--fake-boundary\r\n'
+                b'Content-Disposition: form-data; '
+                b'name=metadata; filename=meta.tar.xz\r\n'
+                b'Content-Type: application/octet-stream\r\n'
+                b'\r\n'
+                b'meta\r\n'
+                b'--fake-boundary\r\n'
+                b'Content-Disposition: form-data; '
+                b'name=rootfs; filename=root.tar.xz\r\n'
+                b'Content-Type: application/octet-stream\r\n'
+                b'\r\n'
+                b'rootfs\r\n'
+                b'--fake-boundary--\r\n'
+                b'\r\n')
+
+    def test_read_all(self):
+        reader = self._reader()
+        self.assertEqual(len(self.expected), len(reader))
+        self.assertEqual(self.expected, reader.read())
+
+    def test_read_chunks(self):
+        reader = self._reader()
+        chunks = []
+        while True:
+            chunk = reader.read(5)
+            if not chunk:
+                break
+            self.assertTrue(len(chunk) <= 5)
+            chunks.append(chunk)
+        self.assertEqual(self.expected, b''.join(chunks))
+
+    def test_truncated(self):
+        reader = container_image.MultipartReader(
+            'fake-boundary',
+            [('rootfs', 'root.tar.xz', six.BytesIO(b'root'), 6)])
+        self.assertRaises(IOError, reader.read)
+
+
+class LXDTestStreamImageContents(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestStreamImageContents, self).setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir()).path
+        self.container_image = container_image.LXDContainerImage()
+
+    def _make_image(self, members):
+        path = os.path.join(self.tempdir, 'image.tar.gz')
+        with tarfile.open(path, 'w:gz') as tar:
+            for name, data in members:
+                tar_info = tarfile.TarInfo(name)
+                tar_info.size = len(data)
+                tar.addfile(tar_info, six.BytesIO(data))
+        return path
+
+    def test_stream(self):
+        path = self._make_image([('image-root.tar.xz', b'rootfs'),
+                                 ('image-lxd.tar.xz', b'meta')])
+        uploaded = {}
+
+        def upload(parts, filename):
+            for name, member, fileobj, size in parts:
+                uploaded[name] = (member, fileobj.read(), size)
+            return {'metadata': {'fingerprint': 'fake'}}
+
+        with mock.patch.object(container_image, 'images_upload_parts',
+                               side_effect=upload):
+            self.assertEqual(
+                {'metadata': {'fingerprint': 'fake'}},
+                self.container_image._stream_image_contents(path))
+        self.assertEqual(
+            {'metadata': ('image-lxd.tar.xz', b'meta', 4),
+             'rootfs': ('image-root.tar.xz', b'rootfs', 6)},
+            uploaded)
+        self.assertEqual(['image.tar.gz'], os.listdir(self.tempdir))
+
+    def test_stream_missing_member(self):
+        path = self._make_image([('image-root.tar.xz', b'rootfs')])
+        self.assertRaises(tarfile.TarError,
+                          self.container_image._stream_image_contents,
+                          path)
+
+
+@mock.patch.object(container_utils, 'CONF', tests.MockConf())
+class LXDTestImageChain(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestImageChain, self).setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir()).path
+        self.container_image = container_image.LXDContainerImage()
+
+    def _make_layer(self, name, members):
+        path = os.path.join(self.tempdir, name)
+        with tarfile.open(path, 'w:gz') as tar:
+            for member, data in members:
+                tar_info = tarfile.TarInfo(member)
+                tar_info.size = len(data)
+                tar.addfile(tar_info, six.BytesIO(data))
+        return path
+
+    def test_merge_image_chain(self):
+        whiteouts = constants.WHITEOUTS
+        layers = [
+            self._make_layer('full', [('metadata.yaml', b'meta'),
+                                      ('rootfs/etc/a', b'a0'),
+                                      ('rootfs/etc/b', b'b0'),
+                                      ('rootfs/var/c', b'c0')]),
+            self._make_layer('delta1', [(whiteouts, b'var\0'),
+                                        ('rootfs/etc/a', b'a1'),
+                                        ('rootfs/var/d', b'd1')]),
+            self._make_layer('delta2', [(whiteouts, b'etc/b\0'),
+                                        ('rootfs/etc/a', b'a2')]),
+        ]
+        target = os.path.join(self.tempdir, 'merged.tar.gz')
+
+        container_image.merge_image_chain(layers, target)
+        with tarfile.open(target) as tar:
+            self.assertEqual(
+                {'metadata.yaml': b'meta',
+                 'rootfs/etc/a': b'a2',
+                 'rootfs/var/d': b'd1'},
+                dict((name, tar.extractfile(name).read())
+                     for name in tar.getnames()))
+
+    @mock.patch.object(container_image, 'IMAGE_API')
+    def test_fetch_image_chain_loop(self, mi):
+        instance = tests.MockInstance(image_ref='image-2')
+        mi.get.return_value = {'id': 'image-1',
+                               'properties': {'lxd_parent': 'image-2'}}
+        self.assertRaises(
+            exception.ImageUnacceptable,
+            self.container_image._fetch_image_chain, {}, instance,
+            {'id': 'image-2', 'properties': {'lxd_parent': 'image-1'}})
+        self.assertFalse(mi.download.called)
@@ -0,0 +1,287 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+import eventlet
+import mock
+from nova.compute import task_states
+from nova import exception
+from nova import objects
+from nova import test
+from nova.virt import fake
+
+from nclxd.nova.virt.lxd import container_migrate
+from nclxd import tests
+
+
+class LXDTestMigrateBase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestMigrateBase, self).setUp()
+        with mock.patch('pylxd.api.API'):
+            self.migrate = container_migrate.LXDContainerMigrate(
+                fake.FakeVirtAPI())
+        self.mc = mock.Mock()
+        self.migrate.container_client = self.mc
+        self.mconf = mock.Mock()
+        self.migrate.container_config = self.mconf
+
+
+@mock.patch.object(container_migrate, 'CONF', tests.MockConf())
+class LXDTestLiveMigration(LXDTestMigrateBase):
+
+    def setUp(self):
+        super(LXDTestLiveMigration, self).setUp()
+        self.mconf.configure_container_live_migrate.return_value = {
+            'name': 'fake-uuid',
+            'source': {
+                'type': 'migration',
+                'mode': 'pull',
+                'operation': 'wss://1.2.3.4:8443/1.0/operations/'
+                             'source-op/websocket',
+                'secrets': {'control': 'c', 'fs': 'f', 'criu': 'r'}}}
+        self.mc.client.return_value = (
+            200, {'operation': '/1.0/operations/dest-op'})
+        self.instance = tests.MockInstance()
+        self.instance.info_cache.network_info = []
+        self.post = mock.Mock()
+        self.recover = mock.Mock()
+
+    def _live_migration(self):
+        self.migrate.live_migration(mock.sentinel.context, self.instance,
+                                    'dest-host', self.post, self.recover)
+
+    def test_live_migration(self):
+        self.mc.client_async.return_value = eventlet.spawn(lambda: None)
+        self._live_migration()
+        self.mc.client.assert_called_once_with(
+            'init',
+            container_config=(
+                self.mconf.configure_container_live_migrate.return_value),
+            host='dest-host')
+        self.mc.client_async.assert_called_once_with(
+            'wait', oid='dest-op', host='dest-host', timeout=1800)
+        self.post.assert_called_once_with(
+            mock.sentinel.context, self.instance, 'dest-host', False, None)
+        self.assertFalse(self.recover.called)
+
+    def test_live_migration_fail(self):
+        def fail():
+            raise exception.NovaException()
+
+        self.mc.client_async.return_value = eventlet.spawn(fail)
+        self.assertRaises(exception.NovaException, self._live_migration)
+        self.mc.client.assert_called_with('cancel', oid='source-op',
+                                          host=None)
+        self.recover.assert_called_once_with(
+            mock.sentinel.context, self.instance, 'dest-host', False, None)
+        self.assertFalse(self.post.called)
+
+    @mock.patch.object(container_migrate, 'CONF', tests.MockConf(
+        lxd_kwargs={'live_migration_timeout': 0,
+                    'live_migration_progress_interval': 0.01}))
+    def test_live_migration_timeout(self):
+        waiter = eventlet.spawn(eventlet.sleep, 10)
+        self.mc.client_async.return_value = waiter
+        self.assertRaises(exception.MigrationError, self._live_migration)
+        self.assertTrue(waiter.dead)
+        self.mc.client.assert_called_with('cancel', oid='source-op',
+                                          host=None)
+        self.assertTrue(self.recover.called)
+
+    def test_pre_live_migration(self):
+        with mock.patch.object(self.migrate.container_ops,
+                               'plug_vifs') as mp:
+            self.assertEqual(
+                {},
+                self.migrate.pre_live_migration(
+                    mock.sentinel.context, self.instance, None,
+                    mock.sentinel.network_info))
+        mp.assert_called_once_with(None, self.instance,
+                                   mock.sentinel.network_info)
+
+    def test_post_live_migration(self):
+        self.migrate.post_live_migration(mock.sentinel.context,
+                                         self.instance, None)
+        self.assertEqual(
+            [mock.call('stop', instance='fake-uuid', host=None),
+             mock.call('destroy', instance='fake-uuid', host=None)],
+            self.mc.client.call_args_list)
+
+    def test_check_can_live_migrate_source(self):
+        self.mc.client.return_value = False
+        self.assertRaises(exception.InstanceNotFound,
+                          self.migrate.check_can_live_migrate_source,
+                          mock.sentinel.context, self.instance, {})
+
+
+@mock.patch.object(container_migrate, 'CONF', tests.MockConf(host='fake-host'))
+class LXDTestResize(LXDTestMigrateBase):
+
+    def setUp(self):
+        super(LXDTestResize, self).setUp()
+        self.instance = tests.MockInstance(memory_mb=2048, vcpus=2)
+
+    def test_migrate_disk_and_power_off_same_host(self):
+        self.assertEqual(
+            '',
+            self.migrate.migrate_disk_and_power_off(
+                mock.sentinel.context, self.instance, '1.2.3.4',
+                self.instance.flavor, []))
+        self.assertFalse(self.mc.client.called)
+        self.assertFalse(self.mconf.configure_container_migrate.called)
+
+    def test_finish_migration_same_host(self):
+        migration = mock.Mock(source_compute='fake-host',
+                              dest_compute='fake-host')
+        with mock.patch.object(self.migrate.container_ops,
+                               'start_instance') as ms:
+            self.migrate.finish_migration(
+                mock.sentinel.context, migration, self.instance, '', [],
+                {}, resize_instance=True)
+        self.mconf.update_container_limits.assert_called_once_with(
+            self.instance)
+        self.assertFalse(ms.called)
+
+    def test_finish_revert_migration(self):
+        self.mc.client.return_value = True
+        with mock.patch.object(self.migrate.container_ops,
+                               'start_instance') as ms:
+            self.migrate.finish_revert_migration(
+                mock.sentinel.context, self.instance, [])
+        self.mconf.update_container_limits.assert_called_once_with(
+            self.instance)
+        self.mc.client.assert_called_once_with(
+            'running', instance='fake-uuid', host=None)
+        self.assertFalse(ms.called)
+
+    @mock.patch.object(objects.Migration, 'get_by_instance_and_status')
+    def test_revert_resize_same_host(self, mg):
+        mg.return_value = mock.Mock(source_compute='fake-host',
+                                    dest_compute='fake-host')
+        self.migrate.container_ops.container_client = self.mc
+        self.mc.client.return_value = True
+        self.instance.task_state = task_states.RESIZE_REVERTING
+        context = mock.Mock()
+        with mock.patch.object(self.migrate.container_ops,
+                               'start_instance') as ms:
+            # What nova's revert_resize does on the destination, which
+            # is this host as well.
+            self.migrate.container_ops.destroy(context, self.instance, [])
+            self.migrate.finish_revert_migration(context, self.instance, [])
+        mg.assert_called_once_with(context.elevated.return_value,
+                                   'fake-uuid', 'reverting')
+        self.mc.client.assert_called_once_with(
+            'running', instance='fake-uuid', host=None)
+        self.mconf.update_container_limits.assert_called_once_with(
+            self.instance)
+        self.assertFalse(ms.called)
+
+    @mock.patch.object(objects.Migration, 'get_by_instance_and_status')
+    def test_revert_resize_other_host(self, mg):
+        mg.return_value = mock.Mock(source_compute='other-host',
+                                    dest_compute='fake-host')
+        self.instance.task_state = task_states.RESIZE_REVERTING
+        with mock.patch.object(self.migrate.container_ops,
+                               'container_client') as mc, \
+                mock.patch.object(self.migrate.container_ops, 'cleanup'):
+            self.migrate.container_ops.destroy(mock.Mock(), self.instance,
+                                               [])
+        mc.client.assert_any_call('destroy', instance='fake-uuid',
+                                  host=None)
+
+    def test_finish_revert_migration_stopped(self):
+        self.mc.client.return_value = False
+        with mock.patch.object(self.migrate.container_ops,
+                               'start_instance') as ms:
+            self.migrate.finish_revert_migration(
+                mock.sentinel.context, self.instance, [])
+        ms.assert_called_once_with(None, self.instance, [])
+
+
+@mock.patch.object(container_migrate, 'CONF', tests.MockConf(
+    lxd_kwargs={'migration_transfer': 'image',
+                'migration_compression': 'bzip2',
+                'migration_compression_level': 9,
+                'migration_bandwidth_mb': 10}))
+class LXDTestImageMigration(LXDTestMigrateBase):
+
+    def setUp(self):
+        super(LXDTestImageMigration, self).setUp()
+        self.instance = tests.MockInstance()
+        self.export = mock.Mock(bytes_read=2048)
+
+        def client(func, **kwargs):
+            return {
+                'stop': (200, {'operation': '/1.0/operations/stop-op'}),
+                'publish': (200, {'metadata': {'fingerprint': 'source-fp'}}),
+                'image_export': self.export,
+                'image_upload': (
+                    200, {'metadata': {'fingerprint': 'dest-fp'}}),
+                'init': (200, {'operation': '/1.0/operations/init-op'}),
+            }.get(func)
+
+        self.mc.client.side_effect = client
+
+    @mock.patch.object(container_migrate.container_transfer, 'open_stream')
+    def test_migrate_disk_and_power_off(self, mo):
+        mo.return_value = mock.Mock(bytes_read=1024, elapsed=2.0)
+        disk_info = self.migrate.migrate_disk_and_power_off(
+            mock.sentinel.context, self.instance, 'dest-host',
+            self.instance.flavor, mock.sentinel.network_info)
+
+        mo.assert_called_once_with(self.export, 'bzip2', 9, 10 * 1024 * 1024)
+        self.export.close.assert_called_once_with()
+        self.mconf.configure_container_from_image.assert_called_once_with(
+            self.instance, mock.sentinel.network_info, 'dest-fp')
+        calls = [(call[0][0], call[1].get('host'))
+                 for call in self.mc.client.call_args_list]
+        self.assertEqual(
+            [('stop', None), ('wait', None), ('publish', None),
+             ('image_export', None), ('image_upload', 'dest-host'),
+             ('image_delete', None), ('init', 'dest-host'),
+             ('wait', 'dest-host'), ('image_delete', 'dest-host')],
+            calls)
+        self.assertEqual(
+            {'transfer': {'bytes_exported': 2048, 'bytes_sent': 1024,
+                          'seconds': 2.0, 'rate': 512.0}},
+            json.loads(disk_info))
+
+    @mock.patch.object(container_migrate.container_transfer, 'open_stream')
+    def test_migrate_disk_and_power_off_upload_fail(self, mo):
+        self.mc.client.side_effect = [
+            (200, {'operation': '/1.0/operations/stop-op'}), None,
+            (200, {'metadata': {'fingerprint': 'source-fp'}}), self.export,
+            exception.NovaException(), None]
+        self.assertRaises(exception.NovaException,
+                          self.migrate.migrate_disk_and_power_off,
+                          mock.sentinel.context, self.instance, 'dest-host',
+                          self.instance.flavor, [])
+        self.export.close.assert_called_once_with()
+        self.mc.client.assert_called_with('image_delete',
+                                          fingerprint='source-fp', host=None)
+
+    @mock.patch.object(container_migrate.container_transfer, 'lzma', None)
+    def test_migrate_disk_and_power_off_no_lzma(self):
+        with mock.patch.object(container_migrate, 'CONF', tests.MockConf(
+                lxd_kwargs={'migration_transfer': 'image',
+                            'migration_compression': 'xz'})):
+            self.assertRaises(
+                container_migrate.container_transfer.LXDTransferError,
+                self.migrate.migrate_disk_and_power_off,
+                mock.sentinel.context, self.instance, 'dest-host',
+                self.instance.flavor, [])
+        self.assertFalse(self.mc.client.called)
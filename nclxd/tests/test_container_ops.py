@@ -16,11 +16,13 @@
 import ddt
 import mock
 
+from nova.compute import power_state
 from nova import exception
 from nova import test
 from nova.virt import fake
 from pylxd import exceptions as lxd_exception
 
+from nclxd.nova.virt.lxd import container_client
 from nclxd.nova.virt.lxd import container_ops
 from nclxd.nova.virt.lxd import container_utils
 from nclxd import tests
@@ -39,6 +41,8 @@ class LXDTestContainerOps(test.NoDBTestCase):
                                  mock.Mock(return_value=self.ml))
         lxd_patcher.start()
         self.addCleanup(lxd_patcher.stop)
+        container_client.POOL.clear()
+        self.addCleanup(container_client.POOL.clear)
 
         self.container_ops = (
             container_ops.LXDContainerOperations(fake.FakeVirtAPI()))
@@ -141,22 +145,12 @@ class LXDTestContainerOps(test.NoDBTestCase):
             context, instance, image_meta, 'fake_instance', rescue)
         calls = [
             mock.call.container_init(self.mc.configure_container.return_value),
-            mock.call.wait_container_operation('0123456789', 200, 20)
+            mock.call.connection.get_object(
+                'GET', '/1.0/operations/0123456789/wait?timeout=600')
         ]
         self.assertEqual(calls, self.ml.method_calls[:2])
-        name = rescue and 'fake_instance' or 'fake-uuid'
-        if configdrive:
-            self.ml.container_update.assert_any_call(
-                name,
-                self.mc.configure_container_configdrive.return_value)
-        if network_info:
-            self.ml.container_update.assert_any_call(
-                name,
-                self.mc.configure_network_devices.return_value)
-        if rescue:
-            self.ml.container_update.assert_any_call(
-                name,
-                self.mc.configure_container_rescuedisk.return_value)
+        # devices are part of the init request, not separate updates
+        self.assertFalse(self.ml.container_update.called)
 
     @mock.patch.object(container_ops, 'utils')
     @tests.annotated_data(
@@ -207,7 +201,7 @@ class LXDTestContainerOps(test.NoDBTestCase):
             200, {'operation': '/1.0/operations/0123456789'})
         container_ops.CONF.vif_plugging_timeout = timeout
         mu.is_neutron.return_value = is_neutron
-        self.mv.plug.side_effect = plug_side_effect
+        self.mv.plug_vifs.side_effect = plug_side_effect
         with mock.patch.object(self.container_ops.virtapi,
                                'wait_for_instance_event') as mw:
             self.assertEqual(
@@ -220,12 +214,102 @@ class LXDTestContainerOps(test.NoDBTestCase):
                 [('network-vif-plugged', vif) for vif in vifs],
                 deadline=timeout,
                 error_callback=self.container_ops._neutron_failed_callback)
-        self.assertEqual(
-            [mock.call(instance, viface) for viface in network_info],
-            self.mv.plug.call_args_list)
+        self.mv.plug_vifs.assert_called_once_with(instance, network_info)
         calls = [
             mock.call.container_start(rescue and 'fake-uuid-rescue'
                                       or 'fake-uuid', 20),
-            mock.call.wait_container_operation('0123456789', 200, 20)
+            mock.call.connection.get_object(
+                'GET', '/1.0/operations/0123456789/wait?timeout=600')
         ]
         self.assertEqual(calls, self.ml.method_calls[-2:])
+
+    def _mock_power_operations(self):
+        operation = (200, {'operation': '/1.0/operations/0123456789'})
+        self.ml.container_start.return_value = operation
+        self.ml.container_stop.return_value = operation
+
+    @mock.patch.object(container_client.STATES, 'get')
+    def test_host_power_action_shutdown(self, mg):
+        self._mock_power_operations()
+        mg.return_value = {'instance-1': power_state.RUNNING,
+                           'instance-2': power_state.SHUTDOWN,
+                           'instance-3': power_state.RUNNING}
+        self.assertEqual('shutdown',
+                         self.container_ops.host_power_action('shutdown'))
+        self.assertEqual(
+            [mock.call('instance-1', 20), mock.call('instance-3', 20)],
+            sorted(self.ml.container_stop.call_args_list))
+        self.assertFalse(self.ml.container_start.called)
+
+    @mock.patch.object(container_client.STATES, 'get')
+    def test_host_power_action_reboot(self, mg):
+        self._mock_power_operations()
+        mg.return_value = {'instance-1': power_state.RUNNING,
+                           'instance-2': power_state.SHUTDOWN}
+        self.assertEqual('reboot',
+                         self.container_ops.host_power_action('reboot'))
+        self.ml.container_stop.assert_called_once_with('instance-1', 20)
+        self.ml.container_start.assert_called_once_with('instance-1', 20)
+
+    @mock.patch.object(container_client.STATES, 'get')
+    def test_host_power_action_reboot_stop_fail(self, mg):
+        self._mock_power_operations()
+        mg.return_value = {'instance-1': power_state.RUNNING,
+                           'instance-2': power_state.RUNNING}
+
+        def stop(name, timeout):
+            if name == 'instance-2':
+                raise lxd_exception.APIError('Fake', 500)
+            return (200, {'operation': '/1.0/operations/0123456789'})
+
+        self.ml.container_stop.side_effect = stop
+        self.assertRaises(exception.NovaException,
+                          self.container_ops.host_power_action, 'reboot')
+        self.assertEqual(2, self.ml.container_stop.call_count)
+        self.ml.container_start.assert_called_once_with('instance-1', 20)
+
+    @mock.patch.object(container_client.STATES, 'get')
+    def test_host_power_action_fail(self, mg):
+        self._mock_power_operations()
+        mg.return_value = {'instance-1': power_state.SHUTDOWN,
+                           'instance-2': power_state.SHUTDOWN}
+        self.ml.container_start.side_effect = [
+            lxd_exception.APIError('Fake', 500),
+            (200, {'operation': '/1.0/operations/0123456789'})]
+        self.assertRaises(exception.NovaException,
+                          self.container_ops.host_power_action, 'startup')
+        self.assertEqual(2, self.ml.container_start.call_count)
+
+    @mock.patch.object(container_client.STATES, 'get')
+    def test_host_maintenance_mode(self, mg):
+        self._mock_power_operations()
+        mg.return_value = {'instance-1': power_state.RUNNING,
+                           'instance-2': power_state.SHUTDOWN}
+        self.assertEqual(
+            'on_maintenance',
+            self.container_ops.host_maintenance_mode('fake-host', True))
+        self.ml.container_stop.assert_called_once_with('instance-1', 20)
+
+        mg.return_value = {'instance-1': power_state.SHUTDOWN,
+                           'instance-2': power_state.SHUTDOWN}
+        self.assertEqual(
+            'off_maintenance',
+            self.container_ops.host_maintenance_mode('fake-host', False))
+        self.ml.container_start.assert_called_once_with('instance-1', 20)
+
+    @mock.patch.object(container_client.STATES, 'get')
+    def test_host_maintenance_mode_twice(self, mg):
+        self._mock_power_operations()
+        mg.return_value = {'instance-1': power_state.RUNNING,
+                           'instance-2': power_state.SHUTDOWN}
+        self.container_ops.host_maintenance_mode('fake-host', True)
+        mg.return_value = {'instance-1': power_state.SHUTDOWN,
+                           'instance-2': power_state.RUNNING}
+        self.container_ops.host_maintenance_mode('fake-host', True)
+
+        mg.return_value = {'instance-1': power_state.SHUTDOWN,
+                           'instance-2': power_state.SHUTDOWN}
+        self.container_ops.host_maintenance_mode('fake-host', False)
+        self.assertEqual(
+            [mock.call('instance-1', 20), mock.call('instance-2', 20)],
+            sorted(self.ml.container_start.call_args_list))
@@ -0,0 +1,295 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+import os
+
+import fixtures
+import mock
+from nova.compute import task_states
+from nova import exception
+from nova import test
+from pylxd import exceptions as lxd_exception
+
+from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import container_snapshot
+from nclxd.nova.virt.lxd import container_transfer
+from nclxd.nova.virt.lxd import container_utils
+from nclxd.nova.virt.lxd import privhelper
+from nclxd import tests
+
+
+@mock.patch.object(container_snapshot, 'CONF',
+                   tests.MockConf(lxd_kwargs={'incremental_snapshots': True,
+                                              'snapshot_full_every': 3}))
+@mock.patch.object(container_snapshot, 'IMAGE_API')
+class LXDTestIncrementalSnapshot(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestIncrementalSnapshot, self).setUp()
+        self.instances_path = self.useFixture(fixtures.TempDir()).path
+        conf_patcher = mock.patch.object(
+            container_utils, 'CONF',
+            tests.MockConf(instances_path=self.instances_path,
+                           image_cache_subdirectory_name='_base'))
+        conf_patcher.start()
+        self.addCleanup(conf_patcher.stop)
+
+        self.ml = tests.lxd_mock()
+        lxd_patcher = mock.patch('pylxd.api.API',
+                                 mock.Mock(return_value=self.ml))
+        lxd_patcher.start()
+        self.addCleanup(lxd_patcher.stop)
+        listener_patcher = mock.patch.object(
+            container_client.container_events, 'get_listener',
+            mock.Mock(return_value=None))
+        listener_patcher.start()
+        self.addCleanup(listener_patcher.stop)
+        container_client.POOL.clear()
+        self.addCleanup(container_client.POOL.clear)
+
+        self.snapshot = container_snapshot.LXDSnapshot()
+        operation = (200, {'operation': '/1.0/operations/2345678901'})
+        self.ml.container_stop.return_value = operation
+        self.ml.container_start.return_value = operation
+        self.ml.container_snapshot_create.return_value = (
+            200, {'operation': '/1.0/operations/0123456789'})
+        self.ml.container_snapshot_delete.return_value = (
+            200, {'operation': '/1.0/operations/1234567890'})
+        self.instance = tests.MockInstance()
+        self.instance.system_metadata = {
+            'lxd_snapshot_base': 'base_snapshot',
+            'lxd_snapshot_image': 'base_image',
+            'lxd_snapshot_depth': '1'}
+        self.update_task_state = mock.Mock()
+
+    def _rootfs_delta(self, base, new, target):
+        with open(target, 'wb') as fp:
+            fp.write(b'delta')
+        return {'changed': 2, 'removed': 1, 'size': 5}
+
+    @mock.patch.object(privhelper, 'rootfs_delta')
+    def test_snapshot_delta(self, mr, mi):
+        mi.get.return_value = {'name': 'new_snapshot'}
+        mr.side_effect = self._rootfs_delta
+        uploaded = []
+
+        def update(context, image_id, image_meta, data):
+            uploaded.append(b''.join(data))
+            return {'checksum': '63bcabf86a9a991864777c631c5b7617'}
+
+        mi.update.side_effect = update
+
+        self.snapshot.snapshot({}, self.instance, 'new_image',
+                               self.update_task_state)
+
+        target = os.path.join(self.instances_path, '_base',
+                              'snapshot-new_image.tar.gz')
+        mr.assert_called_once_with(
+            '/fake/lxd/root/snapshots/fake-uuid/base_snapshot/rootfs',
+            '/fake/lxd/root/snapshots/fake-uuid/new_snapshot/rootfs',
+            target)
+        self.assertEqual(
+            {'name': 'new_snapshot', 'disk_format': 'raw',
+             'container_format': 'bare',
+             'properties': {'lxd_parent': 'base_image',
+                            'lxd_snapshot_depth': '2'}},
+            mi.update.call_args[0][2])
+        self.assertEqual([b'delta'], uploaded)
+        self.assertFalse(os.path.exists(target))
+        self.update_task_state.assert_called_with(
+            task_state=task_states.IMAGE_UPLOADING,
+            expected_state=task_states.IMAGE_PENDING_UPLOAD)
+        self.assertFalse(self.ml.container_publish.called)
+        self.ml.container_snapshot_delete.assert_called_once_with(
+            'fake-uuid', 'base_snapshot')
+        self.ml.connection.get_object.assert_called_with(
+            'GET', '/1.0/operations/1234567890/wait?timeout=600')
+        self.assertEqual({'lxd_snapshot_base': 'new_snapshot',
+                          'lxd_snapshot_image': 'new_image',
+                          'lxd_snapshot_depth': '2'},
+                         self.instance.system_metadata)
+        self.instance.save.assert_called_once_with()
+
+    @mock.patch.object(privhelper, 'rootfs_delta')
+    def test_snapshot_delta_unreadable(self, mr, mi):
+        mi.get.return_value = {'name': 'new_snapshot'}
+        mr.return_value = {'changed': 2, 'removed': 1, 'size': 5}
+        with mock.patch.object(self.snapshot, 'create_lxd_image'), \
+                mock.patch.object(self.snapshot, 'create_glance_image'):
+            self.snapshot.snapshot({}, self.instance, 'new_image',
+                                   self.update_task_state)
+            self.assertTrue(self.snapshot.create_glance_image.called)
+        self.assertEqual('0',
+                         self.instance.system_metadata['lxd_snapshot_depth'])
+
+    def test_set_snapshot_base_delete_fails(self, mi):
+        self.ml.container_snapshot_delete.side_effect = (
+            lxd_exception.APIError('Fake', 500))
+        self.snapshot.set_snapshot_base(self.instance, 'new_snapshot',
+                                        'new_image', 2)
+        self.assertEqual({'lxd_snapshot_base': 'new_snapshot',
+                          'lxd_snapshot_image': 'new_image',
+                          'lxd_snapshot_depth': '2'},
+                         self.instance.system_metadata)
+        self.instance.save.assert_called_once_with()
+
+    @mock.patch.object(privhelper, 'rootfs_delta')
+    def test_snapshot_delta_unavailable(self, mr, mi):
+        mi.get.return_value = {'name': 'new_snapshot'}
+        mr.side_effect = privhelper.LXDPrivHelperUnavailable()
+        with mock.patch.object(self.snapshot, 'create_lxd_image'), \
+                mock.patch.object(self.snapshot, 'create_glance_image'):
+            self.snapshot.snapshot({}, self.instance, 'new_image',
+                                   self.update_task_state)
+            self.snapshot.create_glance_image.assert_called_once_with(
+                {}, 'new_image', {'name': 'new_snapshot'},
+                self.snapshot.create_lxd_image.return_value,
+                self.update_task_state)
+        self.assertEqual('0',
+                         self.instance.system_metadata['lxd_snapshot_depth'])
+
+    @mock.patch.object(privhelper, 'rootfs_delta')
+    def test_snapshot_chain_full(self, mr, mi):
+        mi.get.return_value = {'name': 'new_snapshot'}
+        self.instance.system_metadata['lxd_snapshot_depth'] = '2'
+        with mock.patch.object(self.snapshot, 'create_lxd_image'), \
+                mock.patch.object(self.snapshot, 'create_glance_image'):
+            self.snapshot.snapshot({}, self.instance, 'new_image',
+                                   self.update_task_state)
+        self.assertFalse(mr.called)
+        self.assertEqual({'lxd_snapshot_base': 'new_snapshot',
+                          'lxd_snapshot_image': 'new_image',
+                          'lxd_snapshot_depth': '0'},
+                         self.instance.system_metadata)
+
+
+@mock.patch.object(container_snapshot, 'CONF',
+                   tests.MockConf(lxd_kwargs={'live_snapshots': True}))
+@mock.patch.object(container_snapshot, 'IMAGE_API')
+class LXDTestLiveSnapshot(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestLiveSnapshot, self).setUp()
+        with mock.patch('pylxd.api.API'):
+            self.snapshot = container_snapshot.LXDSnapshot()
+        self.mc = mock.Mock()
+        self.snapshot.container_client = self.mc
+        self.mc.client.return_value = (
+            200, {'operation': '/1.0/operations/1234567890'})
+        self.snapshot.lxd.container_snapshot_create.return_value = (
+            200, {'operation': '/1.0/operations/0123456789'})
+        self.snapshot.lxd.container_publish.return_value = (
+            200, {'metadata': {'fingerprint': 'abcdef0123456789'}})
+        conn = self.snapshot.lxd.connection.get_connection.return_value
+        conn.getresponse.return_value = mock.Mock(
+            status=200, read=io.BytesIO(b'image').read,
+            getheader=mock.Mock(return_value='5'))
+        self.manager = mock.Mock()
+        self.manager.attach_mock(self.mc.client, 'client')
+        self.manager.attach_mock(self.snapshot.lxd, 'lxd')
+        self.instance = tests.MockInstance()
+
+    def test_snapshot(self, mi):
+        mi.get.return_value = {'name': 'mock_snapshot'}
+        mi.update.return_value = {}
+        self.snapshot.snapshot({}, self.instance, 'mock_image',
+                               self.manager.update)
+        self.assertEqual(
+            [mock.call.update(task_state=task_states.IMAGE_PENDING_UPLOAD),
+             mock.call.client('running', instance='fake-uuid', host=None),
+             mock.call.client('pause', instance='fake-uuid', host=None),
+             mock.call.client('wait', oid='1234567890', host=None),
+             mock.call.lxd.container_snapshot_create(
+                 'fake-uuid', {'name': 'mock_snapshot', 'stateful': False}),
+             mock.call.client('wait', oid='0123456789', host=None),
+             mock.call.client('unpause', instance='fake-uuid', host=None),
+             mock.call.client('wait', oid='1234567890', host=None),
+             mock.call.lxd.container_publish(
+                 {'source': {'name': 'fake-uuid/mock_snapshot',
+                             'type': 'snapshot'}}),
+             mock.call.lxd.alias_create(
+                 {'name': 'mock_snapshot', 'target': 'abcdef0123456789'}),
+             mock.call.update(
+                 task_state=task_states.IMAGE_UPLOADING,
+                 expected_state=task_states.IMAGE_PENDING_UPLOAD),
+             mock.call.lxd.connection.get_connection()],
+            self.manager.method_calls)
+
+    def test_snapshot_unfreezes_on_failure(self, mi):
+        mi.get.return_value = {'name': 'mock_snapshot'}
+        self.snapshot.lxd.container_snapshot_create.side_effect = (
+            exception.NovaException)
+        self.assertRaises(exception.NovaException,
+                          self.snapshot.snapshot, {}, self.instance,
+                          'mock_image', mock.Mock())
+        self.mc.client.assert_any_call('unpause', instance='fake-uuid',
+                                       host=None)
+        self.assertFalse(self.snapshot.lxd.container_publish.called)
+
+    def test_snapshot_stopped(self, mi):
+        mi.get.return_value = {'name': 'mock_snapshot'}
+        mi.update.return_value = {}
+        self.mc.client.side_effect = [
+            False, (200, {'operation': '/1.0/operations/0123456789'})]
+        self.snapshot.snapshot({}, self.instance, 'mock_image', mock.Mock())
+        self.assertEqual(
+            [mock.call('running', instance='fake-uuid', host=None),
+             mock.call('wait', oid='0123456789', host=None)],
+            self.mc.client.call_args_list)
+
+
+@mock.patch.object(container_snapshot, 'IMAGE_API')
+class LXDTestUploadImage(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestUploadImage, self).setUp()
+        with mock.patch('pylxd.api.API'):
+            self.snapshot = container_snapshot.LXDSnapshot()
+        self.update_task_state = mock.Mock()
+
+    def _upload(self):
+        self.snapshot.upload_image({}, 'mock_image', {'name': 'image'},
+                                   io.BytesIO(b'image'),
+                                   self.update_task_state, 5)
+
+    @mock.patch.object(container_transfer, 'PROGRESS_INTERVAL', 0)
+    def test_upload_image(self, mi):
+        def update(context, image_id, image_meta, data):
+            self.assertEqual(b'image', b''.join(data))
+            return {'checksum': '78805a221a988e79ef3f42d7c5bfd418'}
+
+        mi.update.side_effect = update
+        self._upload()
+        self.update_task_state.assert_called_with(
+            task_state=task_states.IMAGE_UPLOADING,
+            expected_state=task_states.IMAGE_UPLOADING)
+
+    def test_upload_image_checksum_mismatch(self, mi):
+        mi.update.side_effect = (
+            lambda context, image_id, image_meta, data:
+            {'checksum': 'bad', 'size': len(b''.join(data))})
+        self.assertRaises(exception.NovaException, self._upload)
+
+    @mock.patch.object(container_transfer, 'PROGRESS_INTERVAL', 0)
+    def test_upload_image_deleted(self, mi):
+        self.update_task_state.side_effect = (
+            exception.UnexpectedDeletingTaskStateError(
+                instance_uuid='fake-uuid', expected='image_uploading',
+                actual='deleting'))
+        mi.update.side_effect = (
+            lambda context, image_id, image_meta, data: b''.join(data))
+        self.assertRaises(exception.UnexpectedDeletingTaskStateError,
+                          self._upload)
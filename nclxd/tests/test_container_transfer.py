@@ -0,0 +1,156 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bz2
+import io
+import zlib
+
+import mock
+from nova import test
+
+from nclxd.nova.virt.lxd import container_transfer
+
+
+def _gzip(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _drain(reader, size=1000):
+    chunks = []
+    while True:
+        chunk = reader.read(size)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+class LXDTestRecompressingReader(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestRecompressingReader, self).setUp()
+        self.data = b'fake rootfs contents ' * 10000
+
+    def test_gzip_to_bzip2(self):
+        reader = container_transfer.RecompressingReader(
+            io.BytesIO(_gzip(self.data)), 'bzip2', 9)
+        self.assertEqual(self.data, bz2.decompress(_drain(reader)))
+
+    def test_gzip_level(self):
+        reader = container_transfer.RecompressingReader(
+            io.BytesIO(_gzip(self.data, 1)), 'gzip', 9)
+        output = _drain(reader)
+        self.assertEqual(
+            self.data, zlib.decompress(output, 16 + zlib.MAX_WBITS))
+
+    def test_unknown_compression(self):
+        reader = container_transfer.RecompressingReader(
+            io.BytesIO(self.data), 'gzip', 6)
+        self.assertRaises(container_transfer.LXDTransferError,
+                          reader.read)
+
+
+class LXDTestThrottledReader(test.NoDBTestCase):
+
+    @mock.patch.object(container_transfer.eventlet, 'sleep')
+    @mock.patch.object(container_transfer.time, 'time')
+    def test_throttle(self, mt, ms):
+        mt.return_value = 100
+        reader = container_transfer.ThrottledReader(
+            io.BytesIO(b'x' * 300 * 1024), 100 * 1024)
+        # The first 100 KiB are covered by the burst.
+        self.assertEqual(100 * 1024, len(reader.read(100 * 1024)))
+        self.assertFalse(ms.called)
+        reader.read(100 * 1024)
+        ms.assert_called_once_with(1.0)
+
+        mt.return_value = 101.5
+        reader.read(100 * 1024)
+        ms.assert_called_with(0.5)
+        self.assertEqual(300 * 1024, reader.bytes_read)
+
+    @mock.patch.object(container_transfer.eventlet, 'sleep')
+    def test_unlimited(self, ms):
+        reader = container_transfer.ThrottledReader(
+            io.BytesIO(b'x' * 1024 * 1024), 0)
+        self.assertEqual(1024 * 1024, len(_drain(reader, 64 * 1024)))
+        self.assertFalse(ms.called)
+
+
+class LXDTestChunkedEncoder(test.NoDBTestCase):
+
+    def test_read(self):
+        encoder = container_transfer.ChunkedEncoder(io.BytesIO(b'a' * 20))
+        self.assertEqual(b'10\r\n' + b'a' * 16 + b'\r\n', encoder.read(16))
+        self.assertEqual(b'4\r\naaaa\r\n', encoder.read(16))
+        self.assertEqual(b'0\r\n\r\n', encoder.read(16))
+        self.assertEqual(b'', encoder.read(16))
+
+
+class LXDTestChecksumReader(test.NoDBTestCase):
+
+    def test_read(self):
+        reader = container_transfer.ChecksumReader(io.BytesIO(b'image'))
+        self.assertEqual(b'image', b''.join(reader))
+        self.assertEqual(5, reader.bytes_read)
+        self.assertEqual('78805a221a988e79ef3f42d7c5bfd418',
+                         reader.hexdigest())
+
+    @mock.patch.object(container_transfer, 'PROGRESS_INTERVAL', 0)
+    def test_progress(self):
+        progress = mock.Mock()
+        reader = container_transfer.ChecksumReader(io.BytesIO(b'image'),
+                                                   progress)
+        _drain(reader, 2)
+        self.assertEqual([mock.call(2), mock.call(4), mock.call(5),
+                          mock.call(5)],
+                         progress.call_args_list)
+
+
+class LXDTestImageExportReader(test.NoDBTestCase):
+
+    def test_read(self):
+        connection = mock.Mock()
+        conn = connection.get_connection.return_value
+        conn.getresponse.return_value = mock.Mock(
+            status=200, read=io.BytesIO(b'image').read,
+            getheader=mock.Mock(return_value='5'))
+        reader = container_transfer.ImageExportReader(connection, 'fake')
+        conn.request.assert_called_once_with('GET',
+                                             '/1.0/images/fake/export')
+        self.assertEqual(5, reader.size)
+        self.assertEqual(b'image', _drain(reader, 2))
+        self.assertEqual(5, reader.bytes_read)
+
+    def test_not_found(self):
+        connection = mock.Mock()
+        conn = connection.get_connection.return_value
+        conn.getresponse.return_value = mock.Mock(status=404)
+        self.assertRaises(container_transfer.LXDTransferError,
+                          container_transfer.ImageExportReader,
+                          connection, 'fake')
+        conn.close.assert_called_once_with()
+
+    def test_open_stream(self):
+        stream = container_transfer.open_stream(
+            io.BytesIO(_gzip(b'data')), 'bzip2', 9, 0)
+        self.assertEqual(b'data', bz2.decompress(_drain(stream)))
+
+    def test_check_compression(self):
+        container_transfer.check_compression('none', 6)
+        container_transfer.check_compression('bzip2', 9)
+        with mock.patch.object(container_transfer, 'lzma', None):
+            self.assertRaises(container_transfer.LXDTransferError,
+                              container_transfer.check_compression, 'xz', 6)
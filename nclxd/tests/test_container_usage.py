@@ -0,0 +1,198 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import fixtures
+import mock
+from nova import test
+import six
+
+from nclxd.nova.virt.lxd import container_usage
+from nclxd import tests
+
+
+class LXDCgroupTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDCgroupTestCase, self).setUp()
+        self.cgroup_root = self.useFixture(fixtures.TempDir()).path
+        conf_patcher = mock.patch.object(
+            container_usage, 'CONF',
+            tests.MockConf(lxd_kwargs={'cgroup_root': self.cgroup_root}))
+        conf_patcher.start()
+        self.addCleanup(conf_patcher.stop)
+        self.usage = container_usage.LXDContainerUsage()
+
+    def _write(self, controller, name, key, value):
+        path = os.path.join(self.cgroup_root, controller, 'lxc', name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, key), 'w') as fp:
+            fp.write('%s\n' % value)
+
+    def _container(self, name, usage, limit, cpus, cpu_time):
+        self._write('memory', name, 'memory.usage_in_bytes', usage)
+        self._write('memory', name, 'memory.limit_in_bytes', limit)
+        self._write('cpuset', name, 'cpuset.cpus', cpus)
+        self._write('cpuacct', name, 'cpuacct.usage', cpu_time)
+
+
+class LXDTestContainerUsage(LXDCgroupTestCase):
+
+    def test_get(self):
+        self._container('instance-1', 4 * 1024 * 1024, 512 * 1024 * 1024,
+                        '0-1', 1000)
+        self._container('instance-2', 1024 * 1024, 9223372036854771712,
+                        '0,2-4', 2000)
+        self.assertEqual(
+            {'instance-1': {'mem_kb': 4096,
+                            'max_mem_kb': 512 * 1024,
+                            'num_cpu': 2,
+                            'cpu_time_ns': 1000},
+             'instance-2': {'mem_kb': 1024,
+                            'max_mem_kb': None,
+                            'num_cpu': 4,
+                            'cpu_time_ns': 2000}},
+            self.usage.get())
+
+    def test_get_missing_controllers(self):
+        self._write('memory', 'instance-1', 'memory.usage_in_bytes', 1024)
+        self.assertEqual(
+            {'instance-1': {'mem_kb': 1,
+                            'max_mem_kb': None,
+                            'num_cpu': None,
+                            'cpu_time_ns': 0}},
+            self.usage.get())
+
+    def test_get_no_cgroups(self):
+        self.assertEqual({}, self.usage.get())
+
+    def test_get_cached(self):
+        self._container('instance-1', 1024, 1024, '0', 0)
+        self.usage.get()
+        self._container('instance-2', 1024, 1024, '0', 0)
+        self.assertEqual(['instance-1'], list(self.usage.get()))
+
+        self.usage.invalidate()
+        self.assertEqual(['instance-1', 'instance-2'],
+                         sorted(self.usage.get()))
+
+
+class LXDTestNetStatistics(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestNetStatistics, self).setUp()
+        self.sysfs_net = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MonkeyPatch(
+            'nclxd.nova.virt.lxd.container_usage.SYSFS_NET',
+            self.sysfs_net))
+
+    def _device(self, name, rx_bytes, tx_bytes):
+        path = os.path.join(self.sysfs_net, name, 'statistics')
+        os.makedirs(path)
+        for key, value in (('rx_bytes', rx_bytes), ('tx_bytes', tx_bytes)):
+            with open(os.path.join(path, key), 'w') as fp:
+                fp.write('%d\n' % value)
+
+    def test_get_net_statistics(self):
+        self._device('qvb1', 100, 200)
+        self._device('qvb2', 300, 400)
+        self._device('eth0', 500, 600)
+        self.assertEqual({'qvb1': (100, 200), 'qvb2': (300, 400)},
+                         container_usage.get_net_statistics(
+                             ['qvb1', 'qvb2', 'qvb3']))
+
+    def test_get_net_statistics_no_sysfs(self):
+        os.rmdir(self.sysfs_net)
+        self.assertEqual({}, container_usage.get_net_statistics(['qvb1']))
+
+
+class LXDTestMetricsSampler(LXDCgroupTestCase):
+
+    def setUp(self):
+        super(LXDTestMetricsSampler, self).setUp()
+        usage_patcher = mock.patch.object(container_usage, 'USAGE',
+                                          self.usage)
+        usage_patcher.start()
+        self.addCleanup(usage_patcher.stop)
+        self.sampler = container_usage.LXDMetricsSampler()
+
+    def test_sample(self):
+        self._container('instance-1', 4096, 8192, '1-2', 300)
+        self._write('cpuacct', 'instance-1', 'cpuacct.usage_percpu',
+                    '100 120 180 0')
+        self._write('blkio', 'instance-1', 'blkio.throttle.io_service_bytes',
+                    '8:0 Read 4096\n8:0 Write 1024\n8:0 Sync 5120\n'
+                    '8:16 Read 2048\nTotal 7168')
+        self._write('blkio', 'instance-1', 'blkio.throttle.io_serviced',
+                    '8:0 Read 2\n8:0 Write 1\n8:16 Read 1\nTotal 4')
+        self.assertEqual(
+            {'instance-1': container_usage.ContainerSample(
+                mem_kb=4, max_mem_kb=8, cpu_times=(120, 180), nics={},
+                disk=(6144, 3, 1024, 1), started_at=None)},
+            self.sampler.sample())
+
+    def test_sample_ring_buffer(self):
+        self._container('instance-1', 4096, 8192, '0', 300)
+        for i in range(12):
+            self.sampler.sample()
+        self.assertEqual(10, len(self.sampler._samples))
+
+    def test_get(self):
+        self._container('instance-1', 4096, 8192, '0', 300)
+        self.assertEqual(4, self.sampler.get('instance-1').mem_kb)
+        self.assertIsNone(self.sampler.get('instance-2'))
+        self.assertEqual(1, len(self.sampler._samples))
+
+    @mock.patch('six.moves.builtins.open')
+    def test_nics(self, mo):
+        net_dev = mock.MagicMock()
+        net_dev.__enter__.return_value = six.moves.cStringIO(
+            'Inter-|   Receive |  Transmit\n'
+            ' face |bytes packets errs drop fifo frame compressed '
+            'multicast|bytes packets errs drop fifo colls carrier '
+            'compressed\n'
+            '    lo: 10 1 0 0 0 0 0 0 10 1 0 0 0 0 0 0\n'
+            '  eth0: 100 2 3 4 0 0 0 0 200 5 6 7 0 0 0 0\n')
+        mo.return_value = net_dev
+        self.assertEqual(
+            {'eth0': container_usage.NicSample(100, 2, 3, 4, 200, 5, 6, 7)},
+            self.sampler._nics('1234'))
+        mo.assert_called_once_with('/proc/1234/net/dev')
+
+    @mock.patch('os.sysconf', mock.Mock(return_value=100))
+    @mock.patch('six.moves.builtins.open')
+    def test_started_at(self, mo):
+        files = {'/proc/stat': 'cpu  1 2 3\nbtime 1000000\nprocesses 9\n',
+                 '/proc/1234/stat': '1234 (init (x)) S 0 1 1 0 -1 4194560 '
+                                    '1 2 3 4 5 6 7 8 20 0 1 0 12345 '
+                                    '1000 100\n'}
+
+        def fake_open(path):
+            fp = mock.MagicMock()
+            fp.__enter__.return_value = six.moves.cStringIO(files[path])
+            return fp
+
+        mo.side_effect = fake_open
+        self.assertEqual(1000123.45, self.sampler._started_at('1234'))
+
+    def test_started_at_gone(self):
+        self.assertIsNone(self.sampler._started_at('no-such-pid'))
+
+    @mock.patch.object(container_usage.utils, 'spawn_n')
+    def test_start_disabled(self, ms):
+        self.sampler.start()
+        self.assertFalse(ms.called)
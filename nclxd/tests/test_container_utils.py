@@ -14,6 +14,7 @@
 #    under the License.
 
 
+import eventlet
 import mock
 
 from nova import exception
@@ -45,3 +46,58 @@ class LXDTestContainerUtils(test.NoDBTestCase):
         self.assertRaises(exception.NovaException,
                           self.container_utils.wait_for_container,
                           'fake')
+
+
+class LXDTestSpawnStages(test.NoDBTestCase):
+
+    @mock.patch('time.time', mock.Mock(side_effect=[10, 12.5]))
+    def test_timed_call(self):
+        timings = {}
+        self.assertEqual(
+            'result',
+            container_utils.timed_call(timings, 'stage',
+                                       mock.Mock(return_value='result')))
+        self.assertEqual({'stage': 2.5}, timings)
+
+    def test_wait_all(self):
+        threads = [eventlet.spawn(lambda: 1), eventlet.spawn(lambda: 2)]
+        self.assertEqual([1, 2], container_utils.wait_all(threads))
+
+    def test_wait_all_failure(self):
+        def fail():
+            raise exception.NovaException()
+
+        slow = eventlet.spawn(eventlet.sleep, 10)
+        threads = [slow, eventlet.spawn(fail)]
+        self.assertRaises(exception.NovaException,
+                          container_utils.wait_all, threads)
+        self.assertTrue(slow.dead)
+
+    def test_run_many(self):
+        running = []
+        peak = []
+
+        def func(item):
+            running.append(item)
+            peak.append(len(running))
+            eventlet.sleep(0.01)
+            running.remove(item)
+            if item == 3:
+                raise exception.NovaException()
+            return item * 2
+
+        results = container_utils.run_many(func, range(6), 2)
+        self.assertEqual([0, 2, 4, None, 8, 10],
+                         [result for item, result, error in results])
+        self.assertIsInstance(results[3][2], exception.NovaException)
+        self.assertEqual(2, max(peak))
+
+    def test_run_many_timeout(self):
+        def func(item):
+            eventlet.sleep(item)
+            return item
+
+        results = container_utils.run_many(func, [0, 10], 2, timeout=0.1)
+        self.assertEqual((0, 0, None), results[0])
+        self.assertIsInstance(results[1][2],
+                              container_utils.LXDOperationTimeout)
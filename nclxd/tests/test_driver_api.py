@@ -33,11 +33,15 @@ from nova import test
 from nova.virt import fake
 from nova.virt import hardware
 
+from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import container_console
 from nclxd.nova.virt.lxd import container_ops
 from nclxd.nova.virt.lxd import container_snapshot
+from nclxd.nova.virt.lxd import container_usage
 from nclxd.nova.virt.lxd import container_utils
 from nclxd.nova.virt.lxd import driver
 from nclxd.nova.virt.lxd import host
+from nclxd.nova.virt.lxd import privhelper
 from nclxd import tests
 
 
@@ -53,9 +57,11 @@ class LXDTestConfig(test.NoDBTestCase):
 
 @ddt.ddt
 @mock.patch.object(container_ops, 'CONF', tests.MockConf())
+@mock.patch.object(container_usage, 'CONF', tests.MockConf())
 @mock.patch.object(container_utils, 'CONF', tests.MockConf())
 @mock.patch.object(driver, 'CONF', tests.MockConf())
 @mock.patch.object(host, 'CONF', tests.MockConf())
+@mock.patch.object(privhelper, 'CONF', tests.MockConf())
 class LXDTestDriver(test.NoDBTestCase):
 
     @mock.patch.object(driver, 'CONF', tests.MockConf())
@@ -66,11 +72,18 @@ class LXDTestDriver(test.NoDBTestCase):
                                  mock.Mock(return_value=self.ml))
         lxd_patcher.start()
         self.addCleanup(lxd_patcher.stop)
+        container_client.POOL.clear()
+        self.addCleanup(container_client.POOL.clear)
+        container_client.STATES.invalidate()
+        self.addCleanup(container_client.STATES.invalidate)
+        container_usage.USAGE.invalidate()
+        self.addCleanup(container_usage.USAGE.invalidate)
+        self.addCleanup(container_console.CONSOLES.forget, 'fake-uuid')
 
         self.connection = driver.LXDDriver(fake.FakeVirtAPI())
 
     def test_capabilities(self):
-        self.assertFalse(self.connection.capabilities['has_imagecache'])
+        self.assertTrue(self.connection.capabilities['has_imagecache'])
         self.assertFalse(self.connection.capabilities['supports_recreate'])
         self.assertFalse(
             self.connection.capabilities['supports_migrate_to_same_host'])
@@ -120,19 +133,140 @@ class LXDTestDriver(test.NoDBTestCase):
         (lxd_exceptions.APIError('Fake', 500), power_state.NOSTATE),
     )
     def test_get_info(self, side_effect, expected):
-        instance = tests.MockInstance()
-        self.ml.container_state.side_effect = [side_effect]
-        self.assertEqual(hardware.InstanceInfo(state=expected, num_cpu=2),
+        instance = tests.MockInstance(memory_mb=512, vcpus=2)
+        if isinstance(side_effect, Exception):
+            self.ml.connection.get_object.side_effect = [side_effect]
+            self.assertRaises(exception.NovaException,
+                              self.connection.get_info, instance)
+            return
+        self.ml.connection.get_object.return_value = (
+            200, {'metadata': [{'name': 'fake-uuid',
+                                'status': {'status': side_effect}}]})
+        self.assertEqual(hardware.InstanceInfo(state=expected,
+                                               max_mem_kb=512 * 1024,
+                                               num_cpu=2),
                          self.connection.get_info(instance))
 
+    def test_get_info_cached(self):
+        instance = tests.MockInstance()
+        self.connection.get_info(instance)
+        self.connection.get_info(instance)
+        self.ml.connection.get_object.assert_called_once_with(
+            'GET', '/1.0/containers?recursion=1')
+        self.assertFalse(self.ml.container_state.called)
+
+    def test_get_info_missing(self):
+        instance = tests.MockInstance(memory_mb=512, vcpus=2)
+        self.assertEqual(
+            hardware.InstanceInfo(state=power_state.NOSTATE,
+                                  max_mem_kb=512 * 1024, num_cpu=2),
+            self.connection.get_info(instance))
+
+    def test_get_info_usage(self):
+        instance = tests.MockInstance(uuid='mock-instance-1',
+                                      memory_mb=512, vcpus=2)
+        usage = {'mock-instance-1': {'mem_kb': 1024,
+                                     'max_mem_kb': 2048,
+                                     'num_cpu': 1,
+                                     'cpu_time_ns': 123456}}
+        with mock.patch.object(container_usage.USAGE, 'get',
+                               return_value=usage):
+            self.assertEqual(
+                hardware.InstanceInfo(state=power_state.RUNNING,
+                                      max_mem_kb=2048, mem_kb=1024,
+                                      num_cpu=1, cpu_time_ns=123456),
+                self.connection.get_info(instance))
+
+    def test_get_per_instance_usage(self):
+        usage = {'mock-instance-1': {'mem_kb': 2048,
+                                     'max_mem_kb': None,
+                                     'num_cpu': 4,
+                                     'cpu_time_ns': 0},
+                 'mock-instance-2-rescue': {'mem_kb': 1024,
+                                            'max_mem_kb': None,
+                                            'num_cpu': 4,
+                                            'cpu_time_ns': 0}}
+        with mock.patch.object(container_usage.USAGE, 'get',
+                               return_value=usage):
+            self.assertEqual(
+                {'mock-instance-1': {'uuid': 'mock-instance-1',
+                                     'memory_mb': 2}},
+                self.connection.get_per_instance_usage())
+
+    def _sample(self):
+        return container_usage.ContainerSample(
+            mem_kb=2048, max_mem_kb=4096, cpu_times=(100, 200),
+            nics={'eth0': container_usage.NicSample(1, 2, 3, 4,
+                                                    5, 6, 7, 8)},
+            disk=(10, 20, 30, 40), started_at=None)
+
+    def test_get_diagnostics(self):
+        instance = tests.MockInstance(uuid='mock-instance-1')
+        with mock.patch.object(self.connection.container_ops.metrics, 'get',
+                               return_value=self._sample()):
+            self.assertEqual(
+                {'memory': 4096, 'memory-actual': 2048,
+                 'cpu0_time': 100, 'cpu1_time': 200,
+                 'eth0_rx': 1, 'eth0_rx_packets': 2, 'eth0_rx_errors': 3,
+                 'eth0_rx_drop': 4, 'eth0_tx': 5, 'eth0_tx_packets': 6,
+                 'eth0_tx_errors': 7, 'eth0_tx_drop': 8,
+                 'root_read': 10, 'root_read_req': 20,
+                 'root_write': 30, 'root_write_req': 40},
+                self.connection.get_diagnostics(instance))
+
+    def test_get_diagnostics_not_found(self):
+        instance = tests.MockInstance(uuid='fake-instance')
+        self.assertRaises(exception.InstanceNotFound,
+                          self.connection.get_diagnostics, instance)
+
+    @mock.patch('nova.virt.configdrive.required_by',
+                mock.Mock(return_value=False))
+    def test_get_instance_diagnostics(self):
+        instance = tests.MockInstance(uuid='mock-instance-1')
+        with mock.patch.object(self.connection.container_ops.metrics, 'get',
+                               return_value=self._sample()):
+            diags = self.connection.get_instance_diagnostics(instance)
+        self.assertEqual('running', diags.state)
+        self.assertEqual('lxd', diags.driver)
+        self.assertEqual(4, diags.memory_details.maximum)
+        self.assertEqual(2, diags.memory_details.used)
+        self.assertEqual([100, 200],
+                         [cpu.time for cpu in diags.cpu_details])
+        self.assertEqual(1, diags.nic_details[0].rx_octets)
+        self.assertEqual(5, diags.nic_details[0].tx_octets)
+        self.assertEqual(10, diags.disk_details[0].read_bytes)
+        self.assertEqual(40, diags.disk_details[0].write_requests)
+
+    @mock.patch.object(container_usage, 'get_net_statistics')
+    def test_get_all_bw_counters(self, mg):
+        mg.return_value = {'qvb0123456789a': (100, 200)}
+        instance = tests.MockInstance()
+        instance.info_cache.network_info = [
+            {'id': '0123456789abcdef', 'address': '00:11:22:33:44:55'},
+            {'id': 'fedcba9876543210', 'address': '00:11:22:33:44:66'}]
+        no_cache = tests.MockInstance(uuid='fake-uuid-2', info_cache=None)
+        self.assertEqual(
+            [{'uuid': 'fake-uuid',
+              'mac_address': '00:11:22:33:44:55',
+              'bw_in': 100,
+              'bw_out': 200}],
+            self.connection.get_all_bw_counters([instance, no_cache]))
+        self.assertEqual(['qvb0123456789a', 'qvbfedcba98765'],
+                         sorted(mg.call_args[0][0]))
+
     @tests.annotated_data(
         (True, 'mock-instance-1'),
         (False, 'fake-instance'),
+        (False, 'mock-instance-2-rescue'),
     )
-    def test_instance_exists(self, expected, name):
+    def test_instance_exists(self, expected, uuid):
         self.assertEqual(
             expected,
-            self.connection.instance_exists(tests.MockInstance(name=name)))
+            self.connection.instance_exists(tests.MockInstance(uuid=uuid)))
+
+    def test_list_instance_uuids(self):
+        self.assertEqual(['mock-instance-1', 'mock-instance-2'],
+                         sorted(self.connection.list_instance_uuids()))
 
     def test_estimate_instance_overhead(self):
         self.assertEqual(
@@ -140,11 +274,12 @@ class LXDTestDriver(test.NoDBTestCase):
             self.connection.estimate_instance_overhead(mock.Mock()))
 
     def test_list_instances(self):
-        self.assertEqual(['mock-instance-1', 'mock-instance-2'],
-                         self.connection.list_instances())
+        self.assertEqual(['mock-instance-1', 'mock-instance-2',
+                          'mock-instance-2-rescue'],
+                         sorted(self.connection.list_instances()))
 
     def test_list_instances_fail(self):
-        self.ml.container_list.side_effect = (
+        self.ml.connection.get_object.side_effect = (
             lxd_exceptions.APIError('Fake', 500))
         self.assertRaises(
             exception.NovaException,
@@ -228,24 +363,18 @@ class LXDTestDriver(test.NoDBTestCase):
         mr.assert_called_once_with(
             '/fake/instances/path/fake-uuid')
 
-    @mock.patch('six.moves.builtins.open')
-    @mock.patch.object(container_ops.utils, 'execute')
-    @mock.patch('pwd.getpwuid', mock.Mock(return_value=mock.Mock(pw_uid=1234)))
-    @mock.patch('os.getuid', mock.Mock())
-    def test_get_console_output(self, me, mo):
+    @mock.patch.object(container_console.LXDConsoleLog, 'read',
+                       mock.Mock(return_value=(b'fake contents', 13)))
+    def test_get_console_output(self):
         instance = tests.MockInstance()
-        mo.return_value.__enter__.return_value = six.BytesIO(b'fake contents')
         self.assertEqual(b'fake contents',
                          self.connection.get_console_output({}, instance))
-        calls = [
-            mock.call('chown', '1234:1234',
-                      '/fake/lxd/root/containers/fake-uuid/console.log',
-                      run_as_root=True),
-            mock.call('chmod', '755',
-                      '/fake/lxd/root/containers/fake-uuid',
-                      run_as_root=True)
-        ]
-        self.assertEqual(calls, me.call_args_list)
+        log = container_console.CONSOLES.get(
+            'fake-uuid', '/fake/lxd/root/containers/fake-uuid/console.log',
+            container_ops.MAX_CONSOLE_BYTES)
+        self.assertEqual(
+            '/fake/lxd/root/containers/fake-uuid/console.log', log.path)
+        log.read.assert_called_once_with()
 
     @mock.patch.object(host.compute_utils, 'get_machine_ips')
     @tests.annotated_data(
@@ -354,12 +483,19 @@ class LXDTestDriver(test.NoDBTestCase):
             )
             mv.unplug.assert_called_once_with(instance, vif)
 
+    def _mock_image_export(self, status=200, data=b'image'):
+        conn = self.ml.connection.get_connection.return_value
+        conn.getresponse.return_value = mock.Mock(
+            status=status, read=six.BytesIO(data).read,
+            getheader=mock.Mock(return_value=str(len(data))))
+
     @mock.patch.object(container_snapshot, 'IMAGE_API')
     @tests.annotated_data(
-        ('export-fail', lxd_exceptions.APIError('Fake', 500), None),
-        ('update-fail', None, exception.NovaException),
+        ('export-fail', 500, None),
+        ('update-fail', 200, exception.NovaException),
+        ('checksum-fail', 200, None),
     )
-    def test_snapshot_fail(self, tag, export_effect, update_effect, mi):
+    def test_snapshot_fail(self, tag, export_status, update_effect, mi):
         instance = tests.MockInstance()
         mi.get.return_value = {'name': 'mock_snapshot'}
         self.ml.container_snapshot_create.return_value = (
@@ -370,8 +506,9 @@ class LXDTestDriver(test.NoDBTestCase):
             200, {'operation': '/1.0/operations/2345678901'})
         self.ml.container_publish.return_value = (
             200, {'metadata': {'fingerprint': 'abcdef0123456789'}})
-        self.ml.image_export.side_effect = export_effect
+        self._mock_image_export(export_status)
         mi.update.side_effect = update_effect
+        mi.update.return_value = {'checksum': 'bad'}
         self.assertRaises(exception.NovaException,
                           self.connection.snapshot,
                           {}, instance, '', mock.Mock())
@@ -391,6 +528,13 @@ class LXDTestDriver(test.NoDBTestCase):
             200, {'operation': '/1.0/operations/2345678901'})
         self.ml.container_publish.return_value = (
             200, {'metadata': {'fingerprint': 'abcdef0123456789'}})
+        self._mock_image_export()
+
+        def update(context, image_id, image_meta, data):
+            self.assertEqual(b'image', b''.join(data))
+            return {'checksum': '78805a221a988e79ef3f42d7c5bfd418'}
+
+        mi.update.side_effect = update
 
         manager = mock.Mock()
         manager.attach_mock(mi, 'image')
@@ -407,24 +551,27 @@ class LXDTestDriver(test.NoDBTestCase):
             mock.call.lxd.container_snapshot_create(
                 'fake-uuid',
                 {'name': 'mock_snapshot', 'stateful': False}),
-            mock.call.lxd.wait_container_operation('0123456789', 200, 20),
+            mock.call.lxd.connection.get_object(
+                'GET', '/1.0/operations/0123456789/wait?timeout=600'),
             mock.call.lxd.container_stop('fake-uuid', 20),
-            mock.call.lxd.wait_container_operation('1234567890', 200, 20),
+            mock.call.lxd.connection.get_object(
+                'GET', '/1.0/operations/1234567890/wait?timeout=600'),
             mock.call.lxd.container_publish(
                 {'source': {'name': 'fake-uuid/mock_snapshot',
                             'type': 'snapshot'}}),
             mock.call.lxd.alias_create(
                 {'name': 'mock_snapshot', 'target': 'abcdef0123456789'}),
-            mock.call.lxd.image_export('abcdef0123456789'),
+            mock.call.update(task_state=task_states.IMAGE_UPLOADING,
+                             expected_state=task_states.IMAGE_PENDING_UPLOAD),
+            mock.call.lxd.connection.get_connection(),
             mock.call.image.update(
                 context, 'mock_image',
                 {'name': 'mock_snapshot', 'disk_format': 'raw',
                  'container_format': 'bare', 'properties': {}},
-                self.ml.image_export.return_value),
-            mock.call.update(task_state=task_states.IMAGE_UPLOADING,
-                             expected_state=task_states.IMAGE_PENDING_UPLOAD),
+                mock.ANY),
             mock.call.lxd.container_start('fake-uuid', 20),
-            mock.call.lxd.wait_container_operation('2345678901', 200, 20),
+            mock.call.lxd.connection.get_object(
+                'GET', '/1.0/operations/2345678901/wait?timeout=600'),
         ]
         self.assertEqual(calls, manager.method_calls)
 
@@ -471,50 +618,53 @@ class LXDTestDriver(test.NoDBTestCase):
         ]
         self.assertEqual(calls, self.ml.method_calls)
 
-    @mock.patch.object(container_ops.utils, 'execute',
-                       mock.Mock(return_value=('', True)))
-    def test_get_available_resource_fail(self):
-        self.assertRaises(
-            exception.NovaException,
-            self.connection.get_available_resource,
-            None)
+    sysfs = {
+        '/sys/devices/system/cpu/online': '0-3',
+        '/sys/devices/system/cpu/cpu0/topology/physical_package_id': '0',
+        '/sys/devices/system/cpu/cpu0/topology/core_id': '0',
+        '/sys/devices/system/cpu/cpu1/topology/physical_package_id': '0',
+        '/sys/devices/system/cpu/cpu1/topology/core_id': '0',
+        '/sys/devices/system/cpu/cpu2/topology/physical_package_id': '1',
+        '/sys/devices/system/cpu/cpu2/topology/core_id': '0',
+        '/sys/devices/system/cpu/cpu3/topology/physical_package_id': '1',
+        '/sys/devices/system/cpu/cpu3/topology/core_id': '0',
+    }
 
     @mock.patch('platform.node', mock.Mock(return_value='fake_hostname'))
     @mock.patch('os.statvfs', return_value=mock.Mock(f_blocks=131072000,
                                                      f_bsize=8192,
                                                      f_bavail=65536000))
     @mock.patch('six.moves.builtins.open')
-    @mock.patch.object(container_ops.utils, 'execute')
+    @mock.patch.object(host.utils, 'execute')
     def test_get_available_resource(self, me, mo, ms):
-        me.return_value = ('Model name:          Fake CPU\n'
-                           'Vendor ID:           FakeVendor\n'
-                           'Socket(s):           10\n'
-                           'Core(s) per socket:  5\n'
-                           'Thread(s) per core:  4\n'
-                           '\n',
-                           None)
         meminfo = mock.MagicMock()
         meminfo.__enter__.return_value = six.moves.cStringIO(
             'MemTotal: 10240000 kB\n'
             'MemFree:   2000000 kB\n'
             'Buffers:     24000 kB\n'
             'Cached:      24000 kB\n')
-
-        mo.side_effect = [
-            six.moves.cStringIO('flags: fake flag goes here\n'
-                                'processor: 2\n'
-                                '\n'),
-            meminfo,
-        ]
-        value = self.connection.get_available_resource(None)
+        cpuinfo = mock.MagicMock()
+        cpuinfo.__enter__.return_value = six.moves.cStringIO(
+            'processor: 0\n'
+            'vendor_id: FakeVendor\n'
+            'model name: Fake CPU\n'
+            'flags: fake flag goes here\n'
+            '\n'
+            'processor: 1\n'
+            'flags: ignored\n')
+
+        mo.side_effect = [cpuinfo, meminfo]
+        with mock.patch.object(self.connection.host, '_read_sysfs',
+                               side_effect=self.sysfs.get):
+            value = self.connection.get_available_resource(None)
         value['cpu_info'] = json.loads(value['cpu_info'])
         value['supported_instances'] = json.loads(value['supported_instances'])
         expected = {'cpu_info': {'arch': 'x86_64',
                                  'features': 'fake flag goes here',
                                  'model': 'Fake CPU',
-                                 'topology': {'cores': '5',
-                                              'sockets': '10',
-                                              'threads': '4'},
+                                 'topology': {'cores': 1,
+                                              'sockets': 2,
+                                              'threads': 2},
                                  'vendor': 'FakeVendor'},
                     'hypervisor_hostname': 'fake_hostname',
                     'hypervisor_type': 'lxd',
@@ -528,15 +678,57 @@ class LXDTestDriver(test.NoDBTestCase):
                                              vm_mode.EXE],
                                             [arch.X86_64, hv_type.LXC,
                                              vm_mode.EXE]],
-                    'vcpus': 200,
+                    'vcpus': 4,
                     'vcpus_used': 0}
         self.assertEqual(expected, value)
-        me.assert_called_once_with('lscpu')
+        self.assertFalse(me.called)
         self.assertEqual([mock.call('/proc/cpuinfo', 'r'),
                           mock.call('/proc/meminfo')],
                          mo.call_args_list)
         ms.assert_called_once_with('/fake/lxd/root')
 
+    @mock.patch('psutil.cpu_count', mock.Mock(return_value=8))
+    @mock.patch('six.moves.builtins.open')
+    def test_get_cpuinfo_no_sysfs(self, mo):
+        cpuinfo = mock.MagicMock()
+        cpuinfo.__enter__.return_value = six.moves.cStringIO(
+            'processor: 0\n'
+            'vendor_id: FakeVendor\n'
+            'model name: Fake CPU\n'
+            'siblings: 4\n'
+            'cpu cores: 2\n'
+            'flags: fake flag goes here\n')
+        mo.return_value = cpuinfo
+        lxd_host = self.connection.host
+        with mock.patch.object(lxd_host, '_read_sysfs',
+                               side_effect=IOError):
+            cpu_info = lxd_host._get_cpuinfo()
+        self.assertEqual({'sockets': 2, 'cores': 2, 'threads': 2},
+                         cpu_info['topology'])
+        self.assertEqual('Fake CPU', cpu_info['model'])
+
+    @mock.patch('six.moves.builtins.open',
+                mock.Mock(side_effect=IOError))
+    def test_get_cpuinfo_cached(self):
+        cpu_info = {'topology': {'sockets': 1, 'cores': 1, 'threads': 1}}
+        lxd_host = self.connection.host
+        with mock.patch.object(lxd_host, '_read_sysfs',
+                               return_value='0-3'), (
+                mock.patch.object(lxd_host, '_build_cpuinfo',
+                                  return_value=cpu_info)) as mb:
+            self.assertEqual(cpu_info, lxd_host._get_cpuinfo())
+            self.assertEqual(cpu_info, lxd_host._get_cpuinfo())
+            mb.assert_called_once_with('0-3')
+
+            # CPU hotplug changes the online list and refreshes the info
+            lxd_host._read_sysfs.return_value = '0-7'
+            lxd_host._get_cpuinfo()
+            mb.assert_called_with('0-7')
+
+            lxd_host.invalidate_cpuinfo()
+            lxd_host._get_cpuinfo()
+            self.assertEqual(3, mb.call_count)
+
     # methods that simply proxy some arguments through
     simple_methods = (
         ('reboot', 'container_reboot',
@@ -639,36 +831,20 @@ class LXDTestDriverNoops(test.NoDBTestCase):
         self.connection = driver.LXDDriver(fake.FakeVirtAPI())
 
     @ddt.data(
-        'list_instance_uuids',
-        'get_diagnostics',
-        'get_instance_diagnostics',
-        'get_all_bw_counters',
         'get_all_volume_usage',
         'attach_volume',
         'detach_volume',
         'migrate_disk_and_power_off',
         'finish_migration',
         'confirm_migration',
-        'finish_revert_migration',
         'unpause',
         'suspend',
         'resume',
         'soft_delete',
-        'pre_live_migration',
-        'live_migration',
-        'rollback_live_migration_at_destination',
-        'post_live_migration_at_source',
-        'post_live_migration_at_destination',
         'check_instance_shared_storage_local',
         'check_instance_shared_storage_remote',
-        'check_can_live_migrate_destination',
-        'check_can_live_migrate_destination_cleanup',
-        'check_can_live_migrate_source',
         'get_instance_disk_info',
         'poll_rebooting_instances',
-        'host_power_action',
-        'host_maintenance_mode',
-        'set_host_enabled',
         'block_stats',
         'add_to_aggregate',
         'remove_from_aggregate',
@@ -689,9 +865,7 @@ class LXDTestDriverNoops(test.NoDBTestCase):
 
     @ddt.data(
         'post_interrupted_snapshot_cleanup',
-        'post_live_migration',
         'check_instance_shared_storage_cleanup',
-        'manage_image_cache',
     )
     def test_pass(self, method):
         call = getattr(self.connection, method)
@@ -703,7 +877,6 @@ class LXDTestDriverNoops(test.NoDBTestCase):
     @tests.annotated_data(
         ('deallocate_networks_on_reschedule', False),
         ('macs_for_instance', None),
-        ('get_per_instance_usage', {}),
         ('instance_on_disk', False),
     )
     def test_return(self, method, expected):
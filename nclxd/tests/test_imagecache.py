@@ -0,0 +1,99 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova import test
+from oslo_utils import units
+from pylxd import exceptions as lxd_exceptions
+
+from nclxd.nova.virt.lxd import container_client
+from nclxd.nova.virt.lxd import imagecache
+from nclxd import tests
+
+
+@mock.patch.object(imagecache, 'CONF', tests.MockConf(
+    remove_unused_base_images=True,
+    remove_unused_original_minimum_age_seconds=3600,
+    lxd_kwargs={'image_cache_max_size_mb': 0}))
+@mock.patch('time.time', mock.Mock(return_value=10000))
+class LXDTestImageCacheManager(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestImageCacheManager, self).setUp()
+        self.ml = tests.lxd_mock()
+        lxd_patcher = mock.patch('pylxd.api.API',
+                                 mock.Mock(return_value=self.ml))
+        lxd_patcher.start()
+        self.addCleanup(lxd_patcher.stop)
+        container_client.POOL.clear()
+        self.addCleanup(container_client.POOL.clear)
+
+        self.entries = {
+            'used': {'fingerprint': 'fp-used', 'files': ['/used'],
+                     'size': 100 * units.Mi, 'last_used': 0},
+            'old': {'fingerprint': 'fp-old', 'files': ['/old'],
+                    'size': 100 * units.Mi, 'last_used': 1000},
+            'recent': {'fingerprint': 'fp-recent', 'files': ['/recent'],
+                       'size': 100 * units.Mi, 'last_used': 9000},
+        }
+        index_patcher = mock.patch.object(imagecache, 'INDEX')
+        self.mi = index_patcher.start()
+        self.addCleanup(index_patcher.stop)
+        self.mi.entries.return_value = self.entries
+        lock_patcher = mock.patch.object(imagecache.lockutils, 'lock',
+                                         mock.MagicMock())
+        lock_patcher.start()
+        self.addCleanup(lock_patcher.stop)
+
+        self.manager = imagecache.LXDImageCacheManager()
+        running_patcher = mock.patch.object(
+            self.manager, '_list_running_instances',
+            return_value={'used_images': {'used': (1, 0, ['inst'])}})
+        running_patcher.start()
+        self.addCleanup(running_patcher.stop)
+
+    @mock.patch('oslo_utils.fileutils.delete_if_exists')
+    def test_update_age(self, md):
+        self.manager.update({}, [])
+        self.mi.touch.assert_called_once_with(set(['used']))
+        self.ml.image_delete.assert_called_once_with('fp-old')
+        self.ml.alias_delete.assert_called_once_with('old')
+        md.assert_called_once_with('/old')
+        self.mi.remove.assert_called_once_with('old')
+
+    @mock.patch('oslo_utils.fileutils.delete_if_exists', mock.Mock())
+    def test_update_size(self):
+        imagecache.CONF.lxd.image_cache_max_size_mb = 150
+        self.addCleanup(setattr, imagecache.CONF.lxd,
+                        'image_cache_max_size_mb', 0)
+        self.manager.update({}, [])
+        self.assertEqual([mock.call('fp-old'), mock.call('fp-recent')],
+                         self.ml.image_delete.call_args_list)
+
+    @mock.patch('oslo_utils.fileutils.delete_if_exists')
+    def test_update_delete_fail(self, md):
+        self.ml.image_delete.side_effect = (
+            lxd_exceptions.APIError('Fake', 500))
+        self.manager.update({}, [])
+        self.assertFalse(md.called)
+        self.assertFalse(self.mi.remove.called)
+
+    def test_update_disabled(self):
+        imagecache.CONF.remove_unused_base_images = False
+        self.addCleanup(setattr, imagecache.CONF,
+                        'remove_unused_base_images', True)
+        self.manager.update({}, [])
+        self.assertFalse(self.ml.image_delete.called)
@@ -0,0 +1,290 @@
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import base64
+import json
+import os
+import tarfile
+
+import fixtures
+import mock
+from nova import test
+from oslo_concurrency import processutils
+import six
+
+from nclxd.cmd import privhelper as privhelper_cmd
+from nclxd.nova.virt.lxd import constants
+from nclxd.nova.virt.lxd import privhelper
+from nclxd import tests
+
+
+@mock.patch.object(privhelper, 'CONF',
+                   tests.MockConf(lxd_kwargs={'use_privhelper': True}))
+class LXDTestPrivHelperClient(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestPrivHelperClient, self).setUp()
+        self.helper = privhelper.LXDPrivHelper()
+        helper_patcher = mock.patch.object(privhelper, 'HELPER', self.helper)
+        helper_patcher.start()
+        self.addCleanup(helper_patcher.stop)
+
+        popen_patcher = mock.patch.object(privhelper.subprocess, 'Popen')
+        self.mp = popen_patcher.start()
+        self.addCleanup(popen_patcher.stop)
+        self.proc = self.mp.return_value
+        self.proc.poll.return_value = None
+
+        root_helper_patcher = mock.patch.object(
+            privhelper.utils, 'get_root_helper',
+            mock.Mock(return_value='sudo nova-rootwrap /etc/nova/rw.conf'))
+        root_helper_patcher.start()
+        self.addCleanup(root_helper_patcher.stop)
+
+    def test_call(self):
+        self.proc.stdout.readline.side_effect = [b'{"result": null}\n',
+                                                 b'{"result": "out"}\n']
+        privhelper.chmod('/fake/path', 0o755)
+        privhelper.ovs_vsctl(['--', 'add-port', 'br', 'dev'])
+        self.mp.assert_called_once_with(
+            ['sudo', 'nova-rootwrap', '/etc/nova/rw.conf',
+             'nclxd-privhelper', '--root-dir', '/fake/lxd/root'],
+            stdin=privhelper.subprocess.PIPE,
+            stdout=privhelper.subprocess.PIPE,
+            close_fds=True)
+        self.assertEqual(
+            [{'op': 'chmod', 'args': ['/fake/path', 493]},
+             {'op': 'ovs_vsctl', 'args': [['--', 'add-port', 'br', 'dev']]}],
+            [json.loads(call[0][0].decode())
+             for call in self.proc.stdin.write.call_args_list])
+
+    def test_call_error(self):
+        self.proc.stdout.readline.return_value = (
+            b'{"error": "failed", "cmd": ["ip", "-batch", "-"], '
+            b'"exit_code": 2, "stdout": "", "stderr": "bad"}\n')
+        ex = self.assertRaises(processutils.ProcessExecutionError,
+                               privhelper.ip_batch, ['link add foo'])
+        self.assertEqual(2, ex.exit_code)
+        self.assertEqual('bad', ex.stderr)
+
+    def test_read_console(self):
+        self.proc.stdout.readline.return_value = (
+            '{"result": {"data": "%s", "offset": 3, "size": 10, '
+            '"inode": 42}}\n' % base64.b64encode(b'console').decode()
+        ).encode()
+        self.assertEqual({'data': b'console', 'offset': 3, 'size': 10,
+                          'inode': 42},
+                         privhelper.read_console('/fake/console.log', 10))
+
+    @mock.patch.object(privhelper.utils, 'execute')
+    def test_fallback(self, me):
+        self.proc.stdout.readline.return_value = b''
+        privhelper.chown('/fake/path', 1234, 1234)
+        me.assert_called_once_with('chown', '1234:1234', '/fake/path',
+                                   run_as_root=True)
+        self.assertIsNone(self.helper._proc)
+
+    @mock.patch.object(privhelper.utils, 'execute')
+    def test_fallback_backs_off(self, me):
+        self.proc.stdout.readline.return_value = b''
+        privhelper.chmod('/fake/path', 0o755)
+        privhelper.chmod('/fake/path', 0o755)
+        self.assertEqual(2, me.call_count)
+        self.mp.assert_called_once_with(mock.ANY, stdin=mock.ANY,
+                                        stdout=mock.ANY, close_fds=True)
+
+        self.helper._retry_at = 0
+        privhelper.chmod('/fake/path', 0o755)
+        self.assertEqual(2, self.mp.call_count)
+
+    @mock.patch.object(privhelper.utils, 'execute')
+    def test_disabled(self, me):
+        with mock.patch.object(privhelper.CONF.lxd, 'use_privhelper', False):
+            privhelper.chmod('/fake/path', 0o755)
+            self.assertRaises(privhelper.LXDPrivHelperUnavailable,
+                              privhelper.read_console, '/fake/path', 10)
+        me.assert_called_once_with('chmod', '755', '/fake/path',
+                                   run_as_root=True)
+        self.assertFalse(self.mp.called)
+
+
+class LXDTestPrivHelperCommand(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestPrivHelperCommand, self).setUp()
+        self.root_dir = self.useFixture(fixtures.TempDir()).path
+        self.container_dir = os.path.join(self.root_dir, 'containers', 'c1')
+        os.makedirs(self.container_dir)
+        self.helper = privhelper_cmd.PrivHelper(self.root_dir, os.getuid(),
+                                                os.getgid())
+
+    def test_read_console(self):
+        path = os.path.join(self.container_dir, 'console.log')
+        with open(path, 'wb') as fp:
+            fp.write(b'hello console')
+        inode = os.stat(path).st_ino
+        self.assertEqual(
+            {'result': {'data': base64.b64encode(b'console').decode(),
+                        'offset': 6, 'size': 13, 'inode': inode}},
+            self.helper.handle({'op': 'read_console', 'args': [path, 7]}))
+        self.assertEqual(
+            {'result': {'data': base64.b64encode(b'ole').decode(),
+                        'offset': 10, 'size': 13, 'inode': inode}},
+            self.helper.handle({'op': 'read_console',
+                                'args': [path, 7, 10]}))
+
+    def _make_snapshots(self):
+        snapshots_dir = os.path.join(self.root_dir, 'snapshots', 'c1')
+        base = os.path.join(snapshots_dir, 'base', 'rootfs')
+        new = os.path.join(snapshots_dir, 'new', 'rootfs')
+        for rootfs, files in ((base, {'etc/same': 'same', 'etc/mod': 'a',
+                                      'var/old/file': 'old'}),
+                              (new, {'etc/same': 'same', 'etc/mod': 'bb',
+                                     'etc/new': 'new'})):
+            for name, data in files.items():
+                path = os.path.join(rootfs, name)
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as fp:
+                    fp.write(data)
+                os.utime(path, (0, 0))
+        return base, new
+
+    def test_rootfs_delta(self):
+        base, new = self._make_snapshots()
+        target = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'delta.tar.gz')
+
+        reply = self.helper.handle({'op': 'rootfs_delta',
+                                    'args': [base, new, target]})
+        self.assertEqual(2, reply['result']['changed'])
+        self.assertEqual(1, reply['result']['removed'])
+        self.assertEqual(os.path.getsize(target), reply['result']['size'])
+        with tarfile.open(target) as tar:
+            names = tar.getnames()
+            self.assertEqual(constants.WHITEOUTS, names[0])
+            self.assertEqual(['rootfs/etc/mod', 'rootfs/etc/new'],
+                             sorted(names[1:]))
+            self.assertEqual(
+                b'var\0',
+                tar.extractfile(constants.WHITEOUTS).read())
+            self.assertEqual(b'bb',
+                             tar.extractfile('rootfs/etc/mod').read())
+
+    def test_rootfs_delta_outside_snapshots(self):
+        reply = self.helper.handle(
+            {'op': 'rootfs_delta',
+             'args': [self.container_dir, self.container_dir,
+                      os.path.join(self.container_dir, 'delta.tar.gz')]})
+        self.assertIn('outside', reply['error'])
+
+    def test_rootfs_delta_other_users_dir(self):
+        base, new = self._make_snapshots()
+        helper = privhelper_cmd.PrivHelper(self.root_dir, os.getuid() + 1,
+                                           os.getgid())
+        target = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'delta.tar.gz')
+        reply = helper.handle({'op': 'rootfs_delta',
+                               'args': [base, new, target]})
+        self.assertIn('does not belong', reply['error'])
+        self.assertFalse(os.path.exists(target))
+
+    def test_rootfs_delta_existing_target(self):
+        base, new = self._make_snapshots()
+        target = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'delta.tar.gz')
+        os.symlink('/etc/passwd', target)
+        reply = self.helper.handle({'op': 'rootfs_delta',
+                                    'args': [base, new, target]})
+        self.assertIn('File exists', reply['error'])
+
+    def test_path_outside_root(self):
+        reply = self.helper.handle({'op': 'chmod',
+                                    'args': ['/etc/passwd', 0o644]})
+        self.assertIn('outside', reply['error'])
+
+    def test_chown_other_user(self):
+        path = os.path.join(self.container_dir, 'console.log')
+        open(path, 'w').close()
+        reply = self.helper.handle({'op': 'chown',
+                                    'args': [path, os.getuid() + 1,
+                                             os.getgid()]})
+        self.assertIn('can only be given', reply['error'])
+
+    def test_chmod_mode(self):
+        reply = self.helper.handle({'op': 'chmod',
+                                    'args': [self.container_dir, 0o4755]})
+        self.assertIn('Only directories', reply['error'])
+        self.assertEqual(
+            {'result': None},
+            self.helper.handle({'op': 'chmod',
+                                'args': [self.container_dir, 0o755]}))
+
+    def test_chmod_file(self):
+        path = os.path.join(self.container_dir, 'console.log')
+        open(path, 'w').close()
+        reply = self.helper.handle({'op': 'chmod', 'args': [path, 0o755]})
+        self.assertIn('Only directories', reply['error'])
+
+    def test_unknown_op(self):
+        self.assertEqual({'error': 'Unknown operation _run'},
+                         self.helper.handle({'op': '_run',
+                                             'args': [['id']]}))
+
+    def test_ip_batch_link_only(self):
+        reply = self.helper.handle({'op': 'ip_batch',
+                                    'args': [[u'addr add 1.2.3.4 dev lo']]})
+        self.assertIn('Only link commands', reply['error'])
+
+    @mock.patch.object(privhelper_cmd.subprocess, 'Popen')
+    def test_ovs_vsctl(self, mp):
+        mp.return_value.communicate.return_value = (b'out', b'')
+        mp.return_value.returncode = 0
+        self.assertEqual(
+            {'result': 'out'},
+            self.helper.handle({'op': 'ovs_vsctl',
+                                'args': [[u'--', u'add-port', u'br']]}))
+        self.assertEqual(['ovs-vsctl', '--', 'add-port', 'br'],
+                         mp.call_args[0][0])
+
+    @mock.patch.object(privhelper_cmd.subprocess, 'Popen')
+    def test_command_error(self, mp):
+        mp.return_value.communicate.return_value = (b'', b'bad')
+        mp.return_value.returncode = 1
+        reply = self.helper.handle({'op': 'ovs_vsctl', 'args': [[u'show']]})
+        self.assertEqual(1, reply['exit_code'])
+        self.assertEqual('bad', reply['stderr'])
+
+    @mock.patch.dict(os.environ, {'SUDO_UID': '1234', 'SUDO_GID': '5678'})
+    def test_caller(self):
+        self.assertEqual((1234, 5678), privhelper_cmd._caller())
+
+    @mock.patch.dict(os.environ, clear=True)
+    def test_caller_no_sudo(self):
+        self.assertEqual((os.getuid(), os.getgid()),
+                         privhelper_cmd._caller())
+
+    def test_main(self):
+        stdin = six.StringIO('{"op": "bogus"}\nnot json\n')
+        stdout = six.StringIO()
+        with mock.patch('sys.stdin', stdin), \
+                mock.patch('sys.stdout', stdout), \
+                mock.patch('sys.argv', ['nclxd-privhelper', '--root-dir',
+                                        self.root_dir]):
+            privhelper_cmd.main()
+        replies = stdout.getvalue().splitlines()
+        self.assertEqual(2, len(replies))
+        self.assertIn('Unknown operation', replies[0])
+        self.assertIn('Invalid request', replies[1])
@@ -16,6 +16,7 @@
 import copy
 
 import ddt
+import eventlet
 import mock
 from oslo_concurrency import processutils
 
@@ -23,11 +24,15 @@ from nova import exception
 from nova.network import model as network_model
 from nova import test
 
+from nclxd.nova.virt.lxd import privhelper
 from nclxd.nova.virt.lxd import vif
 from nclxd import tests
 
 
 @ddt.ddt
+@mock.patch.object(privhelper, 'CONF', tests.MockConf())
+@mock.patch.object(vif, 'CONF', tests.MockConf(network_device_mtu=None,
+                                               ovs_vsctl_timeout=120))
 class LXDTestOVSDriver(test.NoDBTestCase):
 
     vif_data = {
@@ -110,6 +115,82 @@ class LXDTestOVSDriver(test.NoDBTestCase):
                 '00:11:22:33:44:55', 'fake-uuid'))
         self.assertEqual(calls, self.mgr.method_calls)
 
+    @tests.annotated_data(
+        ('new', [False, False, False, False], [
+            'link add name qbr0123456789a type bridge forward_delay 0 '
+            'stp_state 0 mcast_snooping 0',
+            'link add qvb0123456789a type veth peer name qvo0123456789a',
+            'link set qvb0123456789a up promisc on',
+            'link set qvo0123456789a up promisc on',
+            'link set qbr0123456789a up',
+            'link set qvb0123456789a master qbr0123456789a',
+            'link add name qbr123456789ab type bridge forward_delay 0 '
+            'stp_state 0 mcast_snooping 0',
+            'link add qvb123456789ab type veth peer name qvo123456789ab',
+            'link set qvb123456789ab up promisc on',
+            'link set qvo123456789ab up promisc on',
+            'link set qbr123456789ab up',
+            'link set qvb123456789ab master qbr123456789ab']),
+        ('existing', [True, True, True, True], None),
+    )
+    def test_plug_vifs(self, tag, exists, commands):
+        instance = tests.MockInstance()
+        vifs = [copy.deepcopy(self.vif_data), copy.deepcopy(self.vif_data)]
+        vifs[1]['id'] = '123456789abcdef0'
+        self.mgr.net.device_exists.side_effect = exists
+        self.vif_driver.plug_vifs(instance, vifs)
+        if commands is None:
+            self.assertFalse(self.mgr.ex.called)
+            return
+        self.assertEqual(
+            [mock.call('ip', '-batch', '-',
+                       process_input='\n'.join(commands) + '\n',
+                       run_as_root=True),
+             mock.call('ovs-vsctl', '--timeout=120',
+                       *(self._port_args('qvo0123456789a',
+                                         '0123456789abcdef') +
+                         self._port_args('qvo123456789ab',
+                                         '123456789abcdef0')),
+                       run_as_root=True)],
+            self.mgr.ex.call_args_list)
+        self.assertFalse(self.mgr.net.create_ovs_vif_port.called)
+
+    def _port_args(self, dev, iface_id):
+        return ['--', '--if-exists', 'del-port', dev,
+                '--', 'add-port', 'fakebr', dev,
+                '--', 'set', 'Interface', dev,
+                'external-ids:iface-id=%s' % iface_id,
+                'external-ids:iface-status=active',
+                'external-ids:attached-mac=00:11:22:33:44:55',
+                'external-ids:vm-uuid=fake-uuid']
+
+    def test_plug_vifs_fallback(self):
+        instance = tests.MockInstance()
+        vif_data = copy.deepcopy(self.vif_data)
+        self.mgr.net.device_exists.side_effect = [True, False, True, False]
+        self.mgr.ex.side_effect = [processutils.ProcessExecutionError,
+                                   None, None]
+        self.vif_driver.plug_vifs(instance, [vif_data])
+        self.assertEqual(
+            [mock.call.net.device_exists('qbr0123456789a'),
+             mock.call.net.device_exists('qvo0123456789a'),
+             mock.call.ex('ip', '-batch', '-', process_input=mock.ANY,
+                          run_as_root=True),
+             # The batch may have stopped halfway; start over.
+             mock.call.net.delete_net_dev('qvb0123456789a'),
+             mock.call.net.device_exists('qbr0123456789a'),
+             mock.call.net.device_exists('qvo0123456789a'),
+             mock.call.net._create_veth_pair('qvb0123456789a',
+                                             'qvo0123456789a'),
+             mock.call.ex('ip', 'link', 'set', 'qbr0123456789a', 'up',
+                          run_as_root=True),
+             mock.call.ex('brctl', 'addif', 'qbr0123456789a',
+                          'qvb0123456789a', run_as_root=True),
+             mock.call.net.create_ovs_vif_port(
+                 'fakebr', 'qvo0123456789a', '0123456789abcdef',
+                 '00:11:22:33:44:55', 'fake-uuid')],
+            self.mgr.method_calls)
+
     def test_unplug_fail(self):
         instance = tests.MockInstance()
         vif_data = copy.deepcopy(self.vif_data)
@@ -154,6 +235,64 @@ class LXDTestOVSDriver(test.NoDBTestCase):
         self.assertEqual(calls, self.mgr.method_calls)
 
 
+@mock.patch.object(privhelper, 'CONF', tests.MockConf())
+@mock.patch.object(vif, 'CONF', tests.MockConf(ovs_vsctl_timeout=120))
+class LXDTestOvsPortTransaction(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LXDTestOvsPortTransaction, self).setUp()
+        self.transaction = vif.LXDOvsPortTransaction()
+        execute_patcher = mock.patch.object(vif.utils, 'execute')
+        self.me = execute_patcher.start()
+        self.addCleanup(execute_patcher.stop)
+
+    def _port(self, dev):
+        return ('fakebr', dev, 'iface-%s' % dev, '00:11:22:33:44:55',
+                'fake-uuid')
+
+    def _devs(self, call):
+        args = call[0]
+        return [args[i + 1] for i, arg in enumerate(args)
+                if arg == 'add-port']
+
+    def test_group_commit(self):
+        def execute(*args, **kwargs):
+            eventlet.sleep(0.01)
+        self.me.side_effect = execute
+
+        threads = [eventlet.spawn(self.transaction.add_ports,
+                                  [self._port('qvo%d' % i)])
+                   for i in range(3)]
+        for thread in threads:
+            self.assertIsNone(thread.wait())
+
+        self.assertEqual([['qvo0'], ['qvo1', 'qvo2']],
+                         [self._devs(call) for call in
+                          self.me.call_args_list])
+        self.assertFalse(self.transaction._committing)
+
+    def test_failure_isolated(self):
+        def execute(*args, **kwargs):
+            eventlet.sleep(0.01)
+            if 'qvobad' in args:
+                raise processutils.ProcessExecutionError()
+        self.me.side_effect = execute
+
+        first = eventlet.spawn(self.transaction.add_ports,
+                               [self._port('qvo0')])
+        good = eventlet.spawn(self.transaction.add_ports,
+                              [self._port('qvo1')])
+        bad = eventlet.spawn(self.transaction.add_ports,
+                             [self._port('qvobad')])
+        self.assertIsNone(first.wait())
+        self.assertIsNone(good.wait())
+        self.assertRaises(exception.OvsConfigurationFailure, bad.wait)
+        self.assertEqual([['qvo0'], ['qvo1', 'qvobad'], ['qvo1'],
+                          ['qvobad']],
+                         [self._devs(call) for call in
+                          self.me.call_args_list])
+
+
 @ddt.ddt
 @mock.patch.object(vif, 'CONF', tests.MockConf())
 class LXDTestBridgeDriver(test.NoDBTestCase):
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare the buffered and streaming multipart image upload bodies.
+
+Each mode runs in its own process so that the reported peak RSS only
+covers that mode. The body is drained into a null sink in the chunk size
+httplib uses, which is what sending it to the LXD daemon costs on the
+client side.
+
+Usage: benchmark_image_upload.py [--size-mb N]
+"""
+
+from __future__ import print_function
+
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+CHUNK_SIZE = 8192
+
+
+def _legacy_body(boundary, paths):
+    form = []
+    for name, path in paths:
+        form.append("--%s" % boundary)
+        form.append("Content-Disposition: form-data; "
+                    "name=%s; filename=%s" % (name, os.path.basename(path)))
+        form.append("Content-Type: application/octet-stream")
+        form.append("")
+        with open(path, "rb") as fd:
+            form.append(fd.read())
+    form.append("--%s--" % boundary)
+    form.append("")
+
+    body = b""
+    for entry in form:
+        if isinstance(entry, bytes):
+            body += entry + b"\r\n"
+        else:
+            body += entry.encode() + b"\r\n"
+
+    for offset in range(0, len(body), CHUNK_SIZE):
+        body[offset:offset + CHUNK_SIZE]
+    return len(body)
+
+
+def _streaming_body(boundary, paths):
+    from nclxd.nova.virt.lxd import container_image
+
+    files = [open(path, 'rb') for name, path in paths]
+    try:
+        parts = [(name, os.path.basename(path), fd, os.path.getsize(path))
+                 for (name, path), fd in zip(paths, files)]
+        body = container_image.MultipartReader(boundary, parts)
+        sent = 0
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sent += len(chunk)
+        return sent
+    finally:
+        for fd in files:
+            fd.close()
+
+
+def run_mode(mode, meta_path, rootfs_path):
+    paths = [('metadata', meta_path), ('rootfs', rootfs_path)]
+    boundary = str(uuid.uuid1())
+    func = {'legacy': _legacy_body, 'stream': _streaming_body}[mode]
+
+    start = time.time()
+    sent = func(boundary, paths)
+    elapsed = time.time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-8s %10d bytes %8.3fs %10.1f MB/s peak RSS %8.1f MB' %
+          (mode, sent, elapsed, sent / elapsed / 1024 / 1024,
+           peak_kb / 1024.0))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--size-mb', type='int', default=512,
+                      help='size of the fake rootfs tarball')
+    parser.add_option('--mode', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--meta', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--rootfs', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.mode:
+        run_mode(options.mode, options.meta, options.rootfs)
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    meta_path = os.path.join(tmpdir, 'image-lxd.tar.xz')
+    rootfs_path = os.path.join(tmpdir, 'image-root.tar.xz')
+    try:
+        with open(meta_path, 'wb') as fd:
+            fd.write(os.urandom(64 * 1024))
+        with open(rootfs_path, 'wb') as fd:
+            for i in range(options.size_mb):
+                fd.write(os.urandom(1024 * 1024))
+
+        for mode in ('legacy', 'stream'):
+            subprocess.check_call([sys.executable, __file__,
+                                   '--mode', mode,
+                                   '--meta', meta_path,
+                                   '--rootfs', rootfs_path])
+    finally:
+        os.remove(meta_path)
+        os.remove(rootfs_path)
+        os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
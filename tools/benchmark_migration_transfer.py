@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure image migration throughput against a loopback fake LXD.
+
+A fake daemon on 127.0.0.1 serves a gzip compressed image export and
+accepts chunked image uploads. The image is moved between the two with
+every compression setting, the way an image migration moves it between
+hosts, and the bytes on the wire, elapsed time and image throughput are
+reported for each.
+
+Usage: benchmark_migration_transfer.py [--size-mb N] [--bandwidth-mb N]
+"""
+
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from six.moves import BaseHTTPServer
+from six.moves import http_client
+from six.moves import socketserver
+
+from nclxd.nova.virt.lxd import container_transfer
+
+SETTINGS = [('none', 0), ('gzip', 1), ('gzip', 6), ('bzip2', 9), ('xz', 1),
+            ('xz', 6)]
+
+
+class FakeLXDHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        size = os.path.getsize(self.server.image_path)
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        with open(self.server.image_path, 'rb') as fp:
+            while True:
+                chunk = fp.read(container_transfer.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def do_POST(self):
+        received = 0
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                break
+            received += len(self.rfile.read(size))
+            self.rfile.readline()
+        body = json.dumps({'metadata': {'received': received}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeLXDServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # The export and the upload are served at the same time.
+    daemon_threads = True
+
+
+class FakeConnection(object):
+
+    def __init__(self, port):
+        self.port = port
+
+    def get_connection(self):
+        return http_client.HTTPConnection('127.0.0.1', self.port)
+
+
+def make_image(path, size_mb):
+    """Write a gzip image of half random, half repetitive data."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    text = b'usr/lib/python2.7/site-packages/fake/module.py 0644 root\n'
+    with open(path, 'wb') as fp:
+        for i in range(size_mb):
+            data = os.urandom(512 * 1024) + text * (512 * 1024 // len(text))
+            fp.write(compressor.compress(data))
+        fp.write(compressor.flush())
+
+
+def transfer(port, compression, level, rate):
+    export = container_transfer.ImageExportReader(FakeConnection(port),
+                                                  'fake')
+    stream = container_transfer.open_stream(export, compression, level, rate)
+    conn = http_client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/1.0/images',
+                 body=container_transfer.ChunkedEncoder(stream),
+                 headers={'Transfer-Encoding': 'chunked'})
+    received = json.loads(conn.getresponse().read().decode())
+    conn.close()
+    export.close()
+    return export.bytes_read, received['metadata']['received']
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--size-mb', type='int', default=256,
+                      help='uncompressed size of the fake image')
+    parser.add_option('--bandwidth-mb', type='int', default=0,
+                      help='bandwidth limit in MB/s, 0 for none')
+    options, args = parser.parse_args()
+
+    fd, image_path = tempfile.mkstemp()
+    os.close(fd)
+    server = FakeLXDServer(('127.0.0.1', 0), FakeLXDHandler)
+    server.image_path = image_path
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        make_image(image_path, options.size_mb)
+        for compression, level in SETTINGS:
+            if compression == 'xz' and container_transfer.lzma is None:
+                continue
+            start = time.time()
+            exported, sent = transfer(
+                server.server_address[1], compression, level,
+                options.bandwidth_mb * 1024 * 1024)
+            elapsed = time.time() - start
+            print('%-6s %d: %10d bytes on the wire (%5.1f%% of export) '
+                  '%7.2fs %8.1f MB/s of image' %
+                  (compression, level, sent, 100.0 * sent / exported,
+                   elapsed, options.size_mb / elapsed))
+    finally:
+        server.shutdown()
+        os.remove(image_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Copyright 2015 Canonical Ltd
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare per-command and batched host device setup for vifs.
+
+Both modes create the qbr bridge and the qvb/qvo veth pair that the OVS
+vif driver uses for every vif and remove them again afterwards. The OVS
+port itself is left out since it costs the same in both modes. Run as
+root; pass the compute node's root helper with --root-helper to include
+the cost of rootwrap in every privileged call.
+
+Usage: benchmark_vif_plug.py [--vifs N] [--rounds N]
+                             [--root-helper 'sudo nova-rootwrap ...']
+"""
+
+from __future__ import print_function
+
+import optparse
+import shlex
+import subprocess
+import time
+
+
+def _names(index):
+    suffix = 'bench%06d' % index
+    return 'qbr' + suffix, 'qvb' + suffix, 'qvo' + suffix
+
+
+def _run(root_helper, *cmd, **kwargs):
+    process_input = kwargs.get('process_input')
+    proc = subprocess.Popen(root_helper + list(cmd),
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(process_input and process_input.encode())
+    if proc.returncode not in kwargs.get('check_exit_code', [0]):
+        raise RuntimeError('%s failed: %s' % (' '.join(cmd), err))
+
+
+def plug_legacy(root_helper, vifs):
+    for index in range(vifs):
+        br_name, v1_name, v2_name = _names(index)
+        _run(root_helper, 'brctl', 'addbr', br_name)
+        _run(root_helper, 'brctl', 'setfd', br_name, '0')
+        _run(root_helper, 'brctl', 'stp', br_name, 'off')
+        _run(root_helper, 'tee',
+             '/sys/class/net/%s/bridge/multicast_snooping' % br_name,
+             process_input='0', check_exit_code=[0, 1])
+        _run(root_helper, 'ip', 'link', 'add', v1_name, 'type', 'veth',
+             'peer', 'name', v2_name)
+        for dev in (v1_name, v2_name):
+            _run(root_helper, 'ip', 'link', 'set', dev, 'up')
+            _run(root_helper, 'ip', 'link', 'set', dev, 'promisc', 'on')
+        _run(root_helper, 'ip', 'link', 'set', br_name, 'up')
+        _run(root_helper, 'brctl', 'addif', br_name, v1_name)
+
+
+def plug_batch(root_helper, vifs):
+    commands = []
+    for index in range(vifs):
+        br_name, v1_name, v2_name = _names(index)
+        commands.extend([
+            'link add name %s type bridge forward_delay 0 stp_state 0 '
+            'mcast_snooping 0' % br_name,
+            'link add %s type veth peer name %s' % (v1_name, v2_name),
+            'link set %s up promisc on' % v1_name,
+            'link set %s up promisc on' % v2_name,
+            'link set %s up' % br_name,
+            'link set %s master %s' % (v1_name, br_name)])
+    _run(root_helper, 'ip', '-batch', '-',
+         process_input='\n'.join(commands) + '\n')
+
+
+def cleanup(vifs):
+    commands = []
+    for index in range(vifs):
+        br_name, v1_name, v2_name = _names(index)
+        commands.extend(['link del %s' % v1_name, 'link del %s' % br_name])
+    _run([], 'ip', '-force', '-batch', '-',
+         process_input='\n'.join(commands) + '\n', check_exit_code=[0, 1])
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--vifs', type='int', default=4,
+                      help='number of vifs plugged per instance')
+    parser.add_option('--rounds', type='int', default=10,
+                      help='number of instances to time per mode')
+    parser.add_option('--root-helper', default='',
+                      help='command prefix used for privileged calls')
+    options, args = parser.parse_args()
+    root_helper = shlex.split(options.root_helper)
+
+    for mode, func in (('legacy', plug_legacy), ('batch', plug_batch)):
+        elapsed = []
+        for i in range(options.rounds):
+            start = time.time()
+            try:
+                func(root_helper, options.vifs)
+                elapsed.append(time.time() - start)
+            finally:
+                cleanup(options.vifs)
+        elapsed.sort()
+        print('%-8s %d vifs: median %8.1f ms  max %8.1f ms' %
+              (mode, options.vifs, elapsed[len(elapsed) // 2] * 1000,
+               elapsed[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()